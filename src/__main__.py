@@ -16,13 +16,19 @@ from util import Color
 from util import Logger
 from genbank import GenBankSetup
 from genbank import GenBankSearch
+from genbank import SequenceDeduplicator
 from distancematrix import DistanceMatrixBuilder
 from clusters import HACClusterBuilder
 from clusters import SLINKClusterBuilder
 from clusters import UCLUSTClusterBuilder
 from clusters import GuidedClusterBuilder
+from clusters import GreedyClusterBuilder
+from clusters import IncrementalClusterBuilder
+from clusters import ClusterBuilder
 from alignments import Alignments
+from alignments import MafftStrategyPolicy
 from supermatrix import Supermatrix
+from supermatrix import BinaryMatrix
 
 
 
@@ -36,7 +42,7 @@ def main():
     parser.add_argument("--ingroup", "-i", help="Ingroup clade to build supermatrix.")
     parser.add_argument("--outgroup", "-o", help="Outgroup clade to build supermatrix.")
     parser.add_argument("--cores", "-c", help="The number of CPU cores to use for parallel processing. Defaults to the max available.")
-    parser.add_argument("--id", "-id", help="UCLUST id threshold to cluster taxa. Defaults to 0.50")
+    parser.add_argument("--id", "-id", help="UCLUST (or greedy clustering) id threshold to cluster taxa. Defaults to 0.50")
     parser.add_argument("--evalue", "-e", help="BLAST E-value threshold to cluster taxa. Defaults to 1e-10")
     parser.add_argument("--length", "-l", help="Threshold of sequence length percent similarity to cluster taxa. Defaults to 0.25")
     parser.add_argument("--maxlength", "-maxl", help="Maximum length of sequences to include in UCLUST clusters. Defaults to 5000")
@@ -46,11 +52,47 @@ def main():
     parser.add_argument("--guide", "-g", help="""FASTA file containing sequences to guide cluster construction. If this option is 
                                                  selected then all-by-all BLAST comparisons are not performed.""")
     parser.add_argument("--alignments", "-a", nargs='+', help="List of aligned FASTA files to build supermatrix instead of mining GenBank.")
-    parser.add_argument("--salignments", "-sa", nargs='+', help="List of SUMAC alignments to build supermatrix instead of mining GenBank.")
+    parser.add_argument("--salignments", "-sa", nargs='+', help="""List of SUMAC alignments to build supermatrix instead of mining GenBank.
+                                                                   If the alignments are unchanged since the previous run, its binary
+                                                                   supermatrix is loaded instead.""")
     parser.add_argument("--search", "-s", action='store_true', help="Turn on search and cluster mode. Will not make alignments or supermatrix.")
-    parser.add_argument("--decisiveness", "-de", action='store_true', help="Calculate partial decisiveness. For larger matrices this may be slow.")
+    parser.add_argument("--decisiveness", "-de", nargs='?', const="exact", choices=["exact", "sample"], help="""Calculate partial decisiveness.
+                                                        With 'sample' PD and the decisiveness scores are estimated from randomly
+                                                        sampled triples of taxa, with confidence intervals.""")
+    parser.add_argument("--pd_samples", type=int, default=100000, help="Maximum number of triples to sample with '--decisiveness sample'. Defaults to 100000.")
+    parser.add_argument("--pd_se", type=float, help="Standard error of PD at which to stop sampling triples with '--decisiveness sample'.")
+    parser.add_argument("--plan", type=int, help="""Rank this many missing sequences by how much sequencing them, one after another, would
+                                                  increase PD. Written to sequence_acquisition_plan.csv.""")
+    parser.add_argument("--locus_costs", type=float, nargs='+', help="Cost of sequencing each gene region, in order, for --plan. Defaults to 1 for all.")
     parser.add_argument("--hac", action='store_true', help="Use HAC single-linkage clustering algorithm instead of the default UCLUST algorithm.")
     parser.add_argument("--slink", action='store_true', help="Use the SLINK clustering algorithm instead of the default UCLUST algorithm.")
+    parser.add_argument("--greedy", action='store_true', help="""Use the built-in greedy clustering algorithm instead of UCLUST. It is also used
+                                                                 if UCLUST is not installed or fails.""")
+    parser.add_argument("--incremental", action='store_true', help="""Place sequences that are new since the previous run into the clusters
+                                                                      saved by that run instead of clustering all sequences again.
+                                                                      Clusters that did not change reuse their previous alignment.""")
+    parser.add_argument("--sweep", nargs='+', help="""List of BLAST E-value thresholds to compare. Clusters the sequences with SLINK once and
+                                                      reports the clusters and taxon coverage density for each threshold. Will not make
+                                                      alignments or supermatrix.""")
+    parser.add_argument("--cache_dir", help="""Directory of alignments cached across runs. Clusters whose sequences are unchanged
+                                              are not realigned. Defaults to ./alignment_cache/""")
+    parser.add_argument("--cache_size", help="Maximum size of the alignment cache in megabytes. Use 0 to turn off the cache. Defaults to 1000")
+    parser.add_argument("--add_fraction", help="""With --incremental, clusters that grew by at most this fraction of new sequences
+                                                 are aligned by adding the new sequences to the previous alignment with MAFFT --add
+                                                 instead of realigning the cluster. Defaults to 0.2""")
+    parser.add_argument("--memory", help="""RAM budget in megabytes for aligning clusters. MAFFT jobs are started only while their estimated
+                                           memory fits in the budget, and each job is limited to this much memory. Defaults to 80%% of the
+                                           physical memory, without a limit per job.""")
+    parser.add_argument("--timeout", help="Maximum time in seconds to align each cluster. Default is none (no time limit).")
+    parser.add_argument("--mafft_policy", choices=["auto", "size"], help="""MAFFT strategy for aligning clusters. 'auto' uses MAFFT --auto
+                                                                         for every cluster. 'size' uses L-INS-i for small clusters, FFT-NS-2
+                                                                         for mid-sized clusters, and FFT-NS-1 or PartTree for large clusters.
+                                                                         Defaults to auto""")
+    parser.add_argument("--trim", help="""Remove alignment columns in which more than this fraction of the sequences have a gap before
+                                         concatenating the alignments, for example 0.9. Default is none (no trimming).""")
+    parser.add_argument("--out_of_core", action='store_true', help="""Concatenate the alignments through a memory-mapped file instead of in
+                                                                      memory, for supermatrices larger than RAM. Also writes the supermatrix
+                                                                      in PHYLIP format.""")
     args = parser.parse_args()
  
     sys.stdout = Logger()
@@ -64,6 +106,7 @@ def main():
     if args.cores and int(args.cores) <= num_cores:
         num_cores = int(args.cores) 
 
+    matrix = None
     if args.alignments:
         # if the user provides alignments:
         alignment_files = args.alignments
@@ -72,9 +115,20 @@ def main():
         # if the user inputs SUMAC alignments from previous run
         alignment_files = args.salignments
         alignments = Alignments(alignment_files, "sumac_aligned", num_cores)
+        # reuse the binary supermatrix of the previous run if the alignments have not changed
+        if not args.trim:
+            matrix = BinaryMatrix.load_for(alignment_files)
+            if matrix is not None:
+                print(color.purple + "Loading the binary supermatrix of the previous run..." + color.done)
+                alignments.summaries = matrix.summaries
     else:
         if args.search:
             print(color.yellow + "Running in search and cluster mode. Clusters will not be aligned and supermatrix will not assembled." + color.done) 
+        if args.sweep:
+            if args.guide or args.hac or args.greedy:
+                print(color.red + "Threshold sweep mode uses the SLINK algorithm and cannot be combined with --guide, --hac or --greedy." + color.done)
+                sys.exit(0)
+            print(color.yellow + "Running in threshold sweep mode. Clusters will not be aligned and supermatrix will not assembled." + color.done) 
 
         # first download and set up sqllite db if necessary
         if args.path:
@@ -125,6 +179,13 @@ def main():
             print(color.red + "No sequences found for the ingroup and outgroup!" + color.done)
             sys.exit(0)
 
+        # only cluster one copy of identical sequences
+        print(color.blue + "Collapsing identical sequences..." + color.done)
+        deduplicator = SequenceDeduplicator(gb, all_seq_keys)
+        unique_keys = deduplicator.unique_keys
+        print(color.purple + "Found " + color.red + str(len(unique_keys)) + color.purple + " unique sequences, collapsed " + color.red \
+              + str(deduplicator.get_num_duplicates()) + color.purple + " identical sequences." + color.done)
+
         # determine sequence length similarity threshold
         length_threshold = 0.25
         if args.length:
@@ -143,56 +204,103 @@ def main():
             evalue_threshold = float(args.evalue)
         print(color.blue + "Using BLAST e-value threshold " + color.red + str(evalue_threshold) + color.done)
 
+        # determine minimum number of taxa for clusters
+        min_clusters = 4
+        if args.min_clusters:
+            min_clusters = int(args.min_clusters)
+
         # now build clusters, first checking whether we are using FASTA file of guide sequences
         # or doing all-by-all comparisons
         if args.guide:
             # use FASTA file of guide sequences
             print(color.blue + "Building clusters using the guide sequences..." + color.done)
-            cluster_builder = GuidedClusterBuilder(args.guide, all_seq_keys, length_threshold, evalue_threshold, gb_dir, num_cores)
+            cluster_builder = GuidedClusterBuilder(args.guide, unique_keys, length_threshold, evalue_threshold, gb_dir, num_cores)
         else:
             # cluster using UCLUST
             uclust_error = False
-            if not (args.slink or args.hac):
+            maxlength = 5000
+            minlength = 100
+            if args.maxlength:
+                maxlength = int(args.maxlength)
+            if args.minlength:
+                minlength = int(args.minlength)
+            # place new sequences into the clusters of the previous run
+            incremental = False
+            if args.incremental and not args.sweep:
+                cluster_state = ClusterBuilder.read_cluster_state()
+                if cluster_state is None:
+                    print(color.red + "No clusters saved by a previous run. Clustering all sequences..." + color.done)
+                else:
+                    print(color.blue + "Placing new sequences into the clusters of the previous run..." + color.done)
+                    cluster_builder = IncrementalClusterBuilder(gb, unique_keys, cluster_state, num_cores, minlength, maxlength, length_threshold, id_threshold, \
+                                                                all_seq_keys)
+                    incremental = True
+            if not incremental and not (args.slink or args.hac or args.sweep or args.greedy):
                 print(color.blue + "Clustering sequences with UCLUST...")
-                maxlength = 5000
-                minlength = 100
-                if args.maxlength:
-                    maxlength = int(args.maxlength)
-                if args.minlength:
-                    minlength = int(args.minlength)
-                cluster_builder = UCLUSTClusterBuilder(gb, all_seq_keys, gb_dir, num_cores, minlength, maxlength, length_threshold, id_threshold, evalue_threshold)
+                cluster_builder = UCLUSTClusterBuilder(gb, unique_keys, gb_dir, num_cores, minlength, maxlength, length_threshold, id_threshold, evalue_threshold)
                 if (cluster_builder.error == True):
                     uclust_error = True
                 else:
                     print(color.purple + "Clustering completed..." + color.done)
-            if (args.slink or args.hac) or (uclust_error == True):
-                # make distance matrix
-                print(color.blue + "Making distance matrix for all sequences..." + color.done)
-                distance_matrix = DistanceMatrixBuilder(gb, all_seq_keys, length_threshold, gb_dir, num_cores).distance_matrix
-
-                # cluster sequences
-                if args.hac:
-                    print(color.purple + "Clustering sequences using the HAC algorithm..." + color.done)
-                    cluster_builder = HACClusterBuilder(all_seq_keys, distance_matrix, evalue_threshold)
+            if (args.greedy or (uclust_error == True)) and not incremental:
+                print(color.blue + "Clustering sequences with the built-in greedy clustering algorithm..." + color.done)
+                cluster_builder = GreedyClusterBuilder(gb, unique_keys, num_cores, minlength, maxlength, length_threshold, id_threshold)
+                print(color.purple + "Clustering completed..." + color.done)
+            if (args.slink or args.hac or args.sweep) and not incremental:
+                # reuse the SLINK dendrogram from a previous run if possible
+                dendrogram = None
+                if not args.hac:
+                    dendrogram = SLINKClusterBuilder.read_dendrogram(unique_keys, length_threshold)
+                if dendrogram is not None:
+                    print(color.purple + "Loading SLINK dendrogram from previous run..." + color.done)
+                    cluster_builder = SLINKClusterBuilder(unique_keys, None, evalue_threshold, dendrogram)
                 else:
-                    print(color.purple + "Clustering sequences using the SLINK algorithm..." + color.done)
-                    cluster_builder = SLINKClusterBuilder(all_seq_keys, distance_matrix, evalue_threshold)
+                    # make distance matrix
+                    print(color.blue + "Making distance matrix for all sequences..." + color.done)
+                    distance_matrix = DistanceMatrixBuilder(gb, unique_keys, length_threshold, gb_dir, num_cores).distance_matrix
+
+                    # cluster sequences
+                    if args.hac:
+                        print(color.purple + "Clustering sequences using the HAC algorithm..." + color.done)
+                        cluster_builder = HACClusterBuilder(unique_keys, distance_matrix, evalue_threshold)
+                    else:
+                        print(color.purple + "Clustering sequences using the SLINK algorithm..." + color.done)
+                        cluster_builder = SLINKClusterBuilder(unique_keys, distance_matrix, evalue_threshold)
+                        cluster_builder.write_dendrogram(length_threshold)
+
+        # if we are in threshold sweep mode report each threshold and we are done
+        if args.sweep:
+            thresholds = [float(threshold) for threshold in args.sweep]
+            rows = cluster_builder.sweep(gb, thresholds, min_clusters, deduplicator.duplicates)
+            for row in rows:
+                print(color.blue + "E-value threshold: " + color.red + str(row[0]) + color.blue + "  Clusters: " + color.red + str(row[1]) \
+                      + color.blue + "  Clusters with >= " + str(min_clusters) + " taxa: " + color.red + str(row[2]) \
+                      + color.blue + "  OTUs: " + color.red + str(row[3]) \
+                      + color.blue + "  Taxon coverage density: " + color.red + str(row[4]) + color.done)
+            cluster_builder.make_sweep_csv(rows)
+            print(color.yellow + "Threshold sweep results: " + color.red + "threshold_sweep.csv" + color.done)
+            sys.exit(0)
 
         print(color.purple + "Found " + color.red + str(len(cluster_builder.clusters)) + color.purple + " clusters." + color.done)
         if len(cluster_builder.clusters) == 0:
             print(color.red + "No clusters found." + color.done)
             sys.exit(0)
+        # add the identical sequences back to the clusters
+        cluster_builder.expand_duplicates(gb, deduplicator.duplicates)
+
+        # save the clusters so that later runs can add new sequences to them
+        if not args.guide:
+            cluster_builder.write_cluster_state(gb)
 
         # filter clusters, make FASTA files
         print(color.yellow + "Building sequence matrices for each cluster." + color.done)
-        min_clusters = 4
-        if args.min_clusters:
-            min_clusters = int(args.min_clusters)
-        if (args.slink or args.hac or args.guide) or (uclust_error == True):
-            cluster_builder.assemble_fasta(gb, min_clusters)
+        if isinstance(cluster_builder, UCLUSTClusterBuilder):
+            cluster_builder.assemble_fasta_uclust(min_clusters, num_cores)
         else:
-            cluster_builder.assemble_fasta_uclust(min_clusters)
+            cluster_builder.assemble_fasta(gb, min_clusters, num_cores)
         print(color.purple + "Kept " + color.red + str(len(cluster_builder.clusters)) + color.purple + " clusters, discarded those with < " + str(min_clusters) + " taxa." + color.done)
+        if args.incremental and len(cluster_builder.unchanged_files) > 0:
+            print(color.purple + "Clusters unchanged since the previous run: " + color.red + str(len(cluster_builder.unchanged_files)) + color.done)
         
         # if we are in search and cluster mode we are done
         if args.search:
@@ -203,14 +311,46 @@ def main():
             sys.exit(0)
         # now align each cluster with MAFFT
         print(color.blue + "Aligning clusters with MAFFT..." + color.done)
-        alignments = Alignments(cluster_builder.cluster_files, "unaligned", num_cores)
+        if args.cache_dir:
+            cache_dir = args.cache_dir
+        else:
+            cache_dir = os.path.abspath("alignment_cache/")
+        if args.cache_size:
+            cache_size = float(args.cache_size)
+        else:
+            cache_size = 1000
+        add_fraction = 0.0
+        unchanged_files = None
+        if args.incremental:
+            unchanged_files = cluster_builder.unchanged_files
+            if args.add_fraction:
+                add_fraction = float(args.add_fraction)
+            else:
+                add_fraction = 0.2
+        memory_budget = None
+        if args.memory:
+            memory_budget = float(args.memory)
+        timeout = None
+        if args.timeout:
+            timeout = float(args.timeout)
+        if args.mafft_policy == "size":
+            policy = MafftStrategyPolicy(MafftStrategyPolicy.SIZE)
+        else:
+            policy = MafftStrategyPolicy()
+        alignments = Alignments(cluster_builder.cluster_files, "unaligned", num_cores, cache_dir, cache_size, add_fraction,
+                                memory_budget, timeout, cluster_builder.oriented, policy, unchanged_files)
     
+    # the summaries only need the sequences to trim them, otherwise each alignment is read while concatenating
+    if args.out_of_core or not args.trim:
+        alignments.keep_sequences = False
+    if args.trim:
+        alignments.trim_gap_columns(float(args.trim))
     alignments.print_data()
     alignments.make_gene_region_csv()
 
     # concatenate alignments
     print(color.purple + "Concatenating alignments..." + color.done)
-    supermatrix = Supermatrix(alignments)
+    supermatrix = Supermatrix(alignments, args.out_of_core, matrix)
    
     try:
         imp.find_module('matplotlib')
@@ -227,10 +367,24 @@ def main():
     if matplot:
         supermatrix.make_sequence_data_figure()
     if args.decisiveness:
-        supermatrix.print_PD()
+        if args.decisiveness == "sample":
+            supermatrix.estimate_PD(args.pd_samples, args.pd_se)
+        supermatrix.print_PD(num_cores)
         if matplot:
             supermatrix.make_sequence_decisiveness_figure()
         supermatrix.make_decisiveness_csv()
+    if args.plan:
+        num_loci = 0
+        if len(supermatrix.otus) > 0:
+            num_loci = len(supermatrix.otus[list(supermatrix.otus)[0]].sequence_lengths)
+        if num_loci == 0:
+            print(color.red + "Skipping --plan, the supermatrix is empty." + color.done)
+        elif args.locus_costs and len(args.locus_costs) != num_loci:
+            print(color.red + "Skipping --plan, --locus_costs needs a cost for each of the " + str(num_loci) + " gene regions." + color.done)
+        elif args.locus_costs and min(args.locus_costs) <= 0:
+            print(color.red + "Skipping --plan, --locus_costs must all be greater than 0." + color.done)
+        else:
+            supermatrix.make_acquisition_csv(args.plan, args.locus_costs, num_cores)
     print(color.yellow + "Final supermatrix: " + color.red + "alignments/supermatrix_concatenated.fasta" + color.done)
     
 
@@ -9,12 +9,19 @@ License: GNU GPLv3 http://www.gnu.org/licenses/gpl.html
 import os
 import sys
 import csv
+import hashlib
+import shutil
+import tempfile
+import subprocess
+import time
+import signal
 import multiprocessing
+import threading
 import copy_reg
 import types
 from Bio import Entrez
 from Bio import SeqIO
-from Bio.Align.Applications import MafftCommandline
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from util import Color
 
 
@@ -27,32 +34,116 @@ class Alignments(object):
 
     files = []
     taxa = None
+    summaries = None        # AlignmentSummary of each alignment file, built once by get_summaries
+    keep_sequences = True   # False to keep the sequences out of the summaries, each alignment is then read again to concatenate it
+    max_gap_fraction = None # fraction of gaps above which trim_gap_columns removed columns, or None if not trimmed
+    num_cores = 1
     user_provided = False
     sumac_aligned = False
+    mafft_options = ["--auto", "--adjustdirection"]
+    policy = None           # MafftStrategyPolicy that selects the MAFFT strategy of each cluster
+    strategies = {}         # maps each cluster file to its strategy name and MAFFT options
+    cache = None            # AlignmentCache of previous MAFFT results, or None
+    add_fraction = 0.0      # maximum fraction of new sequences to add to a previous alignment
+    previous = {}           # maps each sequence id to its alignment file from the previous run
+    previous_ids = {}       # maps each alignment file from the previous run to its set of sequence ids
+    previous_dir = None     # scratch directory holding copies of the alignments from the previous run
+    unchanged = set()       # cluster files whose clusters are unchanged since the previous run
+    added = 0
+    reused = 0
+    reports = []            # (cluster file, MAFFT exit status, runtime in seconds, strategy) of each MAFFT job
+    memory_limit = None     # address space limit of each MAFFT job in bytes, or None
+    timeout = None          # maximum runtime of each MAFFT job in seconds, or None
+    lock = threading.Lock()
 
-    def __init__(self, cluster_files, aligned, num_cores):
+    def __init__(self, cluster_files, aligned, num_cores, cache_dir=None, cache_size=1000, add_fraction=0.0,
+                 memory_budget=None, timeout=None, oriented=False, policy=None, unchanged_files=None):
         """
         Input parameters: 
         cluster_files: a list of FASTA files 
         aligned: a string that indicated whether each file contains an 
             unaligned sequence cluster or one already aligned.
+        cache_dir: optional directory of alignments cached by previous runs.
+        cache_size: maximum size of the cache in megabytes.
+        add_fraction: if greater than 0, clusters that grew since the previous run by at most this
+            fraction of new sequences are aligned by adding the new sequences to the previous alignment.
+        memory_budget: optional RAM budget in megabytes for the concurrent MAFFT jobs, each job is also
+            limited to this much memory. Defaults to 80% of the physical memory, without a limit per job.
+        timeout: optional maximum runtime of each MAFFT job in seconds.
+        oriented: True if the sequences of each cluster are already in the same orientation,
+            so MAFFT does not need to check the reverse complement of each sequence.
+        policy: optional MafftStrategyPolicy that selects the MAFFT strategy and maximum number of threads
+            of each cluster from its size. Defaults to MAFFT --auto for every cluster.
+        unchanged_files: optional list of cluster files that are unchanged since the previous run,
+            their previous alignments are reused without running MAFFT.
         Creates new processes to align each sequence cluster.
         Generates a list of aligned FASTA files.
         """
         taxa = None
         alignment_files = []
+        self.summaries = None
+        self.num_cores = num_cores
+        self.add_fraction = add_fraction
+        self.previous = {}
+        self.previous_ids = {}
+        self.previous_dir = None
+        self.unchanged = set(unchanged_files or [])
+        self.added = 0
+        self.reused = 0
+        self.reports = []
+        self.timeout = timeout
+        self.max_gap_fraction = None
+        self.memory_limit = None
+        if memory_budget is not None:
+            self.memory_limit = int(memory_budget * 1024 * 1024)
+        if aligned == "unaligned" and (add_fraction > 0 or len(self.unchanged) > 0) and os.path.isdir("alignments"):
+            self.load_previous_alignments()
         if not os.path.exists("alignments"):
             os.makedirs("alignments")
         color = Color()
         if aligned == "unaligned":
             self.user_provided = False
             self.sumac_aligned = False
+            self.cache = None
+            if oriented:
+                self.mafft_options = []
+            else:
+                self.mafft_options = ["--adjustdirection"]
+            if policy is None:
+                policy = MafftStrategyPolicy()
+            self.policy = policy
+            if cache_dir is not None and cache_size > 0:
+                mafft_version = self.get_mafft_version()
+                if mafft_version is not None:
+                    self.cache = AlignmentCache(cache_dir, cache_size, mafft_version)
             print(color.blue + "Spawning " + color.red + str(num_cores) + color.blue + " processes to align clusters." + color.done)
-            pool = multiprocessing.Pool(num_cores)
-            alignment_files = pool.map(self.align_cluster, cluster_files)
-            pool.close()
-            pool.join()
+            sizes = [self.get_cluster_size(cluster_file) for cluster_file in cluster_files]
+            costs = [num_seqs * length for num_seqs, length in sizes]
+            memory = [self.estimate_memory(num_seqs, length) for num_seqs, length in sizes]
+            self.strategies = {}
+            max_threads = []
+            for cluster_file, (num_seqs, length) in zip(cluster_files, sizes):
+                name, options, threads = policy.select(num_seqs, length)
+                self.strategies[cluster_file] = (name, options + self.mafft_options)
+                max_threads.append(threads)
+            budget = self.memory_limit
+            if budget is None:
+                budget = self.get_physical_memory()
+                if budget is not None:
+                    budget = int(0.8 * budget)
+            scheduler = AlignmentScheduler(cluster_files, costs, num_cores, memory, budget, max_threads)
+            alignment_files = scheduler.run(self.align_cluster)
             self.files = alignment_files
+            self.print_reports()
+            if self.cache is not None:
+                print(color.purple + "Alignments reused from the cache: " + color.red + str(self.cache.hits) + color.done)
+            if len(self.unchanged) > 0:
+                print(color.purple + "Alignments of unchanged clusters reused: " + color.red + str(self.reused) + color.done)
+            if add_fraction > 0:
+                print(color.purple + "Alignments updated with new sequences: " + color.red + str(self.added) + color.done)
+            if self.previous_dir is not None:
+                shutil.rmtree(self.previous_dir)
+                self.previous_dir = None
             if (not os.path.isfile(alignment_files[0])) or os.path.getsize(alignment_files[0]) == 0:
                 print(color.red + "Error: MAFFT is not installed correctly." + color.done)
                 sys.exit()
@@ -69,29 +160,426 @@ class Alignments(object):
 
 
 
-    def align_cluster(self, cluster_file):
+    @staticmethod
+    def get_cluster_size(cluster_file):
+        """
+        Inputs a FASTA file containing an unaligned sequence cluster.
+        Returns the number of sequences and the length of the longest sequence.
+        The cost of aligning the cluster is estimated as their product.
+        """
+        num_seqs = 0
+        max_length = 0
+        length = 0
+        with open(cluster_file, "r") as f:
+            for l in f:
+                if l.startswith(">"):
+                    max_length = max(max_length, length)
+                    length = 0
+                    num_seqs += 1
+                else:
+                    length += len(l.strip())
+        max_length = max(max_length, length)
+        return num_seqs, max_length
+
+
+
+    @staticmethod
+    def estimate_memory(num_seqs, length):
+        """
+        Returns a rough estimate in bytes of the peak memory MAFFT --auto needs for a cluster
+        of num_seqs sequences of the given length: the distance matrix and the sequences,
+        plus the pairwise dynamic programming matrices of L-INS-i, used for up to 200 sequences.
+        """
+        memory = 64 * 1024 * 1024 + 8 * num_seqs * num_seqs + 64 * num_seqs * length
+        if num_seqs <= 200:
+            memory += 16 * length * length
+        return memory
+
+
+
+    @staticmethod
+    def get_physical_memory():
+        """
+        Returns the physical memory of this machine in bytes, or None if it is not known.
+        """
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError, AttributeError):
+            return None
+
+
+
+    @staticmethod
+    def get_mafft_version():
+        """
+        Returns the version string printed by MAFFT, or None if MAFFT cannot be run.
+        """
+        try:
+            process = subprocess.Popen(["mafft", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+        except OSError:
+            return None
+        version = (stdout + stderr).strip()
+        if len(version) == 0:
+            return None
+        return version
+
+
+
+    @staticmethod
+    def is_cluster_alignment(file_name):
+        """
+        Returns True if file_name is the alignment of a numbered cluster, such as 12.fasta,
+        and not a supermatrix or another file in alignments/.
+        """
+        name, extension = os.path.splitext(file_name)
+        return extension == ".fasta" and name.isdigit()
+
+
+
+    def load_previous_alignments(self):
+        """
+        Copies the cluster alignments of the previous run to a scratch directory and indexes them
+        by sequence id, so they are not overwritten while aligning. alignments/ is left as it is.
+        """
+        file_names = [file_name for file_name in os.listdir("alignments") if self.is_cluster_alignment(file_name) \
+                      and os.path.isfile(os.path.join("alignments", file_name))]
+        if len(file_names) == 0:
+            return
+        self.previous_dir = tempfile.mkdtemp(prefix="_sumac_previous_", dir=".")
+        for file_name in file_names:
+            alignment_file = os.path.join(self.previous_dir, file_name)
+            shutil.copyfile(os.path.join("alignments", file_name), alignment_file)
+            ids = set(self.get_ids(alignment_file))
+            self.previous_ids[alignment_file] = ids
+            for seq_id in ids:
+                self.previous[seq_id] = alignment_file
+
+
+
+    @staticmethod
+    def get_ids(fasta_file):
+        """
+        Returns the list of sequence ids in a FASTA file,
+        without the _R_ prefix that MAFFT gives to reversed sequences.
+        """
+        ids = []
+        with open(fasta_file, "r") as f:
+            for l in f:
+                if l.startswith(">"):
+                    seq_id = l[1:].split()[0]
+                    if seq_id.startswith("_R_"):
+                        seq_id = seq_id[3:]
+                    ids.append(seq_id)
+        return ids
+
+
+
+    def reuse_previous(self, cluster_file, alignment_file):
+        """
+        Inputs a FASTA file containing an unaligned sequence cluster that is unchanged since the previous run.
+        Copies the previous alignment of exactly the same sequences to alignment_file.
+        Returns True if alignment_file was written, False if the cluster must be aligned.
+        """
+        ids = self.get_ids(cluster_file)
+        if len(ids) == 0 or ids[0] not in self.previous:
+            return False
+        previous_file = self.previous[ids[0]]
+        if self.previous_ids[previous_file] != set(ids):
+            return False
+        shutil.copyfile(previous_file, alignment_file)
+        with self.lock:
+            self.reused += 1
+        return True
+
+
+
+    def add_to_previous(self, cluster_file, alignment_file, threads=1):
         """
-        Worker fuction for align_clusters
         Inputs a FASTA file containing an unaligned sequence cluster.
+        If the previous run aligned a subset of the cluster, and the fraction of new sequences is at
+        most add_fraction, adds the new sequences to the previous alignment with MAFFT --add, or
+        --addfragments if the new sequences are short.
+        Returns True if alignment_file was written, False if the cluster must be fully aligned.
+        """
+        ids = self.get_ids(cluster_file)
+        counts = {}
+        for seq_id in ids:
+            if seq_id in self.previous:
+                counts[self.previous[seq_id]] = counts.get(self.previous[seq_id], 0) + 1
+        if len(counts) == 0:
+            return False
+        previous_file = max(counts, key=lambda f: (counts[f], f))
+        previous_ids = self.previous_ids[previous_file]
+        # sequences removed since the previous run require a full alignment
+        if not previous_ids.issubset(ids):
+            return False
+        new_ids = set(ids) - previous_ids
+        if len(new_ids) > self.add_fraction * len(ids):
+            return False
+        if len(new_ids) == 0:
+            shutil.copyfile(previous_file, alignment_file)
+            return True
+        new_records = [record for record in SeqIO.parse(cluster_file, "fasta") if record.id in new_ids]
+        new_file = alignment_file + ".new"
+        SeqIO.write(new_records, new_file, "fasta")
+        # sequences shorter than half the previous alignment are added as fragments
+        aligned_length = 0
+        for record in SeqIO.parse(previous_file, "fasta"):
+            aligned_length = len(record.seq)
+            break
+        if max(len(record.seq) for record in new_records) < aligned_length / 2:
+            add_option = "--addfragments"
+        else:
+            add_option = "--add"
+        strategy, options = self.get_strategy(cluster_file)
+        mafft = ["mafft"] + options + ["--thread", str(threads), add_option, new_file, previous_file]
+        try:
+            returncode = self.run_mafft(cluster_file, mafft, alignment_file, strategy + " " + add_option)
+        finally:
+            os.remove(new_file)
+        if returncode != 0 or os.path.getsize(alignment_file) == 0:
+            return False
+        with self.lock:
+            self.added += 1
+        return True
+
+
+
+    def align_cluster(self, cluster_file, threads=1):
+        """
+        Worker fuction for align_clusters
+        Inputs a FASTA file containing an unaligned sequence cluster,
+        and the number of threads MAFFT may use.
         Uses MAFFT to align the cluster.
         """
-        mafft_cline = MafftCommandline(input=cluster_file)
-        mafft_cline.set_parameter("--auto", True)
-        mafft_cline.set_parameter("--adjustdirection", True)
-        color = Color()
-        print(color.red + str(mafft_cline) + color.done)
-        sys.stdout.flush()
         if cluster_file.find("/") != -1:
             alignment_file = "alignments" + cluster_file[cluster_file.index("/"):]
         else:
             alignment_file = "alignments/" + cluster_file
+        if cluster_file in self.unchanged and self.reuse_previous(cluster_file, alignment_file):
+            return alignment_file
+        strategy, options = self.get_strategy(cluster_file)
+        if self.cache is not None:
+            key = self.cache.get_key(cluster_file, options)
+            if self.cache.get(key, alignment_file):
+                return alignment_file
+        if len(self.previous) > 0 and self.add_to_previous(cluster_file, alignment_file, threads):
+            return alignment_file
+        mafft = ["mafft"] + options + ["--thread", str(threads), cluster_file]
+        returncode = self.run_mafft(cluster_file, mafft, alignment_file, strategy)
+        if returncode == 0 and self.cache is not None and os.path.getsize(alignment_file) > 0:
+            self.cache.put(key, alignment_file)
+        return alignment_file
+
+
+
+    @staticmethod
+    def get_job_command(command, memory_limit=None):
+        """
+        Returns command wrapped in a new Python process that moves to its own process group, so a
+        timeout kills all of the processes of the job, limits its address space to memory_limit bytes
+        if given, and then runs command in its place. Exits with status 127 if command cannot be run.
+        """
+        launcher = "\n".join(["import os, resource, sys",
+                              "os.setsid()",
+                              "if sys.argv[1] != '-':",
+                              "    resource.setrlimit(resource.RLIMIT_AS, (int(sys.argv[1]), int(sys.argv[1])))",
+                              "try:",
+                              "    os.execvp(sys.argv[2], sys.argv[2:])",
+                              "except OSError as e:",
+                              "    sys.stderr.write(sys.argv[2] + ': ' + str(e) + '\\n')",
+                              "    os._exit(127)"])
+        if memory_limit is None:
+            limit = "-"
+        else:
+            limit = str(int(memory_limit))
+        return [sys.executable, "-c", launcher, limit] + list(command)
+
+
+
+    def get_strategy(self, cluster_file):
+        """
+        Returns the name of the MAFFT strategy selected for cluster_file and its MAFFT options.
+        """
+        if cluster_file in self.strategies:
+            return self.strategies[cluster_file]
+        return "auto", ["--auto"] + self.mafft_options
+
+
+
+    def run_mafft(self, cluster_file, mafft, alignment_file, strategy="auto"):
+        """
+        Runs the MAFFT command line mafft for cluster_file, using the named strategy.
+        MAFFT writes the alignment straight to alignment_file, so the alignment is never held in memory.
+        Its messages are copied as they arrive to a log file in alignment_logs/ and to stderr.
+        The job is killed after timeout seconds, and its memory is limited to memory_limit.
+        Both are set up by the wrapper of get_job_command rather than preexec_fn, which can
+        deadlock when the other alignment threads are running.
+        Records the exit status and runtime of the job in reports, and returns the exit status.
+        """
+        color = Color()
+        print(color.red + " ".join(mafft) + color.done)
+        sys.stdout.flush()
+        if not os.path.exists("alignment_logs"):
+            try:
+                os.makedirs("alignment_logs")
+            except OSError:
+                pass
+        log_file = os.path.join("alignment_logs", os.path.basename(alignment_file) + ".log")
+        def tee(pipe, log):
+            # copy the messages of MAFFT to the log and stderr until MAFFT closes the pipe
+            for data in iter(lambda: os.read(pipe.fileno(), 4096), b""):
+                log.write(data)
+                sys.stderr.write(data)
+            pipe.close()
+        start = time.time()
         try:
-            stdout, stderr = mafft_cline()
-            with open(alignment_file, "w") as handle:
-                handle.write(stdout)
-        except:
+            with open(alignment_file, "w") as handle, open(log_file, "w") as log:
+                process = subprocess.Popen(self.get_job_command(mafft, self.memory_limit), stdout=handle, stderr=subprocess.PIPE)
+                reader = threading.Thread(target=tee, args=(process.stderr, log))
+                reader.start()
+                if self.timeout is None:
+                    returncode = process.wait()
+                else:
+                    while process.poll() is None and time.time() - start < self.timeout:
+                        time.sleep(0.1)
+                    if process.poll() is None:
+                        try:
+                            os.killpg(process.pid, signal.SIGKILL)
+                        except OSError:
+                            # the wrapper has not started its process group yet
+                            process.kill()
+                        process.wait()
+                        print(color.red + "Error: MAFFT timed out after " + str(self.timeout) + " seconds for " + cluster_file + color.done)
+                    returncode = process.returncode
+                reader.join()
+            if returncode == 127:
+                print(color.red + "Error: alignment file not generated. Please check your MAFFT installation." + color.done)
+        except OSError as e:
             print(color.red + "Error: alignment file not generated. Please check your MAFFT installation." + color.done)
-        return alignment_file
+            print(color.red + "OS error: " + str(e) + color.done)
+            returncode = -1
+        runtime = time.time() - start
+        with self.lock:
+            self.reports.append((cluster_file, returncode, runtime, strategy))
+        return returncode
+
+
+
+    def print_reports(self):
+        """
+        Prints the number of MAFFT jobs, their total runtime, the number of jobs and runtime of each
+        strategy, the slowest job, and any failed jobs.
+        """
+        if len(self.reports) == 0:
+            return
+        color = Color()
+        slowest = max(self.reports, key=lambda report: report[2])
+        print(color.purple + "MAFFT jobs: " + color.red + str(len(self.reports)) + color.purple + ", total runtime (s): " \
+              + color.red + str(round(sum(report[2] for report in self.reports), 1)) + color.done)
+        strategies = {}
+        for report in self.reports:
+            num_jobs, runtime = strategies.get(report[3], (0, 0.0))
+            strategies[report[3]] = (num_jobs + 1, runtime + report[2])
+        for strategy in sorted(strategies):
+            num_jobs, runtime = strategies[strategy]
+            print(color.purple + "MAFFT strategy " + color.red + strategy + color.purple + ": " + color.red + str(num_jobs) \
+                  + color.purple + " jobs, runtime (s): " + color.red + str(round(runtime, 1)) + color.done)
+        print(color.purple + "Slowest MAFFT job: " + color.red + slowest[0] + color.purple + " (" + color.red \
+              + str(round(slowest[2], 1)) + color.purple + " s)" + color.done)
+        for cluster_file, returncode, runtime, strategy in self.reports:
+            if returncode != 0:
+                print(color.red + "Error: MAFFT exited with status " + str(returncode) + " for " + cluster_file \
+                      + ". See alignment_logs/ for details." + color.done)
+
+
+
+    def get_summaries(self):
+        """
+        Returns the AlignmentSummary of each alignment file, in the order of files.
+        The alignment files are read once, in parallel, and the summaries are reused by
+        print_data, make_gene_region_csv, get_all_taxa, and Supermatrix.concatenate.
+        """
+        if self.summaries is None:
+            jobs = [(alignment, self.user_provided, self.keep_sequences) for alignment in self.files]
+            if self.num_cores > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(self.num_cores)
+                self.summaries = pool.map(_summarize_alignment, jobs)
+                pool.close()
+                pool.join()
+            else:
+                self.summaries = [_summarize_alignment(job) for job in jobs]
+        return self.summaries
+
+
+
+    def trim_gap_columns(self, max_gap_fraction):
+        """
+        Removes the alignment columns in which more than max_gap_fraction of the sequences have a gap
+        ('-' or '?'), before the alignments are concatenated.
+        Each alignment is loaded from its summary as a NumPy matrix of bytes, one row per sequence.
+        The retained columns of each locus are saved in its summary and written to trimmed_columns.csv.
+        """
+        import numpy as np
+        color = Color()
+        if not self.keep_sequences:
+            print(color.red + "Gap columns cannot be trimmed without loading the alignments." + color.done)
+            return
+        self.max_gap_fraction = max_gap_fraction
+        total_before = 0
+        total_after = 0
+        with open('trimmed_columns.csv', 'wb') as csv_output:
+            csvwriter = csv.writer(csv_output)
+            csvwriter.writerow(["Gene Region #", "Aligned Length", "Trimmed Length", "Retained Columns"])
+            for i, summary in enumerate(self.get_summaries()):
+                total_before += summary.length
+                if len(summary.sequences) == 0 or any(len(sequence) != summary.length for sequence in summary.sequences):
+                    print(color.red + "Skipping trimming " + summary.file + " since its sequences are not aligned." + color.done)
+                    total_after += summary.length
+                    continue
+                data = "".join(summary.sequences)
+                if not isinstance(data, bytes):
+                    data = data.encode("ascii")
+                matrix = np.frombuffer(data, dtype=np.uint8).reshape(len(summary.sequences), summary.length)
+                gaps = (matrix == ord("-")) | (matrix == ord("?"))
+                retained = np.flatnonzero(gaps.mean(axis=0) <= max_gap_fraction)
+                trimmed = matrix[:, retained]
+                ungapped_lengths = (trimmed != ord("-")).sum(axis=1)
+                text = np.ascontiguousarray(trimmed).tobytes()
+                if not isinstance(text, str):
+                    text = text.decode("ascii")
+                trimmed_length = len(retained)
+                summary.sequences = [text[j * trimmed_length:(j + 1) * trimmed_length] for j in range(trimmed.shape[0])]
+                summary.ungapped_lengths = [int(length) for length in ungapped_lengths]
+                summary.retained_columns = [int(column) for column in retained]
+                summary.length = trimmed_length
+                total_after += summary.length
+                csvwriter.writerow([str(i + 1), str(matrix.shape[1]), str(summary.length), self.format_columns(summary.retained_columns)])
+        print(color.purple + "Trimmed gap columns, aligned length: " + color.red + str(total_before) + color.purple + " -> " \
+              + color.red + str(total_after) + color.done)
+
+
+
+    @staticmethod
+    def format_columns(columns):
+        """
+        Inputs a sorted list of column indices (from 0).
+        Returns the columns as ranges counted from 1, for example "1-120;135-400".
+        """
+        ranges = []
+        start = None
+        for column in columns:
+            if start is None:
+                start = end = column
+            elif column == end + 1:
+                end = column
+            else:
+                ranges.append((start, end))
+                start = end = column
+        if start is not None:
+            ranges.append((start, end))
+        return ";".join(str(start + 1) if start == end else str(start + 1) + "-" + str(end + 1) for start, end in ranges)
 
 
 
@@ -106,19 +594,18 @@ class Alignments(object):
         # print data for each region
         i = 1
         color = Color()
-        for alignment in self.files:
-            records = list(SeqIO.parse(alignment, "fasta"))
+        for summary in self.get_summaries():
             if self.user_provided:
-                region_name = alignment
+                region_name = summary.file
             else:
-                descriptors = records[0].description.split(" ")
+                descriptors = summary.description.split(" ")
                 region_name = " ".join(descriptors[5:])
             print(color.blue + "Aligned cluster #: " + color.red + str(i) + color.done)
             print(color.yellow + "DNA region: " + color.red + region_name + color.done)
-            print(color.yellow + "OTUs: " + color.red + str(len(records)) + color.done)
-            print(color.yellow + "Aligned length: " + color.red + str(len(records[0].seq)) + color.done)
-            print(color.yellow + "Missing data (%): " + color.red + str(round(100 - (100 * len(records)/float(len(taxa))), 1)) + color.done)
-            print(color.yellow + "Taxon coverage density: "  + color.red + str(round(len(records)/float(len(taxa)), 2)) + color.done)
+            print(color.yellow + "OTUs: " + color.red + str(summary.num_rows) + color.done)
+            print(color.yellow + "Aligned length: " + color.red + str(summary.length) + color.done)
+            print(color.yellow + "Missing data (%): " + color.red + str(round(100 - (100 * summary.num_rows/float(len(taxa))), 1)) + color.done)
+            print(color.yellow + "Taxon coverage density: "  + color.red + str(round(summary.num_rows/float(len(taxa)), 2)) + color.done)
             i += 1
 
 
@@ -133,20 +620,19 @@ class Alignments(object):
             header = ["Gene Region #", "Description", "# of OTUs", "Aligned Length", "Missing Data (%)", "Taxon Coverage Density"]
             csvwriter.writerow(header)
             i = 1
-            for alignment in self.files:
+            for summary in self.get_summaries():
                 row = []
-                records = list(SeqIO.parse(alignment, "fasta"))
                 if self.user_provided:
-                    region_name = alignment
+                    region_name = summary.file
                 else:
-                    descriptors = records[0].description.split(" ")
+                    descriptors = summary.description.split(" ")
                     region_name = " ".join(descriptors[3:])
                 row.append(str(i))
                 row.append(region_name)
-                row.append(str(len(records)))
-                row.append(str(len(records[0].seq)))
-                row.append(str(round(100 - (100 * len(records)/float(len(taxa))), 1)))
-                row.append(str(round(len(records)/float(len(taxa)), 2)))
+                row.append(str(summary.num_rows))
+                row.append(str(summary.length))
+                row.append(str(round(100 - (100 * summary.num_rows/float(len(taxa))), 1)))
+                row.append(str(round(summary.num_rows/float(len(taxa)), 2)))
                 csvwriter.writerow(row)
                 i += 1
 
@@ -161,21 +647,330 @@ class Alignments(object):
             return self.taxa
         else:
             taxa = []
-            for alignment in self.files:
-                records = SeqIO.parse(alignment, "fasta")
-                for record in records:
-                    if self.user_provided:
-                        taxon = record.description
-                    else:
-                        descriptors = record.description.split(" ")
-                        taxon = descriptors[1] + " " + descriptors[2]
-                    if taxon not in taxa:
+            found = set()
+            for summary in self.get_summaries():
+                for taxon in summary.otus:
+                    if taxon not in found:
                         taxa.append(taxon)
+                        found.add(taxon)
             self.taxa = taxa
             return self.taxa
 
 
 
+class AlignmentSummary(object):
+    """
+    The data of one alignment file needed for reporting and concatenation.
+    Only the first sequence of each OTU is kept, as in the supermatrix.
+    """
+
+
+    file = ""
+    description = ""        # description of the first sequence
+    num_rows = 0            # number of sequences in the file
+    length = 0              # aligned length
+    otus = []               # OTU names, in the order of the file
+    accessions = []         # accession of the sequence of each OTU
+    sequences = []          # aligned sequence of each OTU
+    ungapped_lengths = []   # length of the sequence of each OTU minus any gaps ('-')
+    retained_columns = None # columns of the file kept by Alignments.trim_gap_columns, or None if not trimmed
+
+    def __init__(self, alignment, user_provided=False, keep_sequences=True):
+        """
+        Input: an aligned FASTA file, and whether it was provided by the user, in which case each
+        OTU is the full description of its sequence and the accession is the file name.
+        If keep_sequences is False only the lengths of the sequences are kept.
+        """
+        self.file = alignment
+        self.description = ""
+        self.num_rows = 0
+        self.length = 0
+        self.otus = []
+        self.accessions = []
+        self.sequences = []
+        self.ungapped_lengths = []
+        self.retained_columns = None
+        found = set()
+        with open(alignment, "r") as handle:
+            for title, sequence in SimpleFastaParser(handle):
+                if self.num_rows == 0:
+                    self.description = title
+                    self.length = len(sequence)
+                self.num_rows += 1
+                if user_provided:
+                    otu = title
+                    accession = alignment
+                else:
+                    # sample description:
+                    # AF495760.1 Lythrum salicaria chloroplast ribulose 1,5-bisphosphate carboxylase/oxygenase large subunit-like mRNA, partial sequence
+                    descriptors = title.split(" ")
+                    otu = descriptors[1] + " " + descriptors[2]
+                    accession = descriptors[0]
+                if otu not in found:
+                    found.add(otu)
+                    self.otus.append(otu)
+                    self.accessions.append(accession)
+                    if keep_sequences:
+                        self.sequences.append(sequence)
+                    self.ungapped_lengths.append(len(sequence) - sequence.count("-"))
+
+
+
+def _summarize_alignment(job):
+    """
+    Worker function for Alignments.get_summaries.
+    """
+    alignment, user_provided, keep_sequences = job
+    return AlignmentSummary(alignment, user_provided, keep_sequences)
+
+
+
+class AlignmentScheduler(object):
+    """
+    Runs alignment jobs concurrently, largest job first, using at most num_cores threads in total.
+    A job that dominates the remaining work gets a matching share of the cores,
+    and as the queue drains the remaining jobs get the idle cores as extra threads.
+    With a memory budget, a job is only started while the estimated memory of the running jobs
+    stays within the budget; smaller jobs that fit are started first to keep the cores busy.
+    """
+
+
+    jobs = []
+    costs = []
+    num_cores = 1
+    memory = None           # estimated peak memory of each job in bytes
+    memory_budget = None    # in bytes, or None for no limit
+    max_threads = None      # maximum number of threads of each job, None for no limit
+
+    def __init__(self, jobs, costs, num_cores, memory=None, memory_budget=None, max_threads=None):
+        """
+        Input: a list of jobs, the estimated cost of each job, the number of cores,
+        and optionally the estimated peak memory of each job and the memory budget, in bytes,
+        and the maximum number of threads of each job.
+        """
+        self.jobs = jobs
+        self.costs = costs
+        self.num_cores = max(1, num_cores)
+        self.memory = memory
+        self.memory_budget = memory_budget
+        if self.memory is None:
+            self.memory = [0] * len(jobs)
+        self.max_threads = max_threads
+        if self.max_threads is None:
+            self.max_threads = [None] * len(jobs)
+
+
+
+    def next_job(self, pending, state):
+        """
+        Returns the first job in pending that can start now, or None.
+        A job can start if a core is free and its memory fits within the budget.
+        If no job is running the first job always starts, even if it is over budget.
+        """
+        if state["free"] == 0:
+            return None
+        for i in pending:
+            if self.memory_budget is None or state["running"] == 0 \
+               or state["memory"] + self.memory[i] <= self.memory_budget:
+                return i
+        return None
+
+
+
+    def run(self, worker):
+        """
+        Input: a worker function taking a job and a number of threads.
+        Output: the list of worker results, in the order of the jobs.
+        Each worker call runs in its own thread, so the worker should
+        spend its time in a subprocess such as MAFFT.
+        """
+        results = [None] * len(self.jobs)
+        # largest jobs first
+        pending = sorted(range(len(self.jobs)), key=lambda i: self.costs[i], reverse=True)
+        condition = threading.Condition()
+        state = {"free": self.num_cores, "memory": 0, "running": 0}
+        remaining_cost = sum(self.costs)
+
+        def run_job(i, threads):
+            try:
+                results[i] = worker(self.jobs[i], threads)
+            finally:
+                with condition:
+                    state["free"] += threads
+                    state["memory"] -= self.memory[i]
+                    state["running"] -= 1
+                    condition.notify()
+
+        threads_started = []
+        with condition:
+            while len(pending) > 0:
+                i = self.next_job(pending, state)
+                while i is None:
+                    condition.wait()
+                    i = self.next_job(pending, state)
+                pending.remove(i)
+                # a job gets its share of the cores by cost, and the free cores are
+                # shared among the jobs still waiting as the queue drains
+                share = self.num_cores * self.costs[i] // max(1, remaining_cost)
+                remaining_cost -= self.costs[i]
+                threads = max(1, min(state["free"], max(share, state["free"] // (len(pending) + 1))))
+                if self.max_threads[i] is not None:
+                    threads = max(1, min(threads, self.max_threads[i]))
+                state["free"] -= threads
+                state["memory"] += self.memory[i]
+                state["running"] += 1
+                thread = threading.Thread(target=run_job, args=(i, threads))
+                thread.start()
+                threads_started.append(thread)
+        for thread in threads_started:
+            thread.join()
+        return results
+
+
+
+class MafftStrategyPolicy(object):
+    """
+    Selects the MAFFT strategy and the maximum number of threads for a cluster from its number of
+    sequences and the length of its longest sequence.
+    The policy is a list of bands (max sequences, max length, name, MAFFT options, max threads),
+    where None means no limit; a cluster gets the first band it fits in.
+    """
+
+
+    # MAFFT --auto for every cluster
+    AUTO = [(None, None, "auto", ["--auto"], None)]
+
+    # accurate L-INS-i for small clusters of short sequences, FFT-NS-2 for mid-sized clusters,
+    # FFT-NS-1 for large clusters, and PartTree for very large clusters
+    SIZE = [(60, 5000, "L-INS-i", ["--localpair", "--maxiterate", "1000"], 1),
+            (2000, None, "FFT-NS-2", ["--retree", "2", "--maxiterate", "0"], 4),
+            (20000, None, "FFT-NS-1", ["--retree", "1", "--maxiterate", "0"], None),
+            (None, None, "PartTree", ["--parttree", "--retree", "1"], None)]
+
+    bands = AUTO
+
+    def __init__(self, bands=None):
+        """
+        Input: the list of bands, defaults to MAFFT --auto for every cluster.
+        """
+        if bands is None:
+            bands = MafftStrategyPolicy.AUTO
+        self.bands = bands
+
+
+
+    def select(self, num_seqs, length):
+        """
+        Returns the name, MAFFT options, and maximum number of threads for a cluster.
+        """
+        for max_seqs, max_length, name, options, max_threads in self.bands:
+            if (max_seqs is None or num_seqs <= max_seqs) and (max_length is None or length <= max_length):
+                return name, list(options), max_threads
+        return "auto", ["--auto"], None
+
+
+
+class AlignmentCache(object):
+    """
+    Content-addressed cache of MAFFT alignments shared across runs.
+    Each alignment is stored under the hash of its input FASTA file, the MAFFT version and options.
+    When the cache grows beyond its size limit the least recently used alignments are removed.
+    """
+
+
+    cache_dir = "alignment_cache"
+    max_size = 0            # in bytes
+    mafft_version = ""
+    hits = 0
+    lock = None
+
+    def __init__(self, cache_dir, max_size, mafft_version):
+        """
+        Input: the cache directory, the maximum cache size in megabytes, and the MAFFT version.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024 * 1024)
+        self.mafft_version = mafft_version
+        self.hits = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+
+
+    def get_key(self, cluster_file, options):
+        """
+        Returns the hash of a FASTA file together with the MAFFT version and options.
+        """
+        digest = hashlib.sha1()
+        digest.update((self.mafft_version + "\n" + " ".join(options) + "\n").encode("utf-8"))
+        with open(cluster_file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+
+    def get(self, key, alignment_file):
+        """
+        Copies the cached alignment to alignment_file.
+        Returns True on a cache hit, False otherwise.
+        """
+        cache_file = os.path.join(self.cache_dir, key + ".fasta")
+        try:
+            shutil.copyfile(cache_file, alignment_file)
+        except (IOError, OSError):
+            return False
+        # the modification time marks the most recent use
+        os.utime(cache_file, None)
+        with self.lock:
+            self.hits += 1
+        return True
+
+
+
+    def put(self, key, alignment_file):
+        """
+        Stores a copy of alignment_file in the cache, then evicts the least recently used alignments
+        until the cache is within its size limit.
+        """
+        cache_file = os.path.join(self.cache_dir, key + ".fasta")
+        temp_file = cache_file + "." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+        shutil.copyfile(alignment_file, temp_file)
+        os.rename(temp_file, cache_file)
+        with self.lock:
+            self.evict()
+
+
+
+    def evict(self):
+        """
+        Removes the least recently used alignments until the cache is within its size limit.
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".fasta"):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+
 # pickle method recipe by Steven Bethard
 # see http://stackoverflow.com/questions/1816958/cant-pickle-type-instancemethod-when-using-pythons-multiprocessing-pool-ma/
 def _pickle_method(method):
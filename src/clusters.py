@@ -7,6 +7,8 @@ License: GNU GPLv3 http://www.gnu.org/licenses/gpl.html
 
 
 import os
+import csv
+import pickle
 from os import listdir
 from os.path import isfile, join
 import subprocess
@@ -15,8 +17,10 @@ import sys
 import multiprocessing
 from Bio import Entrez
 from Bio import SeqIO
+from Bio.Seq import reverse_complement
+from Bio.SeqRecord import SeqRecord
 from Bio.Blast.Applications import NcbiblastnCommandline
-from Bio.Blast import NCBIXML
+from Bio.Blast.Applications import NcbimakeblastdbCommandline
 from util import Color
 
 
@@ -28,109 +32,285 @@ class ClusterBuilder(object):
     clusters = []
     seq_keys = []
     cluster_files = []
+    unchanged = set()       # indices of clusters that are unchanged since a previous run
+    unchanged_files = []    # FASTA files of the unchanged clusters
+    strands = {}            # orientation ('+' or '-') of each sequence relative to its cluster, if known
+    cluster_strands = []    # orientation of the sequences of each cluster, if it differs between clusters
+    oriented = False        # True if the cluster FASTA files are written with all sequences in the same orientation
 
 
     def __init__(self, seq_keys):
         self.seq_keys = seq_keys
+        self.unchanged = set()
+        self.unchanged_files = []
+        self.strands = {}
+        self.cluster_strands = []
+        self.oriented = False
 
 
     def write_fasta(self):
         return True
 
 
-    def assemble_fasta(self, gb, min_clusters=4):
+    def get_cluster_keys(self):
+        """
+        Returns a list of clusters, each cluster a list of keys to sequences.
+        """
+        return self.clusters
+
+
+    def expand_duplicates(self, gb, duplicates):
+        """
+        Inputs the dictionary of all GenBank sequences, and a dictionary that maps the key of each
+        clustered sequence to the keys of identical sequences that were not clustered.
+        Adds the identical sequences to the cluster of each clustered sequence, in the same orientation.
+        Clusters that gain sequences are no longer unchanged.
+        """
+        for seq_key in list(self.strands.keys()):
+            for duplicate in duplicates.get(seq_key, []):
+                self.strands[duplicate] = self.strands[seq_key]
+        for strands in self.cluster_strands:
+            for seq_key in list(strands.keys()):
+                for duplicate in duplicates.get(seq_key, []):
+                    strands[duplicate] = strands[seq_key]
+        seq_keys = list(self.seq_keys)
+        for i, cluster in enumerate(self.clusters):
+            in_cluster = set(cluster)
+            for seq_key in list(cluster):
+                for duplicate in duplicates.get(seq_key, []):
+                    if duplicate not in in_cluster:
+                        cluster.append(duplicate)
+                        in_cluster.add(duplicate)
+                        self.unchanged.discard(i)
+        for seq_key in self.seq_keys:
+            seq_keys.extend(duplicates.get(seq_key, []))
+        self.seq_keys = seq_keys
+
+
+    def get_cluster_strands(self, cluster_index):
+        """
+        Returns a dictionary of the orientation of each sequence of a cluster, relative to that cluster.
+        By default each sequence has the same orientation in every cluster.
+        """
+        if len(self.cluster_strands) > 0:
+            return self.cluster_strands[cluster_index]
+        return self.strands
+
+
+    def get_representatives(self, gb):
+        """
+        Returns a list of the (key, sequence) of the representative sequence of each cluster,
+        by default the longest sequence in the cluster.
+        """
+        representatives = []
+        for cluster in self.get_cluster_keys():
+            longest = None
+            for seq_key in cluster:
+                sequence = str(gb[seq_key].seq).upper()
+                if longest is None or len(sequence) > len(longest[1]):
+                    longest = (seq_key, sequence)
+            representatives.append(longest)
+        return representatives
+
+
+    def write_cluster_state(self, gb, file_name="cluster_state"):
+        """
+        Saves the clusters and the representative sequence of each cluster to file,
+        so that a later run can place new sequences into these clusters.
+        Must be called before the clusters are filtered by assemble_fasta.
+        """
+        clusters = []
+        representatives = []
+        for cluster, representative in zip(self.get_cluster_keys(), self.get_representatives(gb)):
+            if representative is not None:
+                clusters.append(cluster)
+                representatives.append(representative)
+        data = {"seq_keys": self.seq_keys, "clusters": clusters, "representatives": representatives, "strands": self.strands}
+        out = open(file_name, "wb")
+        pickle.dump(data, out)
+        out.close()
+
+
+    @staticmethod
+    def read_cluster_state(file_name="cluster_state"):
+        """
+        Loads the clusters saved by write_cluster_state, or returns None if there are none.
+        """
+        if not os.path.exists(file_name):
+            return None
+        return pickle.load(open(file_name, "rb"))
+
+
+    def assemble_fasta(self, gb, min_clusters=4, num_cores=1):
         """
         Inputs the dictionary of all GenBank sequence.
         Only make fasta files of clusters containing min_clusters taxa or more,
         and delete those clusters with less than min_clusters.
+        Each sequence record and its OTU is looked up only once, and the FASTA files
+        are written by num_cores processes.
+        If the strand of every sequence in a cluster is known, its sequences on the minus strand are
+        written reverse complemented, so all sequences in the cluster have the same orientation.
         Generates a list of FASTA files, each file containing an unaligned sequence cluster.
         """
-        cluster_files = []
         if not os.path.exists("clusters"):
             os.makedirs("clusters")
-        i = 1
-        to_delete = []
-        for cluster in self.clusters:
-            # get all OTUs in cluster
-            otus = []
+        # OTU of each sequence, looked up once even if a sequence is in several clusters
+        otus = {}
+        kept_clusters = []
+        cluster_files = []
+        unchanged_files = []
+        kept_strands = []
+        oriented = True
+        global _cluster_fasta_jobs
+        _cluster_fasta_jobs = []
+        for cluster_index, cluster in enumerate(self.clusters):
+            strands = self.get_cluster_strands(cluster_index)
+            cluster_oriented = len(strands) > 0 and all(seq_key in strands for seq_key in cluster)
+            # keep the first sequence of each OTU, do not allow duplicate OTUs in cluster
+            sequences = []
+            otus_in_cluster = set()
             for seq_key in cluster:
-                descriptors = gb[seq_key].description.split(" ")
-                otu = descriptors[0] + " " + descriptors[1]
-                if otu not in otus:
-                    otus.append(otu)
+                record = None
+                if seq_key not in otus:
+                    record = gb[seq_key]
+                    descriptors = record.description.split(" ")
+                    otus[seq_key] = descriptors[0] + " " + descriptors[1]
+                otu = otus[seq_key]
+                if otu not in otus_in_cluster:
+                    if record is None:
+                        record = gb[seq_key]
+                    if cluster_oriented and strands[seq_key] == "-":
+                        record = SeqRecord(record.seq.reverse_complement(), id=record.id, description=record.description)
+                    sequences.append(record)
+                    otus_in_cluster.add(otu)
             # make fasta file if >= min_clusters OTUs in cluster
-            otus_in_cluster = []
-            if len(otus) >= min_clusters:
-                sequences = []
-                for seq_key in cluster:
-                    descriptors = gb[seq_key].description.split(" ")
-                    otu = descriptors[0] + " " + descriptors[1]
-                    # do not allow duplicate OTUs in cluster
-                    if otu not in otus_in_cluster:
-                        sequences.append(gb[seq_key])
-                        otus_in_cluster.append(otu)
-                file_name = "clusters/" + str(i) + ".fasta"
-                file = open(file_name, "wb")
-                SeqIO.write(sequences, file, 'fasta')
-                file.close()
+            if len(otus_in_cluster) >= min_clusters:
+                file_name = "clusters/" + str(len(cluster_files) + 1) + ".fasta"
+                _cluster_fasta_jobs.append((file_name, sequences))
+                kept_clusters.append(cluster)
                 cluster_files.append(file_name)
-                i += 1
-            else:
-                to_delete.append(cluster)
-        for cluster in to_delete:
-            del self.clusters[self.clusters.index(cluster)]
+                if len(self.cluster_strands) > 0:
+                    kept_strands.append(strands)
+                oriented = oriented and cluster_oriented
+                if cluster_index in self.unchanged:
+                    unchanged_files.append(file_name)
+        # the worker processes inherit the list of jobs
+        if num_cores > 1 and len(_cluster_fasta_jobs) > 1:
+            pool = multiprocessing.Pool(num_cores)
+            pool.map(_write_cluster_fasta, range(len(_cluster_fasta_jobs)))
+            pool.close()
+            pool.join()
+        else:
+            for job in range(len(_cluster_fasta_jobs)):
+                _write_cluster_fasta(job)
+        _cluster_fasta_jobs = None
+        self.clusters = kept_clusters
         self.cluster_files = cluster_files
+        self.unchanged_files = unchanged_files
+        self.cluster_strands = kept_strands
+        self.oriented = oriented and len(kept_clusters) > 0
 
 
     
-    def assemble_fasta_uclust(self, min_clusters=4):
+    def assemble_fasta_uclust(self, min_clusters=4, num_cores=1):
         """
         Only make fasta files of clusters containing min_clusters taxa or more,
         and delete those clusters with less than min_clusters.
         Generates a list of FASTA files, each file containing an unaligned sequence cluster.
+        Each UCLUST cluster file is read once as text, in parallel, and written without temporary files.
+        Sequences on the minus strand are written reverse complemented.
         """
         cluster_files = []
         if not os.path.exists("clusters"):
             os.makedirs("clusters")
-        i = 1
-        to_delete = []
-        for cluster in self.clusters:
-            # get all OTUs in cluster
-            otus = []
-            for record in SeqIO.parse(open("uclusters/" + cluster, "rU"), "fasta"):
-                descriptors = record.id.split("_")
-                otu = descriptors[1] + " " + descriptors[2]
-                if otu not in otus:
-                    otus.append(otu)
-            # make fasta file if >= min_clusters OTUs in cluster
-            otus_in_cluster = []
-            if len(otus) >= min_clusters:
-                sequences = []
-                for record in SeqIO.parse(open("uclusters/" + cluster, "rU"), "fasta"):
-                    descriptors = record.id.split("_")
-                    otu = descriptors[1] + " " + descriptors[2]
-                    # do not allow duplicate OTUs in cluster
-                    if otu not in otus_in_cluster:
-                        sequences.append(record)
-                        otus_in_cluster.append(otu)
-                file_name = "clusters/" + str(i) + ".fasta"
-                temp_file_name = "clusters/temp" + str(i) + ".fasta"
-                f = open(temp_file_name, "wb")
-                SeqIO.write(sequences, f, 'fasta')
-                f.close()
-                with open(temp_file_name, "r") as f, open(file_name, "w") as fout:
-                    for l in f:
-                        if ">" in l:
-                            l = l.replace("_", " ")    
-                        fout.write(l)
-                subprocess.check_call(["rm", temp_file_name])
-                cluster_files.append(file_name)
-                i += 1
-            else:
-                to_delete.append(cluster)
-        for cluster in to_delete:
-            del self.clusters[self.clusters.index(cluster)]
+        kept_clusters = []
+        # the worker processes inherit the accessions of the sequences on the minus strand
+        global _uclust_minus_strand
+        _uclust_minus_strand = set(seq_key for seq_key in self.strands if self.strands[seq_key] == "-")
+        jobs = [(cluster, min_clusters) for cluster in self.clusters]
+        if num_cores > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(num_cores)
+            results = pool.imap(_filter_uclust_cluster, jobs, 16)
+        else:
+            pool = None
+            results = (_filter_uclust_cluster(job) for job in jobs)
+        # results arrive in cluster order, so the files are numbered as before
+        for cluster, lines in zip(self.clusters, results):
+            if lines is None:
+                continue
+            file_name = "clusters/" + str(len(cluster_files) + 1) + ".fasta"
+            with open(file_name, "w") as fout:
+                fout.writelines(lines)
+            kept_clusters.append(cluster)
+            cluster_files.append(file_name)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _uclust_minus_strand = None
+        self.clusters = kept_clusters
         self.cluster_files = cluster_files
+        self.oriented = len(self.strands) > 0
+
+
+
+def _filter_uclust_cluster(job):
+    """
+    Worker function for assemble_fasta_uclust.
+    Input: the name of a UCLUST cluster file and the minimum number of OTUs.
+    Output: the lines of the cluster FASTA file, keeping the first sequence of each OTU,
+    or None if the cluster has less than min_clusters OTUs.
+    Sequences on the minus strand are reverse complemented.
+    """
+    cluster, min_clusters = job
+    lines = []
+    otus = set()
+    keep = False
+    minus = []
+    with open("uclusters/" + cluster, "r") as f:
+        for l in f:
+            if l.startswith(">"):
+                if len(minus) > 0:
+                    lines.append(reverse_complement("".join(minus)) + "\n")
+                    minus = []
+                descriptors = l[1:].strip().split("_")
+                otu = descriptors[1] + " " + descriptors[2]
+                # do not allow duplicate OTUs in cluster
+                keep = otu not in otus
+                reverse = keep and _uclust_minus_strand is not None and descriptors[0] in _uclust_minus_strand
+                if keep:
+                    otus.add(otu)
+                    lines.append(l.replace("_", " "))
+            elif keep and l.strip():
+                if reverse:
+                    minus.append(l.strip())
+                else:
+                    lines.append(l)
+    if len(minus) > 0:
+        lines.append(reverse_complement("".join(minus)) + "\n")
+    if len(otus) < min_clusters:
+        return None
+    return lines
+
+
+
+# accessions of the UCLUST sequences on the minus strand, inherited by the worker processes
+_uclust_minus_strand = None
+
+
+
+# cluster FASTA files to be written by assemble_fasta, inherited by the worker processes
+_cluster_fasta_jobs = None
+
+
+
+def _write_cluster_fasta(job):
+    """
+    Worker function for assemble_fasta. Writes the FASTA file of one cluster.
+    """
+    file_name, sequences = _cluster_fasta_jobs[job]
+    f = open(file_name, "wb")
+    SeqIO.write(sequences, f, 'fasta')
+    f.close()
 
 
 
@@ -143,13 +323,16 @@ class SLINKClusterBuilder(ClusterBuilder):
 
     distance_matrix = []
     threshold = (1.0/10**10)
+    Pi = []
+    Lambda = []
 
 
-    def __init__(self, seq_keys, distance_matrix, threshold=(1.0/10**10)):
+    def __init__(self, seq_keys, distance_matrix, threshold=(1.0/10**10), dendrogram=None):
         """
         Input: seq_keys a list of all sequences used in the analysis, distance_matrix based on BLAST e-values, and an optional e-value threshold for clustering.
+        Optionally input dendrogram, a tuple (Pi, Lambda) loaded with read_dendrogram, in which case
+        the distance matrix is not used and may be None.
         Output: a list of clusters (each cluster is itself a list of keys to sequences)
-        This function is a wrapper around the recursive function merge_closest_clusters.
         """
         ClusterBuilder.__init__(self, seq_keys)
         self.distance_matrix = distance_matrix
@@ -157,6 +340,11 @@ class SLINKClusterBuilder(ClusterBuilder):
         self.threshold = threshold
         color = Color()
 
+        if dendrogram is not None:
+            self.Pi, self.Lambda = dendrogram
+            self.clusters = self.cut_dendrogram(self.threshold)
+            return
+
         # pointer representation of cluster hierarchy:
         # Pi[i] is the first cluster that cluster i joins
         # Lambda[i] is the distance between cluster i and cluster Pi[i]
@@ -194,25 +382,125 @@ class SLINKClusterBuilder(ClusterBuilder):
         # convert from pointer representation to list of sequence clusters
         sys.stdout.write("\n")
         sys.stdout.flush()
+        self.Pi = Pi
+        self.Lambda = Lambda
         print(color.blue + "Finalizing clusters..." + color.done)
+        self.clusters = self.cut_dendrogram(self.threshold)
+
+
+
+    def cut_dendrogram(self, threshold):
+        """
+        Input: an e-value threshold.
+        Output: a list of clusters (each cluster is itself a list of keys to sequences)
+        Cuts the SLINK pointer representation at the given threshold. Since Pi and Lambda
+        encode the entire single-linkage hierarchy this can be repeated for any number of
+        thresholds without recalculating the distance matrix.
+        """
+        n = len(self.seq_keys)
         temp_clusters = [[] for _ in range(n)]
 
         for i in range(n):
-            if Lambda[i] <= self.threshold:
-                temp_clusters[Pi[i]].append(i)
+            if self.Lambda[i] <= threshold:
+                temp_clusters[self.Pi[i]].append(i)
                 if len(temp_clusters[i]) > 0:
                     for j in temp_clusters[i]:
-                        temp_clusters[Pi[i]].append(j)
+                        temp_clusters[self.Pi[i]].append(j)
                     temp_clusters[i] = []
             else:
                 temp_clusters[i].append(i)
 
+        clusters = []
         for temp_cluster in temp_clusters:
             if len(temp_cluster) > 0:
                 temp_cluster_seq = []
                 for i in temp_cluster:
-                    temp_cluster_seq.append(seq_keys[i])
-                self.clusters.append(temp_cluster_seq)
+                    temp_cluster_seq.append(self.seq_keys[i])
+                clusters.append(temp_cluster_seq)
+        return clusters
+
+
+
+    def write_dendrogram(self, length_threshold, file_name="slink_dendrogram"):
+        """
+        Saves the SLINK pointer representation to file so that later runs can re-cut
+        the dendrogram at a different e-value threshold.
+        """
+        data = {"seq_keys": self.seq_keys, "length_threshold": length_threshold, "Pi": self.Pi, "Lambda": self.Lambda}
+        out = open(file_name, "wb")
+        pickle.dump(data, out)
+        out.close()
+
+
+
+    @staticmethod
+    def read_dendrogram(seq_keys, length_threshold, file_name="slink_dendrogram"):
+        """
+        Loads a SLINK pointer representation saved by write_dendrogram.
+        Returns the tuple (Pi, Lambda), or None if there is no saved dendrogram
+        for these sequences and this length threshold.
+        """
+        if not os.path.exists(file_name):
+            return None
+        data = pickle.load(open(file_name, "rb"))
+        if data["seq_keys"] != seq_keys or data["length_threshold"] != length_threshold:
+            return None
+        return data["Pi"], data["Lambda"]
+
+
+
+    def sweep(self, gb, thresholds, min_clusters=4, duplicates=None):
+        """
+        Input: dictionary of all GenBank sequences, a list of e-value thresholds and the
+        minimum number of taxa needed for clusters. Optionally a dictionary that maps
+        each clustered sequence to the keys of identical sequences that were not clustered.
+        Output: a list of rows [threshold, # of clusters, # of clusters with >= min_clusters taxa,
+        # of taxa, taxon coverage density], one row per threshold.
+        The taxon coverage density is that of the supermatrix that would be built from
+        the clusters kept at each threshold.
+        """
+        # look up the OTU of each sequence only once for all thresholds
+        if duplicates is None:
+            duplicates = {}
+        otus = {}
+        for seq_key in self.seq_keys:
+            otus[seq_key] = set()
+            for key in [seq_key] + duplicates.get(seq_key, []):
+                descriptors = gb[key].description.split(" ")
+                otus[seq_key].add(descriptors[0] + " " + descriptors[1])
+        rows = []
+        for threshold in thresholds:
+            clusters = self.cut_dendrogram(threshold)
+            taxa = set()
+            kept = 0
+            total_otus = 0
+            for cluster in clusters:
+                cluster_otus = set()
+                for seq_key in cluster:
+                    cluster_otus.update(otus[seq_key])
+                if len(cluster_otus) >= min_clusters:
+                    kept += 1
+                    total_otus += len(cluster_otus)
+                    taxa.update(cluster_otus)
+            if kept > 0:
+                coverage_density = round(total_otus/float(kept * len(taxa)), 2)
+            else:
+                coverage_density = 0.0
+            rows.append([threshold, len(clusters), kept, len(taxa), coverage_density])
+        return rows
+
+
+
+    def make_sweep_csv(self, rows, file_name="threshold_sweep.csv"):
+        """
+        Generates a CSV file with the results of a threshold sweep.
+        """
+        with open(file_name, 'wb') as csv_output:
+            csvwriter = csv.writer(csv_output)
+            header = ["E-value Threshold", "# of Clusters", "# of Clusters Kept", "# of OTUs", "Taxon Coverage Density"]
+            csvwriter.writerow(header)
+            for row in rows:
+                csvwriter.writerow([str(value) for value in row])
 
 
 
@@ -326,55 +614,512 @@ class UCLUSTClusterBuilder(ClusterBuilder):
         if not os.path.exists("uclusters"):
             os.makedirs("uclusters")
         
-        # write sequences to fasta
-        sequences = []
-        for seq_key in seq_keys:
-            record = gb[seq_key]
-            record.description = record.annotations["organism"] + " " + record.description
-            if "sp." not in record.annotations["organism"]:
-                sequences.append(record)
-        file_name = "_sumac"
-        f = open(file_name, "wb")
-        SeqIO.write(sequences, f, 'fasta')
-        f.close()
-        with open("_sumac", "r") as f, open("_sumac_filtered", "w") as fout:
-            for l in f:
-                if ">" in l:
-                    l = l.replace(" ", "_")    
-                fout.write(l)
+        # write sequences to fasta in a single pass
+        with open("_sumac_filtered", "w") as f:
+            for seq_key in seq_keys:
+                record = gb[seq_key]
+                if "sp." not in record.annotations["organism"]:
+                    f.write(">" + self.fasta_header(record) + "\n" + str(record.seq) + "\n")
 
         # call UCLUST
         sort_sequences = ["usearch", "-sortbylength", "_sumac_filtered", "-fastaout", "_sumac_sorted",
                           "-minseqlength", str(minlength), "-maxseqlength", str(maxlength)]
         uclust = ["usearch", "-cluster_fast", "_sumac_sorted", "-id", str(threshold),
                   "-minsl", str(length_thres), "-strand", "both", "-threads", str(num_cores), 
-                  "-clusters", "uclusters/", "-fulldp", "-evalue", str(evalue)]
+                  "-clusters", "uclusters/", "-uc", "_sumac.uc", "-fulldp", "-evalue", str(evalue)]
         try:
             subprocess.check_call(sort_sequences)
             subprocess.check_call(uclust)
         except CalledProcessError as e:
             print(color.red + "UCLUST error: " + str(e) + color.done)
-            print(color.red + "Trying SLINK instead..." + color.done)
+            print(color.red + "Trying built-in greedy clustering instead..." + color.done)
             self.error = True
             return
         except OSError as e:
             print(color.red + "UCLUST is not installed correctly." + color.done)
             print(color.red + "OS error: " + str(e) + color.done)
-            print(color.red + "Trying SLINK instead..." + color.done)
+            print(color.red + "Trying built-in greedy clustering instead..." + color.done)
             self.error = True
             return
         finally:
-            if os.path.exists("_sumac"):
-                subprocess.check_call(["rm", "_sumac"])
-            if os.path.exists("_sumac_filtered"):
-                subprocess.check_call(["rm", "_sumac_filtered"])
-            if os.path.exists("_sumac_sorted"):
-                subprocess.check_call(["rm", "_sumac_sorted"])
+            if not self.error:
+                self.read_strands("_sumac.uc")
+            for file_name in ["_sumac_filtered", "_sumac_sorted", "_sumac.uc"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
         cluster_files = [ f for f in listdir("uclusters/") if isfile(join("uclusters/", f)) ]
         for f in cluster_files:
             self.clusters.append(f)
 
 
+    def expand_duplicates(self, gb, duplicates):
+        """
+        Inputs the dictionary of all GenBank sequences, and a dictionary that maps the key of each
+        clustered sequence to the keys of identical sequences that were not clustered.
+        Appends the identical sequences to each UCLUST cluster file, in the same orientation.
+        """
+        for seq_key in list(self.strands.keys()):
+            for duplicate in duplicates.get(seq_key, []):
+                self.strands[duplicate] = self.strands[seq_key]
+        seq_keys = list(self.seq_keys)
+        for seq_key in self.seq_keys:
+            seq_keys.extend(duplicates.get(seq_key, []))
+        self.seq_keys = seq_keys
+        for cluster, keys in zip(self.clusters, self.get_cluster_keys()):
+            sequences = []
+            for seq_key in keys:
+                for duplicate in duplicates.get(seq_key, []):
+                    record = gb[duplicate]
+                    if "sp." not in record.annotations["organism"]:
+                        sequences.append(record)
+            if len(sequences) > 0:
+                with open("uclusters/" + cluster, "a") as f:
+                    for record in sequences:
+                        f.write(">" + self.fasta_header(record) + "\n" + str(record.seq) + "\n")
+
+
+    @staticmethod
+    def fasta_header(record):
+        """
+        Returns the UCLUST FASTA header of a SeqRecord: the accession, organism and description
+        joined by underscores, for example AF495760.1_Lythrum_salicaria_chloroplast_ribulose...
+        """
+        header = record.id + " " + record.annotations["organism"] + " " + record.description
+        return " ".join(header.split()).replace(" ", "_")
+
+
+    def read_strands(self, uc_file):
+        """
+        Reads the strand of each sequence relative to its centroid from the UCLUST -uc output,
+        where each line is tab separated: record type, cluster, length, identity, strand, ..., query label.
+        """
+        if not os.path.exists(uc_file):
+            return
+        with open(uc_file, "r") as f:
+            for l in f:
+                fields = l.rstrip("\n").split("\t")
+                if len(fields) < 9 or fields[0] not in ("S", "H"):
+                    continue
+                seq_key = fields[8].split("_")[0]
+                if fields[0] == "H" and fields[4] == "-":
+                    self.strands[seq_key] = "-"
+                else:
+                    self.strands[seq_key] = "+"
+
+
+
+    def get_cluster_keys(self):
+        """
+        Returns a list of clusters, each cluster a list of keys to sequences.
+        UCLUST sequence ids are the accession followed by the description, for example:
+        AF495760.1_Lythrum_salicaria_chloroplast_ribulose...
+        """
+        clusters = []
+        for cluster in self.clusters:
+            keys = []
+            with open("uclusters/" + cluster, "r") as f:
+                for l in f:
+                    if l.startswith(">"):
+                        keys.append(l[1:].split("_")[0].strip())
+            clusters.append(keys)
+        return clusters
+
+
+
+
+class GreedyClusterBuilder(ClusterBuilder):
+    """
+    Clusters sequences with a built-in greedy, length-sorted centroid algorithm similar to UCLUST.
+    Requires no external programs, so it is used when USEARCH is not available.
+    Inherits from ClusterBuilder.
+    """
+
+
+    threshold = 0.5
+
+
+    def __init__(self, gb, seq_keys, num_cores, minlength, maxlength, length_thres=0.25, threshold=0.5, word_length=8, min_words=3, maxrejects=8,
+                 centroids=None):
+        """
+        Input: gb dictionary of SeqRecords, keys to all sequences, the number of cores, the minimum and
+        maximum sequence lengths, the minimum length ratio of the shorter to the longer sequence
+        (like UCLUST -minsl), and the identity threshold for clustering (like UCLUST -id).
+        Sequences are sorted by decreasing length. Each sequence joins the first centroid it matches
+        with identity >= threshold on either strand, otherwise it becomes a new centroid.
+        Candidate centroids are ranked by shared words (k-mers) and at most maxrejects + 1 of them
+        are aligned with a banded semi-global alignment, if at least min_words of the shared
+        words fall within the band.
+        Optionally input centroids, a list of (key, sequence) tuples that seed the first clusters
+        (for example the representatives of the clusters of a previous run).
+        Output: a list of clusters (each cluster is itself a list of keys to sequences, centroid first)
+        """
+        ClusterBuilder.__init__(self, seq_keys)
+        self.seq_keys = seq_keys
+        self.threshold = threshold
+        self.strands = {}
+        self.centroids = []
+        color = Color()
+
+        # load sequences, filtering them like the UCLUST clustering
+        sequences = []
+        for seq_key in seq_keys:
+            record = gb[seq_key]
+            if "sp." in record.annotations["organism"]:
+                continue
+            sequence = str(record.seq).upper()
+            if minlength <= len(sequence) <= maxlength:
+                sequences.append((seq_key, sequence))
+        sequences.sort(key=lambda seq: len(seq[1]), reverse=True)
+
+        global _greedy_state
+        _greedy_state = {"centroids": [], "index": {}, "word_length": word_length, "min_words": min_words,
+                         "length_thres": length_thres, "threshold": threshold, "maxrejects": maxrejects}
+        clusters = []
+        if centroids is not None:
+            for seq_key, sequence in centroids:
+                _greedy_add_centroid(sequence)
+                self.centroids.append((seq_key, sequence))
+                clusters.append([])
+        n = len(sequences)
+        batch_size = max(64, 32 * num_cores)
+        pool = None
+        log = None
+        if num_cores > 1 and n > batch_size:
+            # the workers inherit the centroids found so far, and read the centroids
+            # found later from the centroid file, one sequence per line
+            _greedy_state["log"] = "_sumac_centroids"
+            log = open(_greedy_state["log"], "w")
+            pool = multiprocessing.Pool(num_cores)
+        try:
+            start = 0
+            while start < n:
+                batch = sequences[start:start + batch_size]
+                # search the batch against the centroids found so far in parallel
+                if pool is not None and len(_greedy_state["centroids"]) > 0:
+                    log.flush()
+                    num_centroids = len(_greedy_state["centroids"])
+                    hits = pool.map(_greedy_search_synced, [(num_centroids, seq) for key, seq in batch])
+                else:
+                    hits = [_greedy_search(seq) for key, seq in batch]
+                # then resolve the batch in order, since a sequence may only match
+                # a centroid that was created earlier in this same batch
+                first_new = len(_greedy_state["centroids"])
+                for (seq_key, sequence), hit in zip(batch, hits):
+                    if hit is None and len(_greedy_state["centroids"]) > first_new:
+                        hit = _greedy_search(sequence, first_new)
+                    if hit is None:
+                        _greedy_add_centroid(sequence)
+                        if log is not None:
+                            log.write(sequence + "\n")
+                        self.centroids.append((seq_key, sequence))
+                        clusters.append([seq_key])
+                        self.strands[seq_key] = "+"
+                    else:
+                        clusters[hit[0]].append(seq_key)
+                        self.strands[seq_key] = hit[1]
+                start += len(batch)
+                percent = str(round(100 * start/float(n), 2))
+                sys.stdout.write('\r' + color.blue + 'Completed: ' + color.red + str(start) + '/' + str(n) + ' (' + percent + '%)' + color.done)
+                sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                log.close()
+                os.remove(_greedy_state["log"])
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        _greedy_state = None
+        self.clusters = clusters
+
+
+    def expand_duplicates(self, gb, duplicates):
+        """
+        Inputs the dictionary of all GenBank sequences, and a dictionary that maps the key of each
+        clustered sequence to the keys of identical sequences that were not clustered.
+        Adds the identical sequences to the cluster of each clustered sequence, leaving out those from
+        organisms such as "Genus sp." like the clustering does.
+        """
+        named = {}
+        for seq_key in duplicates:
+            named[seq_key] = [duplicate for duplicate in duplicates[seq_key] if "sp." not in gb[duplicate].annotations["organism"]]
+        ClusterBuilder.expand_duplicates(self, gb, named)
+
+
+    def get_representatives(self, gb):
+        """
+        Returns a list of the (key, sequence) of the centroid of each cluster.
+        """
+        return self.centroids
+
+
+
+class IncrementalClusterBuilder(GreedyClusterBuilder):
+    """
+    Places new sequences into the clusters saved by a previous run, using the greedy
+    clustering algorithm with the saved representative sequences as centroids.
+    Sequences that match no representative seed new clusters.
+    Inherits from GreedyClusterBuilder.
+    """
+
+
+    def __init__(self, gb, seq_keys, state, num_cores, minlength, maxlength, length_thres=0.25, threshold=0.5, all_seq_keys=None):
+        """
+        Input: gb dictionary of SeqRecords, keys to all sequences, the clusters saved by
+        write_cluster_state, and the clustering parameters of GreedyClusterBuilder.
+        If seq_keys are only the unique sequences, all_seq_keys are the keys to all sequences
+        including the identical sequences that will be added with expand_duplicates.
+        Only the sequences not clustered in the previous run are compared to the representatives.
+        Output: a list of clusters (each cluster is itself a list of keys to sequences), where
+        the set unchanged has the indices of the clusters that did not gain or lose sequences.
+        """
+        color = Color()
+        previous_keys = set(state["seq_keys"])
+        new_keys = [seq_key for seq_key in seq_keys if seq_key not in previous_keys]
+        print(color.purple + "Found " + color.red + str(len(new_keys)) + color.purple + " new sequences since the previous run." + color.done)
+        GreedyClusterBuilder.__init__(self, gb, new_keys, num_cores, minlength, maxlength, length_thres, threshold,
+                                      centroids=state["representatives"])
+        self.seq_keys = seq_keys
+
+        # new sequences are oriented relative to the representatives, which may be on the
+        # minus strand of their clusters
+        previous_strands = state.get("strands", {})
+        for i, (seq_key, sequence) in enumerate(state["representatives"]):
+            if previous_strands.get(seq_key) == "-":
+                for new_key in self.clusters[i]:
+                    self.strands[new_key] = "+" if self.strands[new_key] == "-" else "-"
+        for seq_key in previous_strands:
+            if seq_key not in self.strands:
+                self.strands[seq_key] = previous_strands[seq_key]
+
+        # merge the new sequences into the previous clusters, dropping sequences
+        # that are no longer part of the search results
+        if all_seq_keys is None:
+            all_seq_keys = seq_keys
+        current_keys = set(all_seq_keys)
+        num_previous = len(state["clusters"])
+        clusters = []
+        centroids = []
+        self.unchanged = set()
+        for i, previous_cluster in enumerate(state["clusters"]):
+            cluster = [seq_key for seq_key in previous_cluster if seq_key in current_keys]
+            if len(cluster) == len(previous_cluster) and len(self.clusters[i]) == 0:
+                self.unchanged.add(len(clusters))
+            cluster.extend(self.clusters[i])
+            if len(cluster) > 0:
+                clusters.append(cluster)
+                centroids.append(self.centroids[i])
+        new_clusters = self.clusters[num_previous:]
+        print(color.purple + "Updated " + color.red + str(num_previous - len(self.unchanged)) + color.purple \
+              + " previous clusters and found " + color.red + str(len(new_clusters)) + color.purple + " new clusters." + color.done)
+        self.clusters = clusters + new_clusters
+        self.centroids = centroids + self.centroids[num_previous:]
+
+
+
+# state shared with the GreedyClusterBuilder worker processes, which inherit it when forked
+_greedy_state = None
+
+
+
+def _greedy_words(sequence, word_length):
+    """
+    Returns a dictionary of each word (k-mer) in the sequence and its first position.
+    """
+    words = {}
+    for i in range(len(sequence) - word_length + 1):
+        word = sequence[i:i + word_length]
+        if word not in words:
+            words[word] = i
+    return words
+
+
+
+def _greedy_add_centroid(sequence):
+    """
+    Adds a sequence to the list of centroids and to the word index.
+    """
+    centroid = len(_greedy_state["centroids"])
+    words = _greedy_words(sequence, _greedy_state["word_length"])
+    _greedy_state["centroids"].append((sequence, words))
+    index = _greedy_state["index"]
+    for word in words:
+        if word in index:
+            index[word].append(centroid)
+        else:
+            index[word] = [centroid]
+
+
+
+def _greedy_search(sequence, first_centroid=0):
+    """
+    Worker function for GreedyClusterBuilder.
+    Returns the tuple (centroid, strand) of the first centroid matching the sequence,
+    or None if no centroid matches.
+    """
+    centroids = _greedy_state["centroids"]
+    index = _greedy_state["index"]
+    word_length = _greedy_state["word_length"]
+    candidates = []
+    for strand, query in (("+", sequence), ("-", reverse_complement(sequence))):
+        query_words = _greedy_words(query, word_length)
+        shared = {}
+        for word in query_words:
+            for centroid in index.get(word, ()):
+                if centroid >= first_centroid:
+                    shared[centroid] = shared.get(centroid, 0) + 1
+        for centroid, count in shared.items():
+            # check the length ratio of the shorter to the longer sequence (-minsl)
+            length = len(centroids[centroid][0])
+            if min(length, len(sequence)) >= _greedy_state["length_thres"] * max(length, len(sequence)):
+                candidates.append((count, -centroid, strand, query, query_words))
+    candidates.sort(reverse=True)
+    for count, centroid, strand, query, query_words in candidates[:_greedy_state["maxrejects"] + 1]:
+        target, target_words = centroids[-centroid]
+        # center the band on the diagonal with the most shared words within the band,
+        # words shared by unrelated sequences are scattered across all diagonals
+        band = _greedy_band(min(len(query), len(target)))
+        hits = sorted([(target_words[word] - position, position) for word, position in query_words.items() if word in target_words])
+        best = (0, 0)
+        first = 0
+        for last in range(len(hits)):
+            while hits[last][0] - hits[first][0] > band:
+                first += 1
+            if last - first + 1 > best[1] - best[0]:
+                best = (first, last + 1)
+        # only count words that do not overlap, a single short match gives several words
+        support = 0
+        end = -1
+        for position in sorted([position for diagonal, position in hits[best[0]:best[1]]]):
+            if position >= end:
+                support += 1
+                end = position + word_length
+        if support < _greedy_state["min_words"]:
+            continue
+        offset = (hits[best[0]][0] + hits[best[1] - 1][0]) // 2
+        # a gapless alignment along the most common diagonal is often good enough
+        diagonals = {}
+        for diagonal, position in hits[best[0]:best[1]]:
+            diagonals[diagonal] = diagonals.get(diagonal, 0) + 1
+        diagonal = max(diagonals, key=lambda d: diagonals[d])
+        # align the shorter sequence to the longer one, seed centroids from
+        # earlier runs may be shorter than the query
+        if len(query) > len(target):
+            query, target, diagonal, offset = target, query, -diagonal, -offset
+        if _ungapped_identity(query, target, diagonal) >= _greedy_state["threshold"]:
+            return -centroid, strand
+        if _banded_identity(query, target, offset, band) >= _greedy_state["threshold"]:
+            return -centroid, strand
+    return None
+
+
+
+def _greedy_search_synced(job):
+    """
+    Worker function for GreedyClusterBuilder.
+    Input: the number of centroids found so far and a sequence.
+    Adds the centroids this worker has not seen yet from the centroid file,
+    then returns the first centroid matching the sequence like _greedy_search.
+    """
+    num_centroids, sequence = job
+    if len(_greedy_state["centroids"]) < num_centroids:
+        if "log_handle" not in _greedy_state:
+            _greedy_state["log_handle"] = open(_greedy_state["log"], "r")
+        while len(_greedy_state["centroids"]) < num_centroids:
+            _greedy_add_centroid(_greedy_state["log_handle"].readline().rstrip("\n"))
+    return _greedy_search(sequence)
+
+
+
+def _greedy_band(length):
+    """
+    Returns the band width used to align a sequence of the given length.
+    """
+    return max(16, length // 20)
+
+
+
+def _ungapped_identity(query, target, diagonal):
+    """
+    Returns the identity of the gapless alignment of the query to the target
+    where query position i is aligned to target position i + diagonal.
+    Query positions overhanging the target count as mismatches.
+    """
+    start = max(0, -diagonal)
+    end = min(len(query), len(target) - diagonal)
+    if end <= start:
+        return 0.0
+    matches = sum([1 for a, b in zip(query[start:end], target[start + diagonal:end + diagonal]) if a == b])
+    return matches/float(len(query))
+
+
+
+def _banded_identity(query, target, offset, band=None):
+    """
+    Aligns the whole query to the target allowing free end gaps in the target, only computing
+    cells within band positions of the diagonal j = i + offset. Alignments are scored with
+    match = 1, mismatch = -1 and gap = -2.
+    Returns the identity, the number of matching columns divided by the number of
+    columns excluding terminal gaps.
+    """
+    n = len(query)
+    m = len(target)
+    if n == 0:
+        return 0.0
+    if band is None:
+        band = _greedy_band(n)
+    unset = -2 * (n + m + 1)
+    # each cell keeps the alignment score, matching columns and columns
+    previous_score = [unset] * (m + 1)
+    previous_matches = [0] * (m + 1)
+    previous_columns = [0] * (m + 1)
+    current_score = [unset] * (m + 1)
+    current_matches = [0] * (m + 1)
+    current_columns = [0] * (m + 1)
+    for j in range(max(0, offset - band), min(m, offset + band) + 1):
+        previous_score[j] = 0
+    for i in range(1, n + 1):
+        low = max(0, i + offset - band)
+        high = min(m, i + offset + band)
+        if low > high:
+            return 0.0
+        letter = query[i - 1]
+        for j in range(low, high + 1):
+            if j == 0:
+                current_score[j] = -2 * i
+                current_matches[j] = 0
+                current_columns[j] = i
+                continue
+            # match or mismatch
+            if target[j - 1] == letter:
+                score = previous_score[j - 1] + 1
+                matches = previous_matches[j - 1] + 1
+            else:
+                score = previous_score[j - 1] - 1
+                matches = previous_matches[j - 1]
+            columns = previous_columns[j - 1] + 1
+            # gap in the target
+            if previous_score[j] - 2 > score:
+                score = previous_score[j] - 2
+                matches = previous_matches[j]
+                columns = previous_columns[j] + 1
+            # gap in the query
+            if j > low and current_score[j - 1] - 2 > score:
+                score = current_score[j - 1] - 2
+                matches = current_matches[j - 1]
+                columns = current_columns[j - 1] + 1
+            current_score[j] = score
+            current_matches[j] = matches
+            current_columns[j] = columns
+        previous_score, current_score = current_score, previous_score
+        previous_matches, current_matches = current_matches, previous_matches
+        previous_columns, current_columns = current_columns, previous_columns
+    best = max(range(low, high + 1), key=lambda j: previous_score[j])
+    if previous_score[best] <= unset or previous_columns[best] == 0:
+        return 0.0
+    return previous_matches[best]/float(previous_columns[best])
+
+
 
 
 class GuidedClusterBuilder(ClusterBuilder):
@@ -390,139 +1135,100 @@ class GuidedClusterBuilder(ClusterBuilder):
         a list of ingroup/outgroup sequences, the e-value threshold to cluster, and the
         threshold of sequence length percent similarity to cluster taxa,
         and the GenBank directory.
+        All guide sequences are searched in a single multithreaded BLAST search against
+        a BLAST database of the ingroup/outgroup sequences. The strand of each hit
+        orients the sequence relative to the guide of its cluster.
         Generates a list of clusters (each cluster is itself a list of keys to sequences).
         """
         ClusterBuilder.__init__(self, all_seq_keys)
-        
-        lock = multiprocessing.Lock()
-        manager = multiprocessing.Manager()
-        already_compared = manager.list()
-        clusters = manager.list()
 
         color = Color()
-        guide_seq_ids = []
         # check for fasta file of guide sequences
         if not os.path.isfile(guide_seq):
             print(color.red + "FASTA file of guide sequences not found. Please re-try." + color.done)
             sys.exit(0)
-        else:
-            # initialize an empty list for each cluster
-            guide_sequences = SeqIO.parse(open(guide_seq, "rU"), "fasta")
-            for guide in guide_sequences:
-                guide_seq_ids.append(guide.id)
-                clusters.append([])
+        guides = list(SeqIO.parse(open(guide_seq, "rU"), "fasta"))
+        guide_seq_ids = [guide.id for guide in guides]
+
+        # write the guides as BLAST queries, using their position as query id
+        output_handle = open("blast_guides.fasta", "w")
+        for i, guide in enumerate(guides):
+            output_handle.write(">guide" + str(i) + "\n" + str(guide.seq) + "\n")
+        output_handle.close()
 
-        # make blast database
+        # make blast database once, each sequence title is its key
+        print(color.blue + "Making BLAST database of " + color.red + str(len(all_seq_keys)) + color.blue + " sequences..." + color.done)
         gb = SeqIO.index_db(gb_dir + "/gb.idx")
-        output_handle = open('blast_db.fasta', 'w')
-        records = []
+        output_handle = open("blast_db.fasta", "w")
         for key in all_seq_keys:
-            record = gb[key]
-            records.append(record)
-        SeqIO.write(records, output_handle, 'fasta')
+            output_handle.write(">" + key + "\n" + str(gb[key].seq) + "\n")
         output_handle.close()
+        makeblastdb_cmd = NcbimakeblastdbCommandline(input_file="blast_db.fasta", dbtype="nucl", out="blast_db")
+        stdout, stderr = makeblastdb_cmd()
+
+        # blast all guides against blast_db
+        print(color.blue + "Searching " + color.red + str(len(guides)) + color.blue + " guide sequences using " + color.red + str(num_cores) \
+              + color.blue + " threads..." + color.done)
+        blastn_cmd = NcbiblastnCommandline(query="blast_guides.fasta", db="blast_db", out="blast_guides.tsv", outfmt="6 qseqid stitle evalue slen sstrand", \
+            evalue=evalue_threshold, max_target_seqs=max(1, len(all_seq_keys)), num_threads=num_cores)
+        stdout, stderr = blastn_cmd()
+
+        # bucket the hits into a cluster for each guide sequence
+        clusters = [[] for guide in guides]
+        in_cluster = [set() for guide in guides]
+        guide_strands = [{} for guide in guides]
+        with open("blast_guides.tsv", "r") as blast_output:
+            for line in blast_output:
+                # sample line:
+                # guide0	AJ620515.1	2e-150	612	plus
+                fields = line.rstrip("\n").split("\t")
+                i = int(fields[0].split("|")[-1][len("guide"):])
+                accession = fields[1].split(" ")[0]
+                length1 = len(guides[i].seq)
+                length2 = int(fields[3])
+                # check if length similarity threshold met
+                # and check to see if evalue_threshold is met
+                if (length2 < length1 * (1 + float(length_threshold))) and (length2 > length1 * (1 - float(length_threshold))) \
+                    and (float(fields[2]) < evalue_threshold):
+                    # blast hit found, add sequence to cluster
+                    if accession not in in_cluster[i]:
+                        clusters[i].append(accession)
+                        in_cluster[i].add(accession)
+                        # the strand of the best hit, relative to this guide sequence
+                        if len(fields) > 4:
+                            guide_strands[i][accession] = "-" if fields[4] == "minus" else "+"
+        for file_name in os.listdir("."):
+            if file_name.startswith("blast_db.") or file_name.startswith("blast_guides."):
+                os.remove(file_name)
 
-        # spawn processes
-        print(color.blue + "Spawning " + color.red + str(num_cores) + color.blue + " processes to make clusters." + color.done)
-        processes = []
-        
-        for i in range(num_cores):
-            p = multiprocessing.Process(target=self.make_guided_clusters_worker, args=(guide_seq, all_seq_keys, \
-                length_threshold, evalue_threshold, clusters, already_compared, lock, i, gb_dir))
-            p.start()
-            processes.append(p)
-
-        for p in processes:
-            p.join()
-        
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        if os.path.isfile("blast_db.fasta"):
-            os.remove("blast_db.fasta")
-        
         final_clusters = []
+        final_strands = []
         merged_clusters = []
         # merge clusters with multiple guide sequences
         for i, seq_id in enumerate(guide_seq_ids):
             if i not in merged_clusters:
                 new_cluster = clusters[i]
+                new_in_cluster = set(in_cluster[i])
+                new_strands = dict(guide_strands[i])
+                conflict = False
                 merged_clusters.append(i)
                 for j in range(i + 1, len(guide_seq_ids)):
                     if guide_seq_ids[i][:-1] == guide_seq_ids[j][:-1]:
-                        new_cluster = new_cluster + clusters[j]
+                        for accession in clusters[j]:
+                            strand = guide_strands[j].get(accession)
+                            if accession not in new_in_cluster:
+                                new_cluster.append(accession)
+                                new_in_cluster.add(accession)
+                                if strand is not None:
+                                    new_strands[accession] = strand
+                            elif strand is not None and new_strands.get(accession, strand) != strand:
+                                conflict = True
                         merged_clusters.append(j)
+                # the guides of a cluster disagree on the orientation of a sequence,
+                # so the cluster is left for MAFFT to orient
+                if conflict:
+                    new_strands = {}
                 final_clusters.append(new_cluster)
+                final_strands.append(new_strands)
         self.clusters = final_clusters
-
-
-    def make_guided_clusters_worker(self, guide_seq, all_seq_keys, length_threshold, evalue_threshold, clusters, already_compared, lock, process_num, gb_dir):
-        """
-        Worker process for make_guided_clusters(). Each process will compare all the ingroup/outgroup sequences
-        to a guide sequence, adding that guide sequence to the already_compared list.
-        """
-
-        color = Color()
-        process_num = str(process_num)
-
-        # open guide fasta file
-        if os.path.isfile(guide_seq):
-            guide_sequences = list(SeqIO.parse(open(guide_seq, "rU"), "fasta"))
-        else:        
-            print(color.red + "FASTA file of guide sequences not found. Please re-try." + color.done)
-            sys.exit(0)
-
-        # remember how many guide sequences there are
-        num_guides = len(list(guide_sequences))
-
-        for i, guide in enumerate(guide_sequences):
-            # check whether another process is already comparing this guide sequence
-            compare_guide = False
-            with lock:
-                if guide.id not in already_compared:
-                    already_compared.append(guide.id)
-                    compare_guide = True
-            if compare_guide:
-                
-                # set query to be guide sequence 
-                output_handle = open('query' + process_num + '.fasta', 'w')
-                SeqIO.write(guide, output_handle, 'fasta')
-                output_handle.close()
-
-                # blast query against blast_db
-                blastn_cmd = NcbiblastnCommandline(query='query' + process_num + '.fasta', subject='blast_db.fasta', \
-                    out='blast' + process_num + '.xml', outfmt=5)
-                stdout, stderr = blastn_cmd()
-
-                # parse blast output
-                blastn_xml = open('blast' + process_num + '.xml', 'r')
-                blast_records = NCBIXML.parse(blastn_xml)
-                for blast_record in blast_records:
-                    for alignment in blast_record.alignments:
-                        # loop through each high-scoring segment pair (HSP)
-                        for hsp in alignment.hsps:
-                            length1 = len(guide.seq)
-                            length2 = alignment.length
-                            # check if length similarity threshold met
-                            # and check to see if evalue_threshold is met
-                            if (length2 < length1 * (1 + float(length_threshold))) and (length2 > length1 * (1 - float(length_threshold))) \
-                                and (hsp.expect < evalue_threshold):
-                                # blast hit found, add sequence to cluster
-                                # get accession number from sequence title:
-                                # Subject_145 AJ620515.1 Gaura parviflora ITS1, 5.8S rRNA gene, and ITS2
-                                accession = alignment.title.split(" ")[1]
-                                with lock:
-                                    temp_cluster = clusters[i]
-                                    temp_cluster.append(accession)
-                                    clusters[i] = temp_cluster
-                blastn_xml.close()
-            # update status
-            percent = str(round(100 * len(already_compared)/float(num_guides), 2))
-            sys.stdout.write('\r' + color.blue + 'Completed: ' + color.red + str(len(already_compared)) + '/' + str(num_guides) + ' (' + percent + '%)' + color.done)    
-            sys.stdout.flush()    
-        # done looping through all guides, now clean up
-        if os.path.isfile("blast" + process_num + ".xml"):
-            os.remove("blast" + process_num + ".xml")
-        if os.path.isfile("query" + process_num + ".fasta"):
-            os.remove("query" + process_num + ".fasta")
-
-
+        self.cluster_strands = final_strands
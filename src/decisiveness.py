@@ -0,0 +1,736 @@
+"""
+SUMAC: supermatrix constructor
+
+Copyright 2014 Will Freyman - freyman@berkeley.edu
+License: GNU GPLv3 http://www.gnu.org/licenses/gpl.html
+"""
+
+import math
+import heapq
+import random
+import multiprocessing
+
+
+
+def binomial_coefficient(n, k):
+    """
+    A fast way to calculate binomial coefficients by Andrew Dalke (contrib).
+    """
+    if 0 <= k <= n:
+        ntok = 1
+        ktok = 1
+        for t in range(1, min(k, n - k) + 1):
+            ntok *= n
+            ktok *= t
+            n -= 1
+        return ntok // ktok
+    else:
+        return 0
+
+
+
+def popcount(bits):
+    """
+    Returns the number of bits set in an integer.
+    """
+    return bin(bits).count("1")
+
+
+
+def count_disjoint_pairs(groups, loci):
+    """
+    Input: a dictionary from bitsets of loci, all within the bitset loci, to a number of OTUs.
+    Returns the number of pairs of OTUs whose bitsets have no locus in common.
+    Compares every pair of bitsets, or if there are few loci sums the OTUs over all subsets of the loci,
+    whichever is faster.
+    """
+    positions = [locus for locus in range(loci.bit_length()) if loci >> locus & 1]
+    size = 1 << len(positions)
+    if size * len(positions) >= len(groups) * len(groups) // 2:
+        count = binomial_coefficient(groups.get(0, 0), 2)
+        shared = list(groups)
+        for a in range(len(shared)):
+            for b in range(a + 1, len(shared)):
+                if shared[a] & shared[b] == 0:
+                    count += groups[shared[a]] * groups[shared[b]]
+        return count
+    # number of OTUs with each subset of the loci, then with any subset of each subset
+    subsets = [0] * size
+    compressed = {}
+    for bits, num_otus in groups.items():
+        index = 0
+        for position, locus in enumerate(positions):
+            if bits >> locus & 1:
+                index |= 1 << position
+        compressed[index] = num_otus
+        subsets[index] += num_otus
+    for position in range(len(positions)):
+        bit = 1 << position
+        for index in range(size):
+            if index & bit:
+                subsets[index] += subsets[index ^ bit]
+    # ordered pairs, less each OTU without loci paired with itself
+    ordered = -groups.get(0, 0)
+    for index, num_otus in compressed.items():
+        ordered += num_otus * subsets[(size - 1) ^ index]
+    return ordered // 2
+
+
+
+class DecisivenessCounts(object):
+    """
+    The triple counts behind partial decisiveness (PD), the fraction of triples of OTUs that share
+    sequence data for at least one locus. A triple is decisive if it does.
+    See: Sanderson, M.J., McMahon, M.M. & Steel, M., 2010. BMC evolutionary biology, 10.
+    """
+
+
+    num_otus = 0
+    total = 0               # number of triples
+    decisive = 0            # number of decisive triples
+    otu_decisive = []       # number of decisive triples containing each OTU
+    locus_otus = []         # number of OTUs with sequence data for each locus
+
+    def __init__(self, num_otus, decisive, otu_decisive, locus_otus):
+        self.num_otus = num_otus
+        self.total = binomial_coefficient(num_otus, 3)
+        self.decisive = decisive
+        self.otu_decisive = otu_decisive
+        self.locus_otus = locus_otus
+
+
+
+    def get_PD(self):
+        """
+        Returns the fraction of triples that are decisive.
+        """
+        return self.decisive/float(self.total)
+
+
+
+    def get_OTU_counts(self, otu):
+        """
+        Returns the number of decisive triples and the number of triples without the OTU at index otu.
+        """
+        return self.decisive - self.otu_decisive[otu], binomial_coefficient(self.num_otus - 1, 3)
+
+
+
+    def get_locus_counts(self, locus):
+        """
+        Returns the number of decisive triples and the number of triples that the locus does not make
+        decisive, that is triples without sequence data for the locus in all three OTUs.
+        Every triple with sequence data for the locus in all three OTUs is decisive.
+        """
+        covered = binomial_coefficient(self.locus_otus[locus], 3)
+        return self.decisive - covered, self.total - covered
+
+
+
+class BitsetDecisiveness(object):
+    """
+    Counts decisive triples with bitsets. For each pair of OTUs, the loci they share are the bitwise
+    AND of their locus bitsets, and the third OTUs that make a decisive triple with the pair are the
+    bitwise OR of the OTU bitsets of those loci. Pairs that share the same loci share the result.
+    The cost is quadratic in the number of OTUs, with no loop over triples.
+    """
+
+
+    coverage = []           # bitset of the loci with sequence data, for each OTU
+    locus_coverage = []     # bitset of the OTUs with sequence data, for each locus
+
+    def __init__(self, sequence_lengths):
+        """
+        Input: a list with the sequence lengths of each OTU, a length of 0 meaning no sequence data.
+        """
+        num_loci = 0
+        if len(sequence_lengths) > 0:
+            num_loci = len(sequence_lengths[0])
+        self.coverage = []
+        self.locus_coverage = [0] * num_loci
+        for otu, lengths in enumerate(sequence_lengths):
+            bits = 0
+            for locus, length in enumerate(lengths):
+                if length != 0:
+                    bits |= 1 << locus
+                    self.locus_coverage[locus] |= 1 << otu
+            self.coverage.append(bits)
+
+
+
+    def get_third_otus(self, shared_loci, cache):
+        """
+        Returns the number of OTUs other than a pair that make a decisive triple with the pair,
+        given the bitset of the loci the pair shares.
+        """
+        count = cache.get(shared_loci)
+        if count is None:
+            otus = 0
+            loci = shared_loci
+            while loci:
+                lowest = loci & -loci
+                otus |= self.locus_coverage[lowest.bit_length() - 1]
+                loci ^= lowest
+            # the pair itself has sequence data for all the shared loci
+            count = popcount(otus) - 2
+            cache[shared_loci] = count
+        return count
+
+
+
+    def count_pairs(self, first_otus):
+        """
+        Input: the OTUs to use as the first OTU of each pair.
+        Returns the sum over pairs (i, j), i in first_otus and j > i, of the number of decisive triples
+        containing the pair, and the same sum for each OTU.
+        """
+        n = len(self.coverage)
+        pair_sum = 0
+        otu_sums = [0] * n
+        cache = {}
+        for i in first_otus:
+            bits = self.coverage[i]
+            if bits == 0:
+                continue
+            for j in range(i + 1, n):
+                shared_loci = bits & self.coverage[j]
+                if shared_loci:
+                    count = self.get_third_otus(shared_loci, cache)
+                    pair_sum += count
+                    otu_sums[i] += count
+                    otu_sums[j] += count
+        return pair_sum, otu_sums
+
+
+
+    def calculate(self):
+        """
+        Returns the DecisivenessCounts of the supermatrix.
+        Each decisive triple is counted once by each of its 3 pairs, and twice for each of its OTUs.
+        """
+        pair_sum, otu_sums = self.count_pairs(range(len(self.coverage)))
+        return DecisivenessCounts(len(self.coverage), pair_sum // 3, [otu_sum // 2 for otu_sum in otu_sums],
+                                  [popcount(otus) for otus in self.locus_coverage])
+
+
+
+class PatternDecisiveness(BitsetDecisiveness):
+    """
+    Counts decisive triples over groups of OTUs with the same coverage pattern, the loci they have
+    sequence data for. OTUs in a group make the same decisive triples, so pairs of OTUs are counted
+    with binomial coefficients per pair of patterns, and the cost is quadratic in the number of
+    distinct patterns rather than the number of OTUs.
+    """
+
+
+    patterns = []           # the distinct coverage patterns, as bitsets of loci
+    pattern_otus = []       # the OTUs with each pattern
+
+    def __init__(self, sequence_lengths):
+        """
+        Input: a list with the sequence lengths of each OTU, a length of 0 meaning no sequence data.
+        """
+        BitsetDecisiveness.__init__(self, sequence_lengths)
+        self.patterns = []
+        self.pattern_otus = []
+        indices = {}
+        for otu, bits in enumerate(self.coverage):
+            if bits not in indices:
+                indices[bits] = len(self.patterns)
+                self.patterns.append(bits)
+                self.pattern_otus.append([])
+            self.pattern_otus[indices[bits]].append(otu)
+
+
+
+    def count_pattern_pairs(self, first_patterns):
+        """
+        Input: the indices of the patterns to use as the first pattern of each pair of patterns.
+        Returns the sum over pairs of OTUs, the first with a pattern in first_patterns and the second
+        with the same or a later pattern, of the number of decisive triples containing the pair,
+        and the same sum for one OTU of each pattern.
+        """
+        pair_sum = 0
+        pattern_sums = [0] * len(self.patterns)
+        cache = {}
+        for a in first_patterns:
+            bits = self.patterns[a]
+            if bits == 0:
+                continue
+            size = len(self.pattern_otus[a])
+            # pairs of OTUs within the pattern
+            if size > 1:
+                count = self.get_third_otus(bits, cache)
+                pair_sum += binomial_coefficient(size, 2) * count
+                pattern_sums[a] += (size - 1) * count
+            for b in range(a + 1, len(self.patterns)):
+                shared_loci = bits & self.patterns[b]
+                if shared_loci:
+                    count = self.get_third_otus(shared_loci, cache)
+                    other_size = len(self.pattern_otus[b])
+                    pair_sum += size * other_size * count
+                    pattern_sums[a] += other_size * count
+                    pattern_sums[b] += size * count
+        return pair_sum, pattern_sums
+
+
+
+    def get_shards(self, num_shards):
+        """
+        Splits the patterns into shards with about the same number of pairs of patterns, to count
+        in parallel. A pattern is the first of a pair with each later pattern, so patterns are dealt
+        to the shards in order, going back and forth.
+        Returns a list of lists of pattern indices.
+        """
+        shards = [[] for shard in range(min(num_shards, len(self.patterns)))]
+        for a in range(len(self.patterns)):
+            turn, shard = divmod(a, len(shards))
+            if turn % 2 == 1:
+                shard = len(shards) - 1 - shard
+            shards[shard].append(a)
+        return shards
+
+
+
+    def calculate(self, num_cores=1):
+        """
+        Returns the DecisivenessCounts of the supermatrix.
+        With more than one core the pairs of patterns are counted in shards by a pool of processes,
+        and their sums added together.
+        """
+        if num_cores > 1 and len(self.patterns) > 1:
+            global _decisiveness_state
+            _decisiveness_state = self
+            pool = multiprocessing.Pool(num_cores)
+            results = pool.map(_count_pattern_shard, self.get_shards(4 * num_cores))
+            pool.close()
+            pool.join()
+            _decisiveness_state = None
+            pair_sum = sum(result[0] for result in results)
+            pattern_sums = [sum(sums) for sums in zip(*[result[1] for result in results])]
+        else:
+            pair_sum, pattern_sums = self.count_pattern_pairs(range(len(self.patterns)))
+        otu_decisive = [0] * len(self.coverage)
+        for pattern, otus in enumerate(self.pattern_otus):
+            for otu in otus:
+                otu_decisive[otu] = pattern_sums[pattern] // 2
+        return DecisivenessCounts(len(self.coverage), pair_sum // 3, otu_decisive,
+                                  [popcount(otus) for otus in self.locus_coverage])
+
+
+
+# the PatternDecisiveness or IncrementalDecisiveness in use, inherited by the pool's worker processes when they fork
+_decisiveness_state = None
+
+
+
+def _count_pattern_shard(first_patterns):
+    """
+    Worker function to count the pairs of patterns starting at a shard of patterns.
+    """
+    return _decisiveness_state.count_pattern_pairs(first_patterns)
+
+
+
+def _score_cells(cells):
+    """
+    Worker function to get the changes in the number of decisive triples for a chunk of cells.
+    """
+    return [_decisiveness_state.get_delta(otu, locus) for otu, locus in cells]
+
+
+
+class IncrementalDecisiveness(BitsetDecisiveness):
+    """
+    Keeps the number of decisive triples of a supermatrix up to date as sequences are added or
+    removed, and answers what-if questions about single cells without counting all triples again.
+    Adding a sequence for an OTU and locus makes the triples of the OTU with two other OTUs that
+    have the locus decisive, unless they already share another locus. The other OTUs are grouped
+    by coverage pattern and then by the loci they share with the OTU, so a cell costs at most
+    quadratic time in the number of distinct patterns.
+    """
+
+
+    decisive = None         # number of decisive triples, or None until it is first needed
+    total = 0               # number of triples
+    locus_patterns = []     # number of OTUs with each coverage pattern that includes each locus
+    num_cores = 1
+
+    def __init__(self, sequence_lengths, num_cores=1, decisive=None):
+        """
+        Input: a list with the sequence lengths of each OTU, a length of 0 meaning no sequence data,
+        and optionally the number of decisive triples if it is already known. Otherwise it is counted
+        on num_cores processes the first time PD is needed, changes in PD do not need it.
+        """
+        BitsetDecisiveness.__init__(self, sequence_lengths)
+        self.decisive = decisive
+        self.num_cores = num_cores
+        self.total = binomial_coefficient(len(self.coverage), 3)
+        self.locus_patterns = [{} for locus in self.locus_coverage]
+        for bits in self.coverage:
+            self.update_patterns(bits, 1)
+
+
+
+    def update_patterns(self, pattern, change):
+        """
+        Adds change to the number of OTUs with the coverage pattern, for each locus in the pattern.
+        """
+        for locus, patterns in enumerate(self.locus_patterns):
+            if pattern >> locus & 1:
+                patterns[pattern] = patterns.get(pattern, 0) + change
+                if patterns[pattern] == 0:
+                    del patterns[pattern]
+
+
+
+    def get_decisive(self):
+        """
+        Returns the number of decisive triples, counting them if need be.
+        """
+        if self.decisive is None:
+            sequence_lengths = [[bits >> locus & 1 for locus in range(len(self.locus_coverage))] for bits in self.coverage]
+            self.decisive = PatternDecisiveness(sequence_lengths).calculate(self.num_cores).decisive
+        return self.decisive
+
+
+
+    def get_PD(self):
+        """
+        Returns the fraction of triples that are decisive.
+        """
+        return self.get_decisive()/float(self.total)
+
+
+
+    def get_delta(self, otu, locus):
+        """
+        Returns the change in the number of decisive triples from adding a sequence for the OTU and
+        locus if it has none, or from removing it if it has one.
+        """
+        bit = 1 << locus
+        # the loci other than this one that the OTU has sequence data for
+        loci = self.coverage[otu] & ~bit
+        groups = {}
+        for pattern, size in self.locus_patterns[locus].items():
+            if pattern == self.coverage[otu]:
+                # not the OTU itself
+                size -= 1
+            if size > 0:
+                shared_loci = pattern & loci
+                groups[shared_loci] = groups.get(shared_loci, 0) + size
+        # triples whose other two OTUs share no other locus with the OTU depend on this cell
+        count = count_disjoint_pairs(groups, loci)
+        if self.coverage[otu] & bit:
+            return -count
+        return count
+
+
+
+    def get_PD_change(self, otu, locus):
+        """
+        Returns the exact change in PD from adding a sequence for the OTU and locus if it has none,
+        or from removing it if it has one.
+        """
+        return self.get_delta(otu, locus)/float(self.total)
+
+
+
+    def get_PD_changes(self, cells, num_cores=1):
+        """
+        Input: a list of (OTU index, locus index) cells.
+        Returns the change in PD for each cell, scoring chunks of cells on a pool of num_cores processes.
+        """
+        if num_cores > 1 and len(cells) > 1:
+            global _decisiveness_state
+            _decisiveness_state = self
+            chunk_size = max(1, len(cells) // (4 * num_cores))
+            pool = multiprocessing.Pool(num_cores)
+            results = pool.map(_score_cells, [cells[i:i + chunk_size] for i in range(0, len(cells), chunk_size)])
+            pool.close()
+            pool.join()
+            _decisiveness_state = None
+            deltas = [delta for result in results for delta in result]
+        else:
+            deltas = [self.get_delta(otu, locus) for otu, locus in cells]
+        return [delta/float(self.total) for delta in deltas]
+
+
+
+    def set_cell(self, otu, locus, present=True):
+        """
+        Adds or removes the sequence of the OTU for the locus, updating the number of decisive triples.
+        Returns the change in the number of decisive triples.
+        """
+        bit = 1 << locus
+        if bool(self.coverage[otu] & bit) == present:
+            return 0
+        delta = self.get_delta(otu, locus)
+        self.update_patterns(self.coverage[otu], -1)
+        self.coverage[otu] ^= bit
+        self.update_patterns(self.coverage[otu], 1)
+        self.locus_coverage[locus] ^= 1 << otu
+        if self.decisive is not None:
+            self.decisive += delta
+        return delta
+
+
+
+class AcquisitionPlanner(object):
+    """
+    Picks the missing sequences, cells of an OTU and locus, that most increase PD per cost when
+    sequenced, one after another. Upper bounds on the gains wait in a priority queue, and a gain is
+    only evaluated when its bound reaches the top. Filling a cell never raises the gain of a cell of
+    another locus, and raises the gain of the cells of its locus by at most the number of OTUs with
+    the locus, so the bounds hold and the plan is the same as evaluating every cell at each step.
+    """
+
+
+    incremental = None      # IncrementalDecisiveness of the supermatrix as the plan fills cells
+    costs = []              # the cost of sequencing each locus
+
+    def __init__(self, sequence_lengths, costs=None, num_cores=1, decisive=None):
+        """
+        Input: a list with the sequence lengths of each OTU, a length of 0 meaning no sequence data,
+        an optional list with the cost of each locus, and the number of decisive triples if it is
+        already known. Each locus costs 1 by default. Costs must be greater than 0.
+        """
+        self.incremental = IncrementalDecisiveness(sequence_lengths, num_cores, decisive)
+        self.costs = costs
+        if self.costs is None:
+            self.costs = [1] * len(self.incremental.locus_coverage)
+        if len(self.costs) != len(self.incremental.locus_coverage):
+            raise ValueError("Need a cost for each of the " + str(len(self.incremental.locus_coverage)) + " loci.")
+        if any(cost <= 0 for cost in self.costs):
+            raise ValueError("Locus costs must be greater than 0.")
+
+
+
+    def get_gain(self, otu, locus, cache):
+        """
+        Returns the number of triples filling the cell makes decisive, per cost of the locus.
+        OTUs with the same coverage pattern have the same gain, so gains are cached by pattern.
+        """
+        key = (self.incremental.coverage[otu], locus)
+        if key not in cache:
+            cache[key] = self.incremental.get_delta(otu, locus)/float(self.costs[locus])
+        return cache[key]
+
+
+
+    def plan(self, k):
+        """
+        Input: the number of cells to pick.
+        Returns a list of (OTU index, locus index, number of triples made decisive, PD after) for the
+        picked cells, in order. Stops early if no missing cell would increase PD.
+        """
+        incremental = self.incremental
+        step = 0
+        cache = {}
+        queue = []
+        bounds = {}         # upper bound on the number of triples each missing cell would make decisive
+        live = {}           # the queue entry of each missing cell that is up to date
+        entry = 0
+        for otu, bits in enumerate(incremental.coverage):
+            for locus in range(len(incremental.locus_coverage)):
+                if not bits & (1 << locus):
+                    # at most every pair of OTUs with the locus
+                    bounds[(otu, locus)] = binomial_coefficient(popcount(incremental.locus_coverage[locus]), 2)
+                    live[(otu, locus)] = entry
+                    queue.append((-bounds[(otu, locus)]/float(self.costs[locus]), otu, locus, entry, None))
+                    entry += 1
+        heapq.heapify(queue)
+        picked = []
+        while len(picked) < k and queue:
+            gain, otu, locus, number, evaluated = heapq.heappop(queue)
+            if live.get((otu, locus)) != number:
+                # filled, or pushed again since
+                continue
+            if evaluated != step:
+                bounds[(otu, locus)] = self.get_gain(otu, locus, cache) * self.costs[locus]
+                live[(otu, locus)] = entry
+                heapq.heappush(queue, (-bounds[(otu, locus)]/float(self.costs[locus]), otu, locus, entry, step))
+                entry += 1
+                continue
+            if gain >= 0:
+                break
+            num_otus = popcount(incremental.locus_coverage[locus])
+            delta = incremental.set_cell(otu, locus)
+            del live[(otu, locus)]
+            del bounds[(otu, locus)]
+            picked.append((otu, locus, delta, incremental.get_PD()))
+            step += 1
+            cache = {}
+            # the other OTUs missing this locus can now also complete triples with this OTU,
+            # every other cell can only lose gain
+            for other in range(len(incremental.coverage)):
+                if (other, locus) in live:
+                    bounds[(other, locus)] = min(bounds[(other, locus)] + num_otus, binomial_coefficient(num_otus + 1, 2))
+                    live[(other, locus)] = entry
+                    heapq.heappush(queue, (-bounds[(other, locus)]/float(self.costs[locus]), other, locus, entry, None))
+                    entry += 1
+        return picked
+
+
+
+class SampledDecisivenessCounts(DecisivenessCounts):
+    """
+    Triple counts from uniformly sampled triples, estimating the DecisivenessCounts of a supermatrix.
+    The counts of the triples without an OTU or not covered by a locus are the sampled triples of
+    that kind, so the OTU and locus decisiveness scores are estimated from the same samples.
+    """
+
+
+    num_samples = 0         # number of sampled triples
+    otu_samples = []        # number of sampled triples containing each OTU
+    locus_samples = []      # number of sampled triples with sequence data for each locus in all three OTUs
+
+    def __init__(self, num_otus, locus_otus):
+        DecisivenessCounts.__init__(self, num_otus, 0, [0] * num_otus, locus_otus)
+        self.num_samples = 0
+        self.otu_samples = [0] * num_otus
+        self.locus_samples = [0] * len(locus_otus)
+
+
+
+    def get_PD(self):
+        """
+        Returns the estimated fraction of triples that are decisive.
+        """
+        return self.decisive/float(self.num_samples)
+
+
+
+    def get_standard_error(self, z=1.96):
+        """
+        Returns the standard error of the estimated PD, as the half width of its Wilson score interval
+        over z. Unlike sqrt(pd * (1 - pd)/n), this is not 0 when all or none of the sampled triples
+        are decisive.
+        """
+        lower, upper = self.get_PD_interval(z)
+        return (upper - lower)/(2 * z)
+
+
+
+    @staticmethod
+    def get_interval(decisive, total, z=1.96):
+        """
+        Input: the number of decisive triples out of total sampled triples, and the normal quantile.
+        Returns the Wilson score interval of the fraction of decisive triples, 95% by default.
+        """
+        if total == 0:
+            return 0.0, 1.0
+        fraction = decisive/float(total)
+        center = (fraction + z * z/(2.0 * total))/(1 + z * z/float(total))
+        half_width = z * math.sqrt(fraction * (1 - fraction)/total + z * z/(4.0 * total * total))/(1 + z * z/float(total))
+        return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+
+    def get_PD_interval(self, z=1.96):
+        """
+        Returns the confidence interval of the estimated PD.
+        """
+        return self.get_interval(self.decisive, self.num_samples, z)
+
+
+
+    def get_OTU_counts(self, otu):
+        """
+        Returns the number of decisive sampled triples and the number of sampled triples without the
+        OTU at index otu.
+        """
+        return self.decisive - self.otu_decisive[otu], self.num_samples - self.otu_samples[otu]
+
+
+
+    def get_OTU_interval(self, otu, z=1.96):
+        """
+        Returns the confidence interval of the estimated PD without the OTU at index otu.
+        """
+        decisive, total = self.get_OTU_counts(otu)
+        return self.get_interval(decisive, total, z)
+
+
+
+    def get_locus_counts(self, locus):
+        """
+        Returns the number of decisive sampled triples and the number of sampled triples without
+        sequence data for the locus in all three OTUs.
+        """
+        return self.decisive - self.locus_samples[locus], self.num_samples - self.locus_samples[locus]
+
+
+
+    def get_locus_interval(self, locus, z=1.96):
+        """
+        Returns the confidence interval of the estimated PD without the locus.
+        """
+        decisive, total = self.get_locus_counts(locus)
+        return self.get_interval(decisive, total, z)
+
+
+
+class SampledDecisiveness(BitsetDecisiveness):
+    """
+    Estimates decisiveness from uniformly sampled triples of OTUs. Each sample costs the same
+    whatever the number of OTUs, so the running time is set by the number of samples.
+    """
+
+
+    generator = None        # the random number generator
+
+    def __init__(self, sequence_lengths, seed=None):
+        """
+        Input: a list with the sequence lengths of each OTU, a length of 0 meaning no sequence data,
+        and an optional seed for the random number generator.
+        """
+        BitsetDecisiveness.__init__(self, sequence_lengths)
+        self.generator = random.Random(seed)
+
+
+
+    def sample_triple(self):
+        """
+        Returns the indices of three distinct OTUs, chosen uniformly.
+        """
+        n = len(self.coverage)
+        i = self.generator.randrange(n)
+        j = self.generator.randrange(n)
+        while j == i:
+            j = self.generator.randrange(n)
+        k = self.generator.randrange(n)
+        while k == i or k == j:
+            k = self.generator.randrange(n)
+        return i, j, k
+
+
+
+    def iter_estimates(self, num_samples=100000, target_se=None, batch_size=1000):
+        """
+        Input: the maximum number of triples to sample, an optional standard error of PD to stop at,
+        and the number of triples sampled between estimates.
+        Yields the SampledDecisivenessCounts after each batch of samples. The same object is updated
+        and yielded again, so copy it to keep an intermediate estimate.
+        """
+        counts = SampledDecisivenessCounts(len(self.coverage), [popcount(otus) for otus in self.locus_coverage])
+        if len(self.coverage) < 3:
+            return
+        while counts.num_samples < num_samples:
+            for sample in range(min(batch_size, num_samples - counts.num_samples)):
+                triple = self.sample_triple()
+                shared_loci = self.coverage[triple[0]] & self.coverage[triple[1]] & self.coverage[triple[2]]
+                counts.num_samples += 1
+                for otu in triple:
+                    counts.otu_samples[otu] += 1
+                if shared_loci:
+                    counts.decisive += 1
+                    for otu in triple:
+                        counts.otu_decisive[otu] += 1
+                    while shared_loci:
+                        lowest = shared_loci & -shared_loci
+                        counts.locus_samples[lowest.bit_length() - 1] += 1
+                        shared_loci ^= lowest
+            yield counts
+            if target_se is not None and counts.get_standard_error() <= target_se:
+                break
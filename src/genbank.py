@@ -10,6 +10,7 @@ import os
 import sys
 import gzip
 import pickle
+import hashlib
 from Bio import Entrez
 from Bio import SeqIO
 from ftplib import FTP
@@ -243,3 +244,52 @@ class GenBankSearch(object):
             groups = pickle.load( open( "gb_search_results", "rb" ) )
             if self.ingroup == groups["ingroup"] and self.outgroup == groups["outgroup"]:
                 return True
+
+
+
+class SequenceDeduplicator(object):
+    """
+    Class responsible for collapsing identical sequences, so that only one copy
+    of each sequence is clustered.
+    """
+
+    unique_keys = []
+    duplicates = {}
+
+    def __init__(self, gb, seq_keys):
+        """
+        Takes as input a dictionary of SeqRecords gb and the keys to all sequences.
+        Finds the list of keys to unique sequences, and a dictionary that maps the key of each
+        unique sequence to the list of keys of its duplicates. Sequences are compared by hash.
+        Sequences from named species are preferred as the unique sequence, since sequences
+        from organisms such as "Genus sp." are not clustered by UCLUST.
+        """
+        self.unique_keys = []
+        self.duplicates = {}
+        unique = {}
+        position = {}
+        for key in seq_keys:
+            record = gb[key]
+            digest = hashlib.sha1(str(record.seq).upper().encode("ascii")).hexdigest()
+            named = "sp." not in record.annotations["organism"]
+            if digest not in unique:
+                unique[digest] = (key, named)
+                position[digest] = len(self.unique_keys)
+                self.unique_keys.append(key)
+                self.duplicates[key] = []
+            else:
+                first_key, first_named = unique[digest]
+                if named and not first_named:
+                    # swap in the sequence from a named species
+                    unique[digest] = (key, named)
+                    self.unique_keys[position[digest]] = key
+                    self.duplicates[key] = self.duplicates.pop(first_key) + [first_key]
+                else:
+                    self.duplicates[first_key].append(key)
+
+
+    def get_num_duplicates(self):
+        """
+        Returns the number of sequences collapsed into the unique sequences.
+        """
+        return sum([len(keys) for keys in self.duplicates.values()])
@@ -9,12 +9,16 @@ License: GNU GPLv3 http://www.gnu.org/licenses/gpl.html
 import os
 import sys
 import csv
-import multiprocessing
+import copy
+import mmap
+import pickle
 from collections import OrderedDict
 from Bio import Entrez
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+from alignments import AlignmentSummary
+from decisiveness import PatternDecisiveness, SampledDecisiveness, IncrementalDecisiveness, AcquisitionPlanner
 from util import Color
 
 
@@ -30,11 +34,16 @@ class Supermatrix(object):
     pd = None           # fraction of triples, a measure of the partial decisiveness of a supermatrix
     missing_data = None # % of sequence data missing
     loci = None
+    matrix = None       # BinaryMatrix of the supermatrix
+    pd_estimate = None  # SampledDecisivenessCounts if pd was estimated from sampled triples
+    decisive = None     # number of decisive triples, if pd was calculated exactly
+    incremental = None  # IncrementalDecisiveness of the supermatrix, built once by get_PD_changes
 
 
-    def __init__(self, alignments=None):
+    def __init__(self, alignments=None, out_of_core=False, matrix=None):
         """
-        Optionally accept an Alignment object.
+        Optionally accept an Alignment object, and whether to concatenate it out of core,
+        or a BinaryMatrix saved by a previous run to load instead of concatenating the alignments.
         """
         self.file = ""
         self.otus = {}
@@ -45,58 +54,64 @@ class Supermatrix(object):
         self.highest_locus_decisiveness_score = 0
         self.lowest_OTU_decisiveness_score = 0
         self.lowest_locus_decisiveness_score = 0
-        if alignments is not None:
-            self.concatenate(alignments)
+        self.matrix = None
+        self.pd_estimate = None
+        self.decisive = None
+        self.incremental = None
+        if matrix is not None:
+            self.load_matrix(matrix)
+        elif alignments is not None:
+            if out_of_core:
+                self.concatenate_out_of_core(alignments)
+            else:
+                self.concatenate(alignments)
 
 
 
     def concatenate(self, alignments):
         """
         Builds a supermatrix from a set of alignments.
+        If the summaries keep the sequences, as for trimmed alignments, each summary drops its sequences
+        once they are copied into the supermatrix. Otherwise each alignment is read as it is copied.
         """
+        summaries = alignments.get_summaries()
         otus = {}
-        for alignment in alignments.files:
-            records = SeqIO.parse(alignment, "fasta")
-            for record in records:
-                if alignments.user_provided:
-                    otu = record.description
-                else:
-                    # sample record.description:
-                    # AF495760.1 Lythrum salicaria chloroplast ribulose 1,5-bisphosphate carboxylase/oxygenase large subunit-like mRNA, partial sequence
-                    descriptors = record.description.split(" ")
-                    otu = descriptors[1] + " " + descriptors[2]
-                if otu not in otus.keys():
+        for summary in summaries:
+            for otu in summary.otus:
+                if otu not in otus:
                     otus[otu] = Otu(otu)
 
-        # now concatenate the sequences
-        total_length = 0
-        for alignment in alignments.files: 
-            records = SeqIO.parse(alignment, "fasta")
-            # make sure to only add 1 sequence per cluster for each otu
-            already_added = []
+        # each OTU row of the supermatrix is preallocated as missing data ('?')
+        # and filled one locus block at a time
+        total_length = sum(summary.length for summary in summaries)
+        for otu in otus:
+            otus[otu].allocate(total_length, len(summaries))
+
+        start = 0
+        for locus, summary in enumerate(summaries):
+            alignment = summary.file
+            loci_length = summary.length
+            # the summary has only 1 sequence per cluster for each otu
+            locus_summary = summary
+            if not alignments.keep_sequences:
+                locus_summary = AlignmentSummary(alignment, alignments.user_provided)
             records_for_loci = []
-            for record in records:
-                if alignments.user_provided:
-                    otu = record.description
-                else:
-                    descriptors = record.description.split(" ")
-                    otu = descriptors[1] + " " + descriptors[2]
-                if otu not in already_added:
-                    records_for_loci.append(SeqRecord(record.seq, id=otu, description=""))
-                    if alignments.user_provided:
-                        otus[otu].update(record.seq, alignment, self.get_ungapped_length(record.seq))
-                    else:
-                        otus[otu].update(record.seq, descriptors[0], self.get_ungapped_length(record.seq))
-                    already_added.append(otu)
-                loci_length = len(record.seq)
-            total_length += loci_length
-            
+            present = set()
+            for otu, accession, sequence, ungapped_length in zip(locus_summary.otus, locus_summary.accessions, \
+                                                                 locus_summary.sequences, locus_summary.ungapped_lengths):
+                records_for_loci.append(SeqRecord(Seq(sequence), id=otu, description=""))
+                otus[otu].set_locus(locus, start, sequence, accession, ungapped_length)
+                present.add(otu)
+            start += loci_length
+            # the sequences of this locus are held by the supermatrix now
+            summary.sequences = []
+            locus_summary = None
+
             # add '?' for any OTU that didn't have a sequence
+            missing_seq = self.make_missing(loci_length)
             for otu in otus:
-                if len(otus[otu].sequence) < total_length:
-                    missing_seq = self.make_missing(loci_length)
+                if otu not in present:
                     records_for_loci.append(SeqRecord(Seq(missing_seq), id=otu, description=""))
-                    otus[otu].update(missing_seq, "-", 0)
             
             # make fasta file of this loci
             alignment_out = alignment.split("/")
@@ -123,17 +138,129 @@ class Supermatrix(object):
         self.file = "alignments/supermatrix_concatenated.fasta"
         self.otus = otus
 
+        # write the binary matrix
+        with open(BinaryMatrix.FILE, "wb") as f:
+            for otu in otus:
+                f.write(otus[otu].sequence)
+        self.write_matrix(alignments, summaries)
+
+
+
+    def concatenate_out_of_core(self, alignments, matrix_file="alignments/supermatrix_matrix.tmp"):
+        """
+        Builds a supermatrix from a set of alignments without holding the sequences in memory.
+        The OTU rows are preallocated as missing data ('?') in a memory-mapped file, each alignment
+        is read and copied into its column block. The file becomes the binary matrix, and the FASTA and
+        PHYLIP files of the supermatrix are streamed from it. Peak memory is bounded by the largest alignment.
+        The OTUs keep their accessions and sequence lengths, but not their sequences.
+        """
+        alignments.keep_sequences = False
+        summaries = alignments.get_summaries()
+        otus = {}
+        for summary in summaries:
+            for otu in summary.otus:
+                if otu not in otus:
+                    otus[otu] = Otu(otu)
+                    otus[otu].allocate(0, len(summaries))
+        names = sorted(otus.keys())
+        rows = dict((otu, i) for i, otu in enumerate(names))
+        total_length = sum(summary.length for summary in summaries)
+        if len(names) == 0 or total_length == 0:
+            alignments.keep_sequences = True
+            alignments.summaries = None
+            self.concatenate(alignments)
+            return
+
+        with open(matrix_file, "wb") as f:
+            missing_row = b"?" * total_length
+            for otu in names:
+                f.write(missing_row)
+        f = open(matrix_file, "r+b")
+        matrix = mmap.mmap(f.fileno(), 0)
+        try:
+            start = 0
+            for locus, summary in enumerate(summaries):
+                alignment = summary.file
+                loci_length = summary.length
+                # read this alignment only, keeping 1 sequence per cluster for each otu
+                locus_summary = AlignmentSummary(alignment, alignments.user_provided)
+                sequences = {}
+                for otu, accession, sequence, ungapped_length in zip(locus_summary.otus, locus_summary.accessions, \
+                                                                     locus_summary.sequences, locus_summary.ungapped_lengths):
+                    offset = rows[otu] * total_length + start
+                    matrix[offset:offset + len(sequence)] = sequence
+                    otus[otu].set_locus(locus, start, None, accession, ungapped_length)
+                    sequences[otu] = sequence
+                start += loci_length
+
+                # make fasta file of this loci, with '?' for any OTU that didn't have a sequence
+                missing_seq = self.make_missing(loci_length)
+                alignment_out = alignment.split("/")
+                out = open("alignments/supermatrix_" + alignment_out[len(alignment_out)-1], "w")
+                SeqIO.write((SeqRecord(Seq(sequences.get(otu, missing_seq)), id=otu, description="") for otu in names), out, "fasta")
+                out.close()
+        finally:
+            matrix.close()
+            f.close()
+        os.rename(matrix_file, BinaryMatrix.FILE)
+        self.file = "alignments/supermatrix_concatenated.fasta"
+        self.otus = OrderedDict((otu, otus[otu]) for otu in names)
+
+        # stream the FASTA and PHYLIP files from the binary matrix
+        self.write_matrix(alignments, summaries)
+        self.matrix.export_fasta(self.file)
+        self.matrix.export_phylip("alignments/supermatrix_concatenated.phy")
+
+
+
+    def write_matrix(self, alignments, summaries):
+        """
+        Writes the sidecar of the binary matrix, holding the OTU names, the loci, the accessions and
+        sequence lengths of each OTU, and the alignment summaries without their sequences, then loads it.
+        """
+        loci = []
+        start = 0
+        light_summaries = []
+        for summary in summaries:
+            loci.append((summary.file, start, summary.length))
+            start += summary.length
+            summary = copy.copy(summary)
+            summary.sequences = []
+            light_summaries.append(summary)
+        names = list(self.otus.keys())
+        accessions = dict((otu, self.otus[otu].accessions) for otu in names)
+        sequence_lengths = dict((otu, self.otus[otu].sequence_lengths) for otu in names)
+        matrix = BinaryMatrix(BinaryMatrix.FILE, names, loci, accessions, sequence_lengths, light_summaries,
+                              BinaryMatrix.get_sources(alignments.files), alignments.max_gap_fraction)
+        matrix.write_sidecar()
+        self.matrix = BinaryMatrix.load(BinaryMatrix.FILE)
+
+
+
+    def load_matrix(self, matrix):
+        """
+        Loads the OTUs of the supermatrix from a BinaryMatrix instead of concatenating the alignments,
+        writing the FASTA file of the supermatrix from it if it is missing.
+        """
+        otus = OrderedDict()
+        for otu in matrix.names:
+            otus[otu] = Otu(otu)
+            otus[otu].accessions = matrix.accessions[otu]
+            otus[otu].sequence_lengths = matrix.sequence_lengths[otu]
+        self.otus = otus
+        self.matrix = matrix
+        self.file = "alignments/supermatrix_concatenated.fasta"
+        if not os.path.exists(self.file):
+            matrix.export_fasta(self.file)
+
 
 
     def make_missing(self, length):
         """
         Inputs an integer.
-        Returns a string of '-' of length
+        Returns a string of '?' of length
         """
-        gap = ""
-        for i in range(length):
-            gap = "?" + gap
-        return gap
+        return "?" * length
 
 
 
@@ -141,11 +268,8 @@ class Supermatrix(object):
         """
         Inputs a sequence, and returns the length of the sequence minus any gaps ('-')
         """
-        length = 0
-        for i in sequence:
-            if i != "-":
-                length += 1
-        return length
+        sequence = str(sequence)
+        return len(sequence) - sequence.count("-")
 
 
 
@@ -156,19 +280,28 @@ class Supermatrix(object):
         # TODO: make the output of this more useful
         color = Color()
         print(color.blue + "Supermatrix attributes:")
-        records = SeqIO.parse(self.file, "fasta")
         num_records = 0
         total_missing = 0
-        for record in records:
-            otu = record.description
-            missing = 0
-            for letter in record.seq:
-                if letter == '?':
-                    missing += 1
-                    total_missing += 1
-            print(color.yellow + "OTU: " + color.red + otu + color.yellow + " % missing data = " + color.red + str(round(missing/float(len(record.seq)), 2)))
-            num_records += 1
-            matrix_length = len(record.seq)
+        matrix_length = 0
+        if self.matrix is not None:
+            # count missing data in each row of the binary matrix
+            matrix_length = self.matrix.num_sites
+            for i, otu in enumerate(self.matrix.names):
+                missing = 0
+                for chunk in self.matrix.iter_row(i):
+                    missing += chunk.count(b"?")
+                total_missing += missing
+                print(color.yellow + "OTU: " + color.red + otu + color.yellow + " % missing data = " + color.red + str(round(missing/float(matrix_length), 2)))
+                num_records += 1
+        else:
+            records = SeqIO.parse(self.file, "fasta")
+            for record in records:
+                otu = record.description
+                missing = str(record.seq).count("?")
+                total_missing += missing
+                print(color.yellow + "OTU: " + color.red + otu + color.yellow + " % missing data = " + color.red + str(round(missing/float(len(record.seq)), 2)))
+                num_records += 1
+                matrix_length = len(record.seq)
         print(color.blue + "Total number of OTUs = " + color.red + str(num_records))
         print(color.blue + "Total length of matrix = " + color.red + str(matrix_length))
         print(color.blue + "Taxon coverage density = " + color.red + str(self.get_coverage_density()))
@@ -178,12 +311,16 @@ class Supermatrix(object):
 
 
 
-    def print_PD(self):
+    def print_PD(self, num_cores=1):
         """
-        Prints partial decisiveness.
+        Prints partial decisiveness, calculating it on num_cores processes if need be.
         """
         color = Color()
-        print(color.blue + "Partial decisiveness (fraction of triples) = " + color.red + str(self.get_PD()) + color.done)
+        print(color.blue + "Partial decisiveness (fraction of triples) = " + color.red + str(self.get_PD(num_cores)) + color.done)
+        if self.pd_estimate is not None:
+            lower, upper = self.pd_estimate.get_PD_interval()
+            print(color.blue + "Estimated from " + color.red + str(self.pd_estimate.num_samples) + color.blue + " sampled triples, 95% CI " + \
+                color.red + str(round(lower, 4)) + "-" + str(round(upper, 4)) + color.done)
 
 
 
@@ -247,6 +384,30 @@ class Supermatrix(object):
 
 
 
+    def make_acquisition_csv(self, k, costs=None, num_cores=1):
+        """
+        Method to generate a CSV file ranking the k missing sequences that would most increase PD
+        per cost if sequenced, each picked after the ones ranked above it were added.
+        Input: the number of missing sequences to rank, and an optional list with the cost of each gene region.
+        """
+        color = Color()
+        names = list(self.otus)
+        planner = AcquisitionPlanner([self.otus[name].sequence_lengths for name in names], costs, num_cores, self.decisive)
+        print(color.blue + "Ranking missing sequences to acquire..." + color.done)
+        with open('sequence_acquisition_plan.csv', 'wb') as csv_output:
+            csvwriter = csv.writer(csv_output)
+            header = ["Rank", "OTU", "Gene Region", "Cost", "PD Increase", "PD"]
+            csvwriter.writerow(header)
+            rank = 1
+            for otu, locus, delta, pd in planner.plan(k):
+                row = [str(rank), self.otus[names[otu]].name, str(locus + 1), str(planner.costs[locus])]
+                row.append(str(round(delta/float(planner.incremental.total), 4)))
+                row.append(str(round(pd, 4)))
+                csvwriter.writerow(row)
+                rank += 1
+
+
+
     def normalize(self):
         """
         function to normalize the sequence length data - this is necessary for plotting the data
@@ -450,103 +611,111 @@ class Supermatrix(object):
 
 
 
-    def get_PD(self):
+    def get_PD(self, num_cores=1):
         """
         method to get pd of supermatrix, calculating it if need be.
         """
         if self.pd == None:
-            self.pd = self.calculate_PD()
+            self.pd = self.calculate_PD(num_cores)
             self.calculate_OTU_decisiveness_scores()
             self.calculate_locus_decisiveness_scores()
         return self.pd
 
 
 
-    def calculate_PD(self):
+    def calculate_PD(self, num_cores=1):
         """
         Method to calculate the fraction of triples, a measure of partial decisiveness (PD).
         See: Sanderson, M.J., McMahon, M.M. & Steel, M., 2010. BMC evolutionary biology, 10. 
+        Counts decisive triples over the coverage patterns of PatternDecisiveness, on num_cores
+        processes, and sets the counts behind the OTU and locus decisiveness scores.
         """
         color = Color()
-        decisive_triples = 0
-        total_triples = 0
-        total = self.binomial_coefficient(len(self.otus), 3)
-        i = 0
-        # nested loops to run through every possible triplet
-        for otu1 in self.otus:
-            if i < (len(self.otus) - 2):
-                j = 0
-                for otu2 in self.otus:
-                    if i < j:
-                        k = 0
-                        for otu3 in self.otus:
-                            if j < k:
-                                sys.stdout.write("\r" + color.blue + "Calculating PD: " + color.red + str(round(100 * total_triples/float(total), 4)) + \
-                                    "% " + color.blue + "finished" + color.done)
-                                sys.stdout.flush()
-                                # do PD calculations for this triplet
-                                triplet = [otu1, otu2, otu3]
-                                decisive, decisive_loci = self.calculate_triplet_PD(triplet)
-                                decisive_triples += decisive
-                                total_triples += 1
-                                # triplet calculations for OTU and loci decisiveness scores
-                                self.update_OTU_decisiveness(triplet, decisive)
-                                self.update_locus_decisiveness(decisive_loci, decisive)
-                            k += 1
-                    j += 1
-            i += 1
+        sys.stdout.write(color.blue + "Calculating PD..." + color.done)
+        sys.stdout.flush()
+        counts = PatternDecisiveness([self.otus[otu].sequence_lengths for otu in self.otus]).calculate(num_cores)
+        self.decisive = counts.decisive
+        self.set_decisiveness_counts(counts)
         sys.stdout.write("\r" + color.blue + "Calculating PD: " + color.red + "100.00% " + color.blue + "finished\n" + color.done)
         sys.stdout.flush()
-        return round(decisive_triples/float(total_triples), 2)
-    
+        return round(counts.get_PD(), 2)
+
 
 
-    def calculate_PD_parallel(self, num_cores):
+    def estimate_PD(self, num_samples=100000, target_se=None, seed=None):
         """
-        Method to calculate the fraction of triples, a measure of partial decisiveness (PD).
-        See: Sanderson, M.J., McMahon, M.M. & Steel, M., 2010. BMC evolutionary biology, 10. 
+        Method to estimate PD and the OTU and locus decisiveness scores from uniformly sampled triples,
+        printing the estimate and its 95% confidence interval as samples accumulate.
+        Input: the maximum number of triples to sample, and an optional standard error of PD to stop at.
         """
         color = Color()
-        lock = multiprocessing.Lock()
-        manager = multiprocessing.Manager()
-        #already_compared = manager.list()
-        #dist_matrix = manager.list()
-        otus_shared = manager.dict()
-        otus_shared = otus
-        decisive_triples = manager.Value('i', 0)
-        total_triples = manager.Value('i', 0)
-        total = self.binomial_coefficient(len(self.otus), 3)
+        sampler = SampledDecisiveness([self.otus[otu].sequence_lengths for otu in self.otus], seed)
+        counts = None
+        for counts in sampler.iter_estimates(num_samples, target_se):
+            lower, upper = counts.get_PD_interval()
+            sys.stdout.write("\r" + color.blue + "Estimating PD: " + color.red + str(round(counts.get_PD(), 4)) + color.blue + " (95% CI " + \
+                color.red + str(round(lower, 4)) + "-" + str(round(upper, 4)) + color.blue + ") from " + color.red + str(counts.num_samples) + \
+                color.blue + " triples" + color.done)
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+        if counts is None:
+            print(color.red + "Need at least 3 OTUs to estimate PD." + color.done)
+            return None
+        self.pd_estimate = counts
+        self.set_decisiveness_counts(counts)
+        self.pd = round(counts.get_PD(), 2)
+        self.calculate_OTU_decisiveness_scores()
+        self.calculate_locus_decisiveness_scores()
+        return self.pd
 
-        for i in range(num_cores):
-            p = multiprocessing.Process(target=calculate_PD_worker, args=(lock, i, num_cores, decisive_triples, total_triples, total, otus_shared))
-            p.start()
-            processes.append(p)
 
-        for p in processes:
-            p.join()
-        
-        self.otus = otus_shared
 
-        sys.stdout.write("\r" + color.blue + "Calculating PD: " + color.red + "100.00% " + color.blue + "finished\n" + color.done)
-        sys.stdout.flush()
-        return round(decisive_triples/float(total_triples), 2)
+    def set_decisiveness_counts(self, counts):
+        """
+        Input: the DecisivenessCounts of the supermatrix, with OTUs in the order of self.otus.
+        Sets other_decisive_triples and other_total_triples of each OTU and locus.
+        """
+        for i, otu in enumerate(self.otus):
+            self.otus[otu].other_decisive_triples, self.otus[otu].other_total_triples = counts.get_OTU_counts(i)
+        self.loci = {}
+        for locus in range(len(counts.locus_otus)):
+            self.loci[locus] = list(counts.get_locus_counts(locus))
 
 
 
-    def calculate_PD_worker(self, lock, process_num, num_cores, decisive_triples, total_triples, total, otus):
+    def get_PD_changes(self, cells, num_cores=1):
         """
-        Worker function to help calculate fraction of triples
+        Method to find out what sequencing a missing sequence would do to PD, without calculating it again.
+        Input: a list of (OTU name, locus index) cells.
+        Returns the exact change in PD from adding a sequence for each cell without one,
+        or from removing the sequence of each cell with one.
         """
-        self.otus = otus
+        names = list(self.otus)
+        if self.incremental is None:
+            self.incremental = IncrementalDecisiveness([self.otus[name].sequence_lengths for name in names], num_cores, self.decisive)
+        index = dict((name, i) for i, name in enumerate(names))
+        return self.incremental.get_PD_changes([(index[otu], locus) for otu, locus in cells], num_cores)
+
+
+
+    def calculate_PD_by_triples(self):
+        """
+        Method to calculate the fraction of triples by looping through every triplet.
+        This is much slower than calculate_PD, and is kept as a reference to check it against.
+        """
+        color = Color()
+        decisive_triples = 0
+        total_triples = 0
+        total = self.binomial_coefficient(len(self.otus), 3)
+        i = 0
         # nested loops to run through every possible triplet
-        i = process_num
         for otu1 in self.otus:
             if i < (len(self.otus) - 2):
                 j = 0
-                for otu2 in otus:
+                for otu2 in self.otus:
                     if i < j:
                         k = 0
-                        for otu3 in otus:
+                        for otu3 in self.otus:
                             if j < k:
                                 sys.stdout.write("\r" + color.blue + "Calculating PD: " + color.red + str(round(100 * total_triples/float(total), 4)) + \
                                     "% " + color.blue + "finished" + color.done)
@@ -554,16 +723,18 @@ class Supermatrix(object):
                                 # do PD calculations for this triplet
                                 triplet = [otu1, otu2, otu3]
                                 decisive, decisive_loci = self.calculate_triplet_PD(triplet)
-                                with lock:
-                                    decisive_triples += decisive
-                                    total_triples += 1
+                                decisive_triples += decisive
+                                total_triples += 1
                                 # triplet calculations for OTU and loci decisiveness scores
                                 self.update_OTU_decisiveness(triplet, decisive)
                                 self.update_locus_decisiveness(decisive_loci, decisive)
                             k += 1
                     j += 1
-            i += num_cores
-
+            i += 1
+        sys.stdout.write("\r" + color.blue + "Calculating PD: " + color.red + "100.00% " + color.blue + "finished\n" + color.done)
+        sys.stdout.flush()
+        return round(decisive_triples/float(total_triples), 2)
+    
 
 
     def calculate_triplet_PD(self, triplet):
@@ -594,7 +765,7 @@ class Supermatrix(object):
             i += 1
         return decisive, decisive_loci
 
-    # TODO: make parallel version of the following three functions:
+
 
     def update_OTU_decisiveness(self, triplet, decisive):
         """
@@ -729,6 +900,173 @@ class Supermatrix(object):
 
 
 
+class BinaryMatrix(object):
+    """
+    A supermatrix saved as a binary file of one byte per site, one row of sites per OTU, and a pickled
+    sidecar file holding the OTU names, the loci, the accessions and sequence lengths of each OTU, and
+    the alignment summaries. The binary file is memory-mapped, so loading it does not read the matrix,
+    and the exporters stream it in chunks.
+    """
+
+
+    FILE = "alignments/supermatrix.bin"
+
+    file = ""
+    names = []              # OTU names, in the order of the rows
+    loci = []               # (alignment file, first site, number of sites) of each locus
+    accessions = {}         # accessions of each OTU
+    sequence_lengths = {}   # sequence lengths of each OTU
+    summaries = []          # AlignmentSummary of each locus, without sequences
+    sources = []            # (alignment file, size, modification time) of each alignment
+    max_gap_fraction = None # the gap fraction the alignments were trimmed with, or None if not trimmed
+    num_sites = 0
+    data = None             # memory-mapped binary file
+
+    def __init__(self, file_name, names, loci, accessions, sequence_lengths, summaries, sources, max_gap_fraction=None):
+        self.file = file_name
+        self.names = names
+        self.loci = loci
+        self.accessions = accessions
+        self.sequence_lengths = sequence_lengths
+        self.summaries = summaries
+        self.sources = sources
+        self.max_gap_fraction = max_gap_fraction
+        self.num_sites = sum(length for alignment, start, length in loci)
+        self.data = None
+
+
+
+    def write_sidecar(self):
+        """
+        Writes the sidecar file, the binary file name followed by .pickle.
+        """
+        data = {"names": self.names, "loci": self.loci, "accessions": self.accessions,
+                "sequence_lengths": self.sequence_lengths, "summaries": self.summaries, "sources": self.sources,
+                "max_gap_fraction": self.max_gap_fraction}
+        out = open(self.file + ".pickle", "wb")
+        pickle.dump(data, out, pickle.HIGHEST_PROTOCOL)
+        out.close()
+
+
+
+    @staticmethod
+    def load(file_name=None):
+        """
+        Loads a binary matrix and its sidecar file, memory-mapping the binary file.
+        Returns None if they do not exist.
+        """
+        if file_name is None:
+            file_name = BinaryMatrix.FILE
+        if not os.path.exists(file_name) or not os.path.exists(file_name + ".pickle"):
+            return None
+        data = pickle.load(open(file_name + ".pickle", "rb"))
+        matrix = BinaryMatrix(file_name, data["names"], data["loci"], data["accessions"], data["sequence_lengths"],
+                              data["summaries"], data["sources"], data.get("max_gap_fraction"))
+        if os.path.getsize(file_name) != len(matrix.names) * matrix.num_sites:
+            return None
+        if os.path.getsize(file_name) > 0:
+            with open(file_name, "rb") as f:
+                matrix.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return matrix
+
+
+
+    @staticmethod
+    def load_for(alignment_files, file_name=None, max_gap_fraction=None):
+        """
+        Loads the binary matrix if it was built from alignment_files, they have not changed since,
+        and they were trimmed with the same max_gap_fraction, None meaning not trimmed.
+        Returns None otherwise.
+        """
+        matrix = BinaryMatrix.load(file_name)
+        if matrix is None or matrix.sources != BinaryMatrix.get_sources(alignment_files):
+            return None
+        if matrix.max_gap_fraction != max_gap_fraction:
+            matrix.close()
+            return None
+        return matrix
+
+
+
+    @staticmethod
+    def get_sources(alignment_files):
+        """
+        Returns the (file, size, modification time) of each alignment file.
+        """
+        sources = []
+        for alignment in alignment_files:
+            stat = os.stat(alignment)
+            sources.append((alignment, stat.st_size, stat.st_mtime))
+        return sources
+
+
+
+    def iter_row(self, row, chunk_size=1048576):
+        """
+        Yields the sites of a row of the matrix in chunks of chunk_size bytes.
+        """
+        offset = row * self.num_sites
+        i = 0
+        while i < self.num_sites:
+            yield self.data[offset + i:offset + min(i + chunk_size, self.num_sites)]
+            i += chunk_size
+
+
+
+    def export_fasta(self, file_name, wrap=80):
+        """
+        Writes the matrix in FASTA format, in lines of wrap sites.
+        """
+        with open(file_name, "w") as out:
+            for row, otu in enumerate(self.names):
+                out.write("> " + otu + "\n")
+                for chunk in self.iter_row(row, wrap):
+                    out.write(chunk + "\n")
+
+
+
+    def export_phylip(self, file_name):
+        """
+        Writes the matrix in relaxed sequential PHYLIP format, with spaces in OTU names replaced by '_'.
+        """
+        with open(file_name, "w") as out:
+            out.write(str(len(self.names)) + " " + str(self.num_sites) + "\n")
+            for row, otu in enumerate(self.names):
+                out.write(otu.replace(" ", "_") + " ")
+                for chunk in self.iter_row(row):
+                    out.write(chunk)
+                out.write("\n")
+
+
+
+    def export_nexus(self, file_name):
+        """
+        Writes the matrix in NEXUS format, with a character set for each locus.
+        """
+        with open(file_name, "w") as out:
+            out.write("#NEXUS\n\nBEGIN DATA;\n")
+            out.write("    DIMENSIONS NTAX=" + str(len(self.names)) + " NCHAR=" + str(self.num_sites) + ";\n")
+            out.write("    FORMAT DATATYPE=DNA MISSING=? GAP=-;\n    MATRIX\n")
+            for row, otu in enumerate(self.names):
+                out.write("    '" + otu.replace("'", "''") + "' ")
+                for chunk in self.iter_row(row):
+                    out.write(chunk)
+                out.write("\n")
+            out.write("    ;\nEND;\n\nBEGIN SETS;\n")
+            for i, (alignment, start, length) in enumerate(self.loci):
+                if length > 0:
+                    out.write("    CHARSET locus" + str(i + 1) + " = " + str(start + 1) + "-" + str(start + length) + ";\n")
+            out.write("END;\n")
+
+
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+
 class Otu(object):
     """
     Class responsible for managing the data of each OTU in the supermatrix
@@ -736,7 +1074,7 @@ class Otu(object):
 
     
     name = ""               # the name of the OTU
-    sequence = ""           # the full aligned sequence for this OTU in the supermatrix
+    sequence = bytearray()  # the full aligned sequence for this OTU in the supermatrix
     accessions = []         # list of each GenBank accession used where "-" means no sequence for that region
     sequence_lengths = []   # list of the length of each sequence
     other_decisive_triples = None
@@ -749,7 +1087,7 @@ class Otu(object):
         Takes as input the name of the OTU
         """
         self.name = name
-        self.sequence = ""
+        self.sequence = bytearray()
         self.accessions = []
         self.sequence_lengths = []
         self.other_decisive_triples = None
@@ -761,16 +1099,39 @@ class Otu(object):
         """
         Inputs the aligned sequence (gaps already added), the accession #, and the unaligned sequence length.
         """
-        self.sequence = self.sequence + sequence
+        self.sequence.extend(str(sequence))
         self.accessions.append(accession)
         self.sequence_lengths.append(sequence_length)
 
 
 
+    def allocate(self, length, num_loci):
+        """
+        Sets the sequence to length characters of missing data ('?'), and each of the num_loci
+        accessions to missing ("-"), to be filled by set_locus.
+        """
+        self.sequence = bytearray(b"?") * length
+        self.accessions = ["-"] * num_loci
+        self.sequence_lengths = [0] * num_loci
+
+
+
+    def set_locus(self, locus, start, sequence, accession, sequence_length):
+        """
+        Inputs the index of a locus, the column where it starts in the supermatrix, the aligned sequence
+        (or None to not store it), the accession #, and the unaligned sequence length.
+        """
+        if sequence is not None:
+            self.sequence[start:start + len(sequence)] = str(sequence)
+        self.accessions[locus] = accession
+        self.sequence_lengths[locus] = sequence_length
+
+
+
     def print_data(self):
         color = Color()
         print(color.blue + "Name = " + color.red + self.name)
-        print(color.blue + "Sequence = " + color.red + self.sequence)
+        print(color.blue + "Sequence = " + color.red + str(self.sequence))
         print(color.blue + "Accessions = "  + color.red)
         print(self.accessions)
         print(color.blue + "Sequence_lengths = " + color.red)
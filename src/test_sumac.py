@@ -24,6 +24,654 @@ class SumacTest(unittest.TestCase):
 
 
 
+    def test_alignment_scheduler(self):
+        # jobs start largest first and never use more than num_cores threads in total
+        import threading
+        import time
+        from alignments import AlignmentScheduler
+        lock = threading.Lock()
+        state = {"used": 0, "max_used": 0, "started": [], "threads": {}}
+        def worker(job, threads):
+            with lock:
+                state["used"] += threads
+                state["max_used"] = max(state["max_used"], state["used"])
+                state["started"].append(job)
+                state["threads"][job] = threads
+            time.sleep(0.01)
+            with lock:
+                state["used"] -= threads
+            return job + ".aln"
+        jobs = ["small", "huge", "medium", "tiny"]
+        scheduler = AlignmentScheduler(jobs, [10, 1000, 50, 1], 4)
+        self.assertEqual(scheduler.run(worker), ["small.aln", "huge.aln", "medium.aln", "tiny.aln"])
+        self.assertEqual(state["started"][0], "huge")
+        self.assertTrue(state["threads"]["huge"] > 1)
+        self.assertTrue(state["max_used"] <= 4)
+
+
+    def test_alignment_memory_budget(self):
+        # large jobs wait for memory while smaller jobs that fit keep the cores busy
+        import threading
+        import time
+        from alignments import AlignmentScheduler
+        lock = threading.Lock()
+        state = {"memory": 0, "max_memory": 0, "started": []}
+        memory = {"big1": 60, "big2": 60, "small1": 10, "small2": 10}
+        def worker(job, threads):
+            with lock:
+                state["memory"] += memory[job]
+                state["max_memory"] = max(state["max_memory"], state["memory"])
+                state["started"].append(job)
+            time.sleep(0.02)
+            with lock:
+                state["memory"] -= memory[job]
+            return job
+        jobs = ["small1", "big1", "small2", "big2"]
+        scheduler = AlignmentScheduler(jobs, [1, 100, 2, 90], 4, [memory[job] for job in jobs], 80)
+        self.assertEqual(scheduler.run(worker), jobs)
+        self.assertEqual(state["started"][:3], ["big1", "small2", "small1"])
+        self.assertTrue(state["max_memory"] <= 80)
+
+
+    def test_mafft_strategy_policy(self):
+        from alignments import MafftStrategyPolicy
+        policy = MafftStrategyPolicy()
+        self.assertEqual(policy.select(5000, 1500), ("auto", ["--auto"], None))
+        policy = MafftStrategyPolicy(MafftStrategyPolicy.SIZE)
+        self.assertEqual(policy.select(20, 1500)[0], "L-INS-i")
+        self.assertEqual(policy.select(20, 8000)[0], "FFT-NS-2")
+        self.assertEqual(policy.select(500, 1500)[0], "FFT-NS-2")
+        self.assertEqual(policy.select(5000, 1500)[0], "FFT-NS-1")
+        self.assertEqual(policy.select(50000, 1500)[:2], ("PartTree", ["--parttree", "--retree", "1"]))
+
+
+    def test_alignment_cache(self):
+        import os
+        import shutil
+        import tempfile
+        import time
+        from alignments import AlignmentCache
+        tmp = tempfile.mkdtemp()
+        try:
+            cluster_file = os.path.join(tmp, "1.fasta")
+            alignment_file = os.path.join(tmp, "1.aln")
+            with open(cluster_file, "w") as f:
+                f.write(">a\nACGT\n>b\nACGA\n")
+            with open(alignment_file, "w") as f:
+                f.write(">a\nACGT-\n>b\nACG-A\n")
+            cache = AlignmentCache(os.path.join(tmp, "cache"), 1, "v7.0")
+            key = cache.get_key(cluster_file, ["--auto"])
+            self.assertNotEqual(key, cache.get_key(cluster_file, ["--localpair"]))
+            self.assertNotEqual(key, AlignmentCache(os.path.join(tmp, "cache"), 1, "v7.1").get_key(cluster_file, ["--auto"]))
+            self.assertFalse(cache.get(key, os.path.join(tmp, "out.aln")))
+            cache.put(key, alignment_file)
+            self.assertTrue(cache.get(key, os.path.join(tmp, "out.aln")))
+            with open(os.path.join(tmp, "out.aln")) as f:
+                self.assertEqual(f.read(), ">a\nACGT-\n>b\nACG-A\n")
+            self.assertEqual(cache.hits, 1)
+            # the least recently used alignment is evicted first
+            cache.max_size = 2 * os.path.getsize(alignment_file)
+            os.utime(os.path.join(cache.cache_dir, key + ".fasta"), (time.time() - 100, time.time() - 100))
+            cache.put("b" * 40, alignment_file)
+            cache.put("c" * 40, alignment_file)
+            self.assertEqual(sorted(os.listdir(cache.cache_dir)), ["b" * 40 + ".fasta", "c" * 40 + ".fasta"])
+        finally:
+            shutil.rmtree(tmp)
+
+
+    def test_incremental_alignment(self):
+        # only clusters that grew by few sequences reuse the previous alignment
+        import os
+        import shutil
+        import tempfile
+        from alignments import Alignments
+        tmp = tempfile.mkdtemp()
+        try:
+            previous_file = os.path.join(tmp, "previous.fasta")
+            with open(previous_file, "w") as f:
+                f.write(">a Genus alpha\nACGT-\n>_R_b Genus beta\nACG-A\n")
+            alignments = Alignments.__new__(Alignments)
+            alignments.add_fraction = 0.2
+            alignments.previous = {}
+            alignments.previous_ids = {previous_file: set(Alignments.get_ids(previous_file))}
+            for seq_id in alignments.previous_ids[previous_file]:
+                alignments.previous[seq_id] = previous_file
+            self.assertEqual(alignments.previous_ids[previous_file], set(["a", "b"]))
+            cluster_file = os.path.join(tmp, "1.fasta")
+            alignment_file = os.path.join(tmp, "1.aln")
+            with open(cluster_file, "w") as f:
+                f.write(">b Genus beta\nTCGT\n>a Genus alpha\nACGT\n")
+            self.assertTrue(alignments.add_to_previous(cluster_file, alignment_file))
+            with open(alignment_file) as f:
+                self.assertEqual(f.read(), ">a Genus alpha\nACGT-\n>_R_b Genus beta\nACG-A\n")
+            # too many new sequences
+            with open(cluster_file, "w") as f:
+                f.write(">a Genus alpha\nACGT\n>b Genus beta\nTCGT\n>c Genus gamma\nACGA\n")
+            self.assertFalse(alignments.add_to_previous(cluster_file, alignment_file))
+            # a sequence was removed
+            with open(cluster_file, "w") as f:
+                f.write(">a Genus alpha\nACGT\n")
+            self.assertFalse(alignments.add_to_previous(cluster_file, alignment_file))
+            # an unchanged cluster reuses the alignment of exactly the same sequences
+            alignments.reused = 0
+            self.assertFalse(alignments.reuse_previous(cluster_file, alignment_file))
+            with open(cluster_file, "w") as f:
+                f.write(">b Genus beta\nTCGT\n>a Genus alpha\nACGT\n")
+            os.remove(alignment_file)
+            self.assertTrue(alignments.reuse_previous(cluster_file, alignment_file))
+            self.assertEqual(alignments.reused, 1)
+            with open(alignment_file) as f:
+                self.assertEqual(f.read(), ">a Genus alpha\nACGT-\n>_R_b Genus beta\nACG-A\n")
+            # only cluster alignments are copied from the previous run, and alignments/ is kept
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                os.makedirs("alignments")
+                shutil.copyfile(previous_file, "alignments/1.fasta")
+                for file_name in ["supermatrix.bin", "supermatrix_concatenated.fasta", "notes.txt"]:
+                    with open(os.path.join("alignments", file_name), "w") as f:
+                        f.write(">x\nACGT\n")
+                alignments.previous = {}
+                alignments.previous_ids = {}
+                alignments.load_previous_alignments()
+                self.assertEqual(sorted(os.listdir("alignments")), ["1.fasta", "notes.txt", "supermatrix.bin", "supermatrix_concatenated.fasta"])
+                self.assertEqual(list(alignments.previous_ids), [os.path.join(alignments.previous_dir, "1.fasta")])
+                self.assertEqual(sorted(alignments.previous), ["a", "b"])
+            finally:
+                os.chdir(cwd)
+        finally:
+            shutil.rmtree(tmp)
+
+
+    def test_run_mafft_streams_output(self):
+        # the aligner's stdout goes to the alignment file and its stderr to a per-job log and stderr
+        import os
+        import shutil
+        import sys
+        import tempfile
+        from StringIO import StringIO
+        from alignments import Alignments
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            alignments = Alignments.__new__(Alignments)
+            alignments.reports = []
+            command = [sys.executable, "-c", "import sys; sys.stdout.write('>a\\nAC-GT\\n'); sys.stderr.write('progress\\n'); sys.exit(3)"]
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertEqual(alignments.run_mafft("clusters/1.fasta", command, "1.fasta"), 3)
+                self.assertEqual(sys.stderr.getvalue(), "progress\n")
+            finally:
+                sys.stderr = stderr
+            with open("1.fasta") as f:
+                self.assertEqual(f.read(), ">a\nAC-GT\n")
+            with open("alignment_logs/1.fasta.log") as f:
+                self.assertEqual(f.read(), "progress\n")
+            self.assertEqual([report[:2] for report in alignments.reports], [("clusters/1.fasta", 3)])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_run_mafft_timeout(self):
+        import os
+        import shutil
+        import sys
+        import tempfile
+        from alignments import Alignments
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            alignments = Alignments.__new__(Alignments)
+            alignments.reports = []
+            alignments.timeout = 0.5
+            command = [sys.executable, "-c", "import time; time.sleep(30)"]
+            self.assertNotEqual(alignments.run_mafft("clusters/1.fasta", command, "1.fasta"), 0)
+            self.assertTrue(alignments.reports[0][2] < 10)
+            # the job runs in its own process group, with its address space limited by the wrapper
+            alignments.memory_limit = 1024 * 1024 * 1024
+            command = [sys.executable, "-c", "import os, resource, sys; sys.stdout.write(str(os.getpgrp() == os.getpid()) + ' ' + " + \
+                       "str(resource.getrlimit(resource.RLIMIT_AS)[0]))"]
+            self.assertEqual(alignments.run_mafft("clusters/1.fasta", command, "1.fasta"), 0)
+            with open("1.fasta") as f:
+                self.assertEqual(f.read(), "True " + str(1024 * 1024 * 1024))
+            # a missing aligner exits with status 127
+            self.assertEqual(alignments.run_mafft("clusters/1.fasta", ["sumac-no-such-aligner"], "1.fasta"), 127)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_slink_threshold_sweep(self):
+        # cutting one SLINK dendrogram must match clustering at each threshold from scratch
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from clusters import SLINKClusterBuilder
+        seq_keys = ["a", "b", "c", "d"]
+        gb = {"a": SeqRecord(Seq("A"), id="a", description="Genus alpha"),
+              "b": SeqRecord(Seq("A"), id="b", description="Genus beta"),
+              "c": SeqRecord(Seq("A"), id="c", description="Genus gamma"),
+              "d": SeqRecord(Seq("A"), id="d", description="Genus delta")}
+        distance_matrix = [[0.0, 1e-50, 1e-20, 10.0],
+                           [1e-50, 0.0, 1e-30, 10.0],
+                           [1e-20, 1e-30, 0.0, 1e-5],
+                           [10.0, 10.0, 1e-5, 0.0]]
+        slink = SLINKClusterBuilder(seq_keys, distance_matrix, 1e-10)
+        self.assertEqual(sorted([sorted(c) for c in slink.clusters]), [["a", "b", "c"], ["d"]])
+        rows = slink.sweep(gb, [1e-40, 1e-10, 1e-3], 2)
+        self.assertEqual([row[1] for row in rows], [3, 2, 1])
+        self.assertEqual([row[2] for row in rows], [1, 1, 1])
+        self.assertEqual([row[3] for row in rows], [2, 3, 4])
+        for threshold in [1e-40, 1e-10, 1e-3]:
+            from_scratch = SLINKClusterBuilder(seq_keys, distance_matrix, threshold).clusters
+            recut = SLINKClusterBuilder(seq_keys, None, threshold, (slink.Pi, slink.Lambda)).clusters
+            self.assertEqual(from_scratch, recut)
+
+
+
+    def test_greedy_clustering(self):
+        import random
+        from Bio.Seq import Seq, reverse_complement
+        from Bio.SeqRecord import SeqRecord
+        from clusters import GreedyClusterBuilder
+        random.seed(1)
+        locus1 = "".join([random.choice("ACGT") for i in range(800)])
+        locus2 = "".join([random.choice("ACGT") for i in range(500)])
+        # a partial sequence with point mutations and a deletion
+        partial = list(locus1[100:600])
+        for i in range(0, len(partial), 10):
+            partial[i] = "A" if partial[i] != "A" else "C"
+        partial = "".join(partial[:200] + partial[210:])
+        sequences = {"a": locus1, "b": partial, "c": locus2, "d": reverse_complement(locus1[50:700]),
+                     "e": locus2[:450], "f": locus2[:90]}
+        gb = {}
+        for key in sequences:
+            gb[key] = SeqRecord(Seq(sequences[key]), id=key, description="Genus species")
+            gb[key].annotations["organism"] = "Genus species"
+        for num_cores in [1, 2]:
+            builder = GreedyClusterBuilder(gb, sorted(sequences.keys()), num_cores, 100, 5000, 0.25, 0.75)
+            self.assertEqual(builder.clusters, [["a", "d", "b"], ["c", "e"]])
+            self.assertEqual(builder.strands["d"], "-")
+        # identical sequences from organisms such as "Genus sp." are not added back
+        gb["g"] = SeqRecord(Seq(locus2), id="g", description="Genus sp.")
+        gb["g"].annotations["organism"] = "Genus sp."
+        gb["h"] = SeqRecord(Seq(locus2), id="h", description="Genus other")
+        gb["h"].annotations["organism"] = "Genus other"
+        builder.expand_duplicates(gb, {"c": ["g", "h"]})
+        self.assertEqual(builder.clusters, [["a", "d", "b"], ["c", "e", "h"]])
+        # with several batches the workers of one pool follow the centroids found in earlier batches
+        loci = ["".join([random.choice("ACGT") for i in range(300)]) for j in range(40)]
+        gb = {}
+        for i in range(200):
+            key = str(i).zfill(3)
+            sequence = loci[i % len(loci)][i % 7:]
+            if i % 3 == 0:
+                sequence = reverse_complement(sequence)
+            gb[key] = SeqRecord(Seq(sequence), id=key, description="Genus species")
+            gb[key].annotations["organism"] = "Genus species"
+        keys = sorted(gb.keys())
+        builder = GreedyClusterBuilder(gb, keys, 1, 100, 5000, 0.25, 0.75)
+        self.assertEqual(len(builder.clusters), len(loci))
+        parallel = GreedyClusterBuilder(gb, keys, 2, 100, 5000, 0.25, 0.75)
+        self.assertEqual(parallel.clusters, builder.clusters)
+        self.assertEqual(parallel.strands, builder.strands)
+
+
+
+    def test_incremental_clustering(self):
+        import os
+        import random
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from clusters import ClusterBuilder, GreedyClusterBuilder, IncrementalClusterBuilder
+        random.seed(2)
+        loci = ["".join([random.choice("ACGT") for i in range(600)]) for j in range(3)]
+        gb = {}
+        for i, sequence in enumerate([loci[0], loci[0][:550], loci[1], loci[1][20:], loci[2], loci[0][10:]]):
+            key = "AB00000" + str(i) + ".1"
+            gb[key] = SeqRecord(Seq(sequence), id=key, description="Genus species" + str(i))
+            gb[key].annotations["organism"] = "Genus species" + str(i)
+        keys = sorted(gb.keys())
+        builder = GreedyClusterBuilder(gb, keys[:4], 1, 100, 5000, 0.25, 0.75)
+        builder.write_cluster_state(gb, "test_cluster_state")
+        state = ClusterBuilder.read_cluster_state("test_cluster_state")
+        os.remove("test_cluster_state")
+        builder = IncrementalClusterBuilder(gb, keys, state, 1, 100, 5000, 0.25, 0.75)
+        self.assertEqual(builder.clusters, [keys[0:2] + [keys[5]], keys[2:4], [keys[4]]])
+        self.assertEqual(builder.unchanged, set([1]))
+
+
+
+    def test_duplicate_collapsing(self):
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from genbank import SequenceDeduplicator
+        from clusters import ClusterBuilder
+        gb = {}
+        for key, sequence, organism in [("a", "ACGT", "Genus sp."), ("b", "acgt", "Genus beta"), ("c", "ACGA", "Genus gamma"),
+                                        ("d", "ACGT", "Genus delta"), ("e", "ACGA", "Genus gamma")]:
+            gb[key] = SeqRecord(Seq(sequence), id=key, description=organism)
+            gb[key].annotations["organism"] = organism
+        deduplicator = SequenceDeduplicator(gb, ["a", "b", "c", "d", "e"])
+        self.assertEqual(deduplicator.unique_keys, ["b", "c"])
+        self.assertEqual(deduplicator.get_num_duplicates(), 3)
+        builder = ClusterBuilder(deduplicator.unique_keys)
+        builder.clusters = [["b", "c"]]
+        builder.expand_duplicates(gb, deduplicator.duplicates)
+        self.assertEqual(sorted(builder.clusters[0]), ["a", "b", "c", "d", "e"])
+        self.assertEqual(sorted(builder.seq_keys), ["a", "b", "c", "d", "e"])
+
+
+
+    def test_assemble_cluster_fasta(self):
+        import os
+        import shutil
+        import tempfile
+        from Bio import SeqIO
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from clusters import ClusterBuilder
+        gb = {}
+        for i, otu in enumerate(["Genus alpha", "Genus beta", "Genus beta", "Genus gamma", "Genus delta", "Genus pi"]):
+            key = "AB00000" + str(i) + ".1"
+            gb[key] = SeqRecord(Seq("ACGT" * (i + 1)), id=key, description=otu + " gene")
+        keys = sorted(gb.keys())
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            builder = ClusterBuilder(keys)
+            builder.clusters = [keys[0:2], keys[0:4], keys[1:], keys[2:5]]
+            builder.unchanged = set([2])
+            builder.assemble_fasta(gb, 3, 2)
+            self.assertEqual(builder.clusters, [keys[0:4], keys[1:], keys[2:5]])
+            self.assertEqual(builder.cluster_files, ["clusters/1.fasta", "clusters/2.fasta", "clusters/3.fasta"])
+            self.assertEqual(builder.unchanged_files, ["clusters/2.fasta"])
+            ids = [record.id for record in SeqIO.parse("clusters/1.fasta", "fasta")]
+            self.assertEqual(ids, [keys[0], keys[1], keys[3]])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+
+    def test_assemble_uclust_fasta(self):
+        import os
+        import shutil
+        import tempfile
+        from clusters import ClusterBuilder
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("uclusters")
+            with open("uclusters/0", "w") as f:
+                f.write(">AB1.1_Genus_alpha_Genus_alpha_gene\nACGT\nAC\n>AB2.1_Genus_beta_Genus_beta_gene\nACGA\n")
+                f.write(">AB3.1_Genus_beta_Genus_beta_gene\nACGG\n>AB4.1_Genus_gamma_Genus_gamma_gene\nACGC\n")
+            with open("uclusters/1", "w") as f:
+                f.write(">AB5.1_Genus_alpha_Genus_alpha_gene\nACGT\n>AB6.1_Genus_alpha_Genus_alpha_gene\nACGA\n")
+            builder = ClusterBuilder([])
+            builder.clusters = ["1", "0"]
+            builder.assemble_fasta_uclust(3, 2)
+            self.assertEqual(builder.clusters, ["0"])
+            self.assertEqual(builder.cluster_files, ["clusters/1.fasta"])
+            with open("clusters/1.fasta") as f:
+                self.assertEqual(f.read(), ">AB1.1 Genus alpha Genus alpha gene\nACGT\nAC\n>AB2.1 Genus beta Genus beta gene\nACGA\n" \
+                                 ">AB4.1 Genus gamma Genus gamma gene\nACGC\n")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_uclust_duplicates_oriented(self):
+        # identical sequences of a representative on the minus strand are reverse complemented too
+        import os
+        import shutil
+        import tempfile
+        from Bio import SeqIO
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from clusters import UCLUSTClusterBuilder
+        gb = {}
+        for key, organism in [("A1.1", "Genus alpha"), ("B1.1", "Genus beta"), ("C1.1", "Genus gamma")]:
+            sequence = "CCAAAA" if key == "A1.1" else "TTTTGG"
+            gb[key] = SeqRecord(Seq(sequence), id=key, description="gene", annotations={"organism": organism})
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("uclusters")
+            with open("uclusters/0", "w") as f:
+                for key in ["A1.1", "B1.1"]:
+                    f.write(">" + UCLUSTClusterBuilder.fasta_header(gb[key]) + "\n" + str(gb[key].seq) + "\n")
+            builder = UCLUSTClusterBuilder.__new__(UCLUSTClusterBuilder)
+            builder.seq_keys = ["A1.1", "B1.1"]
+            builder.clusters = ["0"]
+            builder.strands = {"A1.1": "+", "B1.1": "-"}
+            builder.expand_duplicates(gb, {"B1.1": ["C1.1"]})
+            self.assertEqual(builder.strands["C1.1"], "-")
+            builder.assemble_fasta_uclust(3)
+            self.assertTrue(builder.oriented)
+            self.assertEqual([str(record.seq) for record in SeqIO.parse("clusters/1.fasta", "fasta")], ["CCAAAA"] * 3)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_assemble_oriented_fasta(self):
+        # sequences on the minus strand are written reverse complemented
+        import os
+        import shutil
+        import tempfile
+        from Bio import SeqIO
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from clusters import ClusterBuilder
+        gb = {"a": SeqRecord(Seq("AACG"), id="a", description="Genus alpha gene"),
+              "b": SeqRecord(Seq("CGTT"), id="b", description="Genus beta gene")}
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            builder = ClusterBuilder(["a", "b"])
+            builder.clusters = [["a", "b"]]
+            builder.assemble_fasta(gb, 2)
+            self.assertFalse(builder.oriented)
+            builder = ClusterBuilder(["a", "b"])
+            builder.clusters = [["a", "b"]]
+            builder.strands = {"a": "+", "b": "-"}
+            builder.assemble_fasta(gb, 2)
+            self.assertTrue(builder.oriented)
+            self.assertEqual([str(record.seq) for record in SeqIO.parse("clusters/1.fasta", "fasta")], ["AACG", "AACG"])
+            # a sequence may have a different orientation in each cluster, and a cluster
+            # with an unknown orientation is written as is
+            builder = ClusterBuilder(["a", "b"])
+            builder.clusters = [["a", "b"], ["b", "a"], ["a", "b"]]
+            builder.cluster_strands = [{"a": "+", "b": "-"}, {"a": "-", "b": "+"}, {}]
+            builder.assemble_fasta(gb, 2)
+            self.assertFalse(builder.oriented)
+            self.assertEqual(builder.cluster_strands, [{"a": "+", "b": "-"}, {"a": "-", "b": "+"}, {}])
+            self.assertEqual([str(record.seq) for record in SeqIO.parse("clusters/1.fasta", "fasta")], ["AACG", "AACG"])
+            self.assertEqual([str(record.seq) for record in SeqIO.parse("clusters/2.fasta", "fasta")], ["CGTT", "CGTT"])
+            self.assertEqual([str(record.seq) for record in SeqIO.parse("clusters/3.fasta", "fasta")], ["AACG", "CGTT"])
+            os.makedirs("uclusters")
+            with open("uclusters/0", "w") as f:
+                f.write(">a_Genus_alpha_gene\nAA\nCG\n>b_Genus_beta_gene\nCG\nTT\n")
+            builder = ClusterBuilder(["a", "b"])
+            builder.clusters = ["0"]
+            builder.strands = {"a": "+", "b": "-"}
+            builder.assemble_fasta_uclust(2)
+            self.assertTrue(builder.oriented)
+            with open("clusters/1.fasta") as f:
+                self.assertEqual(f.read(), ">a Genus alpha gene\nAA\nCG\n>b Genus beta gene\nAACG\n")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_alignment_summaries(self):
+        # the alignment files are summarized once and reused for reporting and concatenation
+        import os
+        import shutil
+        import tempfile
+        from alignments import Alignments
+        from supermatrix import Supermatrix
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("alignments")
+            with open("alignments/1.fasta", "w") as f:
+                f.write(">AB1.1 Genus alpha Genus alpha rbcL gene\nAC-T\n>AB2.1 Genus beta Genus beta rbcL gene\nACGT\n")
+                f.write(">AB3.1 Genus beta Genus beta rbcL gene\nA--T\n")
+            with open("alignments/2.fasta", "w") as f:
+                f.write(">AB4.1 Genus gamma Genus gamma matK gene\nGG\nA\n>AB5.1 Genus beta Genus beta matK gene\nG-A\n")
+            alignments = Alignments(["alignments/1.fasta", "alignments/2.fasta"], "sumac_aligned", 2)
+            summaries = alignments.get_summaries()
+            self.assertEqual([summary.num_rows for summary in summaries], [3, 2])
+            self.assertEqual([summary.length for summary in summaries], [4, 3])
+            self.assertEqual(summaries[0].otus, ["Genus alpha", "Genus beta"])
+            self.assertEqual(summaries[0].ungapped_lengths, [3, 4])
+            self.assertEqual(alignments.get_all_taxa(), ["Genus alpha", "Genus beta", "Genus gamma"])
+            supermatrix = Supermatrix(alignments)
+            self.assertEqual(supermatrix.otus["Genus beta"].accessions, ["AB2.1", "AB5.1"])
+            self.assertEqual(supermatrix.otus["Genus gamma"].sequence_lengths, [0, 3])
+            with open("alignments/supermatrix_concatenated.fasta") as f:
+                self.assertEqual(f.read(), "> Genus alpha\nAC-T???\n> Genus beta\nACGTG-A\n> Genus gamma\n????GGA\n")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_out_of_core_supermatrix(self):
+        # the memory-mapped concatenation writes the same files as the in-memory concatenation
+        import os
+        import shutil
+        import tempfile
+        from alignments import Alignments
+        from supermatrix import Supermatrix
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("alignments")
+            with open("alignments/1.fasta", "w") as f:
+                f.write(">AB1.1 Genus alpha rbcL\nAC-T\n>AB2.1 Genus beta rbcL\nACGT\n>AB3.1 Genus beta rbcL\nA--T\n")
+            with open("alignments/2.fasta", "w") as f:
+                f.write(">AB4.1 Genus gamma matK\nGGA\n>AB5.1 Genus beta matK\nG-A\n")
+            files = ["alignments/1.fasta", "alignments/2.fasta"]
+            supermatrix = Supermatrix(Alignments(files, "sumac_aligned", 1))
+            outputs = {}
+            for name in ["supermatrix_1.fasta", "supermatrix_2.fasta", "supermatrix_concatenated.fasta"]:
+                with open("alignments/" + name) as f:
+                    outputs[name] = f.read()
+            supermatrix_ooc = Supermatrix(Alignments(files, "sumac_aligned", 1), True)
+            for name in outputs:
+                with open("alignments/" + name) as f:
+                    self.assertEqual(f.read(), outputs[name])
+            # summaries without sequences are concatenated in memory by reading each alignment
+            alignments = Alignments(files, "sumac_aligned", 1)
+            alignments.keep_sequences = False
+            Supermatrix(alignments).matrix.close()
+            for name in outputs:
+                with open("alignments/" + name) as f:
+                    self.assertEqual(f.read(), outputs[name])
+            # and summaries with sequences drop them once they are in the supermatrix
+            alignments = Alignments(files, "sumac_aligned", 1)
+            Supermatrix(alignments).matrix.close()
+            self.assertEqual([summary.sequences for summary in alignments.get_summaries()], [[], []])
+            with open("alignments/supermatrix_concatenated.phy") as f:
+                self.assertEqual(f.read(), "3 7\nGenus_alpha AC-T???\nGenus_beta ACGTG-A\nGenus_gamma ????GGA\n")
+            for otu in supermatrix.otus:
+                self.assertEqual(supermatrix_ooc.otus[otu].accessions, supermatrix.otus[otu].accessions)
+                self.assertEqual(supermatrix_ooc.otus[otu].sequence_lengths, supermatrix.otus[otu].sequence_lengths)
+            self.assertFalse(os.path.exists("alignments/supermatrix_matrix.tmp"))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_binary_supermatrix(self):
+        # the binary matrix reloads without parsing the alignments and exports the same FASTA
+        import os
+        import shutil
+        import tempfile
+        from alignments import Alignments
+        from supermatrix import Supermatrix, BinaryMatrix
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("alignments")
+            with open("alignments/1.fasta", "w") as f:
+                f.write(">AB1.1 Genus alpha rbcL\nAC-T\n>AB2.1 Genus beta rbcL\nACGT\n")
+            with open("alignments/2.fasta", "w") as f:
+                f.write(">AB4.1 Genus gamma matK\nGGA\n>AB5.1 Genus beta matK\nG-A\n")
+            files = ["alignments/1.fasta", "alignments/2.fasta"]
+            supermatrix = Supermatrix(Alignments(files, "sumac_aligned", 1))
+            with open("alignments/supermatrix_concatenated.fasta") as f:
+                fasta = f.read()
+            matrix = BinaryMatrix.load_for(files)
+            self.assertEqual(matrix.names, ["Genus alpha", "Genus beta", "Genus gamma"])
+            self.assertEqual(matrix.loci, [("alignments/1.fasta", 0, 4), ("alignments/2.fasta", 4, 3)])
+            self.assertEqual([summary.num_rows for summary in matrix.summaries], [2, 2])
+            os.remove("alignments/supermatrix_concatenated.fasta")
+            reloaded = Supermatrix(matrix=matrix)
+            self.assertEqual(reloaded.otus["Genus beta"].accessions, ["AB2.1", "AB5.1"])
+            self.assertEqual(reloaded.get_coverage_density(), supermatrix.get_coverage_density())
+            with open("alignments/supermatrix_concatenated.fasta") as f:
+                self.assertEqual(f.read(), fasta)
+            matrix.export_nexus("supermatrix.nex")
+            with open("supermatrix.nex") as f:
+                nexus = f.read()
+            self.assertTrue("'Genus gamma' ????GGA\n" in nexus)
+            self.assertTrue("CHARSET locus2 = 5-7;" in nexus)
+            # a changed alignment is not loaded from the binary matrix
+            with open("alignments/2.fasta", "a") as f:
+                f.write(">AB6.1 Genus delta matK\nGGA\n")
+            self.assertEqual(BinaryMatrix.load_for(files), None)
+            matrix.close()
+            # a matrix of trimmed alignments is not loaded for a run without trimming
+            alignments = Alignments(files, "sumac_aligned", 1)
+            alignments.trim_gap_columns(0.3)
+            Supermatrix(alignments).matrix.close()
+            matrix = BinaryMatrix.load_for(files, max_gap_fraction=0.3)
+            self.assertEqual(matrix.num_sites, 5)
+            matrix.close()
+            self.assertEqual(BinaryMatrix.load_for(files), None)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
+    def test_trim_gap_columns(self):
+        import os
+        import shutil
+        import tempfile
+        from alignments import Alignments
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            os.makedirs("alignments")
+            with open("alignments/1.fasta", "w") as f:
+                f.write(">AB1.1 Genus alpha gene\nA-C-GT-\n>AB2.1 Genus beta gene\nA-CTG--\n>AB3.1 Genus gamma gene\nAT--GT-\n")
+            alignments = Alignments(["alignments/1.fasta"], "sumac_aligned", 1)
+            alignments.trim_gap_columns(0.5)
+            summary = alignments.get_summaries()[0]
+            self.assertEqual(summary.retained_columns, [0, 2, 4, 5])
+            self.assertEqual(summary.sequences, ["ACGT", "ACG-", "A-GT"])
+            self.assertEqual(summary.ungapped_lengths, [4, 3, 3])
+            self.assertEqual(summary.length, 4)
+            self.assertEqual(Alignments.format_columns(summary.retained_columns), "1;3;5-6")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+
+
     def setup_supermatrix(self):
         """
         Sets up supermatrix for some tests
@@ -68,6 +716,179 @@ class SumacTest(unittest.TestCase):
 
 
 
+    def test_bitset_decisiveness(self):
+        import random
+        from supermatrix import Supermatrix, Otu
+        sm = self.setup_supermatrix()
+        random.seed(7)
+        other = Supermatrix()
+        other.otus = {}
+        for i in range(12):
+            otu = Otu("otu" + str(i))
+            for locus in range(7):
+                otu.update("-", "x", random.choice([0, 0, 5]))
+            other.otus[otu.name] = otu
+        for matrix in [sm, other]:
+            pd = matrix.calculate_PD()
+            otu_counts = dict((otu, (matrix.otus[otu].other_decisive_triples, matrix.otus[otu].other_total_triples)) for otu in matrix.otus)
+            loci = matrix.loci
+            for otu in matrix.otus:
+                matrix.otus[otu].other_decisive_triples = None
+                matrix.otus[otu].other_total_triples = None
+            matrix.loci = None
+            self.assertEqual(pd, matrix.calculate_PD_by_triples())
+            self.assertEqual(loci, matrix.loci)
+            for otu in matrix.otus:
+                self.assertEqual(otu_counts[otu], (matrix.otus[otu].other_decisive_triples, matrix.otus[otu].other_total_triples))
+
+
+
+    def test_pattern_decisiveness(self):
+        import random
+        from decisiveness import BitsetDecisiveness, PatternDecisiveness
+        random.seed(11)
+        # few loci, so that many OTUs share a coverage pattern
+        sequence_lengths = [[random.choice([0, 3]) for locus in range(4)] for otu in range(40)]
+        patterns = PatternDecisiveness(sequence_lengths)
+        self.assertTrue(len(patterns.patterns) <= 16)
+        expected = BitsetDecisiveness(sequence_lengths).calculate()
+        counts = patterns.calculate()
+        self.assertEqual(counts.total, expected.total)
+        self.assertEqual(counts.decisive, expected.decisive)
+        self.assertEqual(counts.otu_decisive, expected.otu_decisive)
+        self.assertEqual(counts.locus_otus, expected.locus_otus)
+
+
+
+    def test_parallel_decisiveness(self):
+        import random
+        from decisiveness import PatternDecisiveness
+        random.seed(17)
+        patterns = PatternDecisiveness([[random.choice([0, 0, 3]) for locus in range(8)] for otu in range(80)])
+        shards = patterns.get_shards(3)
+        self.assertEqual(sorted(sum(shards, [])), range(len(patterns.patterns)))
+        pairs = [sum(len(patterns.patterns) - a for a in shard) for shard in shards]
+        self.assertTrue(max(pairs) - min(pairs) <= len(patterns.patterns))
+        expected = patterns.calculate()
+        counts = patterns.calculate(2)
+        self.assertEqual(counts.decisive, expected.decisive)
+        self.assertEqual(counts.otu_decisive, expected.otu_decisive)
+
+
+
+    def test_incremental_decisiveness(self):
+        import random
+        from decisiveness import PatternDecisiveness, IncrementalDecisiveness, count_disjoint_pairs
+        random.seed(19)
+        sequence_lengths = [[random.choice([0, 0, 3]) for locus in range(6)] for otu in range(30)]
+        incremental = IncrementalDecisiveness(sequence_lengths)
+        cells = [(otu, locus) for otu in range(0, 30, 3) for locus in range(6)]
+        changes = incremental.get_PD_changes(cells)
+        self.assertEqual(changes, incremental.get_PD_changes(cells, 2))
+        for (otu, locus), change in zip(cells, changes):
+            flipped = [list(lengths) for lengths in sequence_lengths]
+            flipped[otu][locus] = 0 if flipped[otu][locus] else 3
+            self.assertAlmostEqual(PatternDecisiveness(flipped).calculate().get_PD() - incremental.get_PD(), change)
+        # filling cells one after another keeps the count exact
+        for otu, locus in [(1, 2), (4, 0), (1, 5), (4, 0)]:
+            sequence_lengths[otu][locus] = 3
+            incremental.set_cell(otu, locus)
+            self.assertEqual(incremental.get_decisive(), PatternDecisiveness(sequence_lengths).calculate().decisive)
+        # pairs of OTUs with no shared locus, counting over subsets of the loci when there are few
+        groups = dict((bits, random.randint(1, 3)) for bits in range(64) if random.random() < 0.8)
+        expected = sum(groups[a] * groups[b] for a in groups for b in groups if a < b and a & b == 0) + groups.get(0, 0) * (groups.get(0, 0) - 1) // 2
+        self.assertEqual(count_disjoint_pairs(groups, 63), expected)
+        # with more loci every pair of bitsets is compared instead
+        self.assertEqual(count_disjoint_pairs(groups, 63 << 10 | 63), expected)
+        sm = self.setup_supermatrix()
+        # sequencing the second gene region for alpha makes its triples with gamma decisive
+        self.assertAlmostEqual(sm.get_PD_changes([("alpha", 1)])[0], 0.2)
+        # the supermatrix builds it once, from the decisive triples counted for its PD
+        incremental = sm.incremental
+        self.assertEqual(incremental.decisive, 2)
+        self.assertAlmostEqual(sm.get_PD_changes([("alpha", 1)])[0], 0.2)
+        self.assertTrue(sm.incremental is incremental)
+        # changes in PD do not count the decisive triples
+        incremental = IncrementalDecisiveness([sm.otus[name].sequence_lengths for name in sm.otus])
+        incremental.get_PD_changes([(0, 1)])
+        incremental.set_cell(0, 1)
+        self.assertEqual(incremental.decisive, None)
+        self.assertAlmostEqual(incremental.get_PD(), sm.calculate_PD_by_triples() + 0.2)
+
+
+
+    def test_acquisition_planner(self):
+        import os
+        import csv
+        import random
+        from decisiveness import IncrementalDecisiveness, AcquisitionPlanner
+        random.seed(23)
+        sequence_lengths = [[random.choice([0, 0, 3]) for locus in range(5)] for otu in range(25)]
+        costs = [1, 2, 1, 3, 1]
+        plan = AcquisitionPlanner(sequence_lengths, costs).plan(8)
+        # the same as evaluating every missing cell at each step
+        incremental = IncrementalDecisiveness(sequence_lengths)
+        for otu, locus, delta, pd in plan:
+            cells = [(o, l) for o in range(25) for l in range(5) if not incremental.coverage[o] & (1 << l)]
+            gains = [change/costs[l] for (o, l), change in zip(cells, incremental.get_PD_changes(cells))]
+            self.assertAlmostEqual(max(gains), delta/float(incremental.total)/costs[locus])
+            self.assertEqual(incremental.set_cell(otu, locus), delta)
+            self.assertAlmostEqual(incremental.get_PD(), pd)
+        self.assertEqual(len(plan), 8)
+        self.assertRaises(ValueError, AcquisitionPlanner, sequence_lengths, [1, 2, 0, 3, 1])
+        self.assertRaises(ValueError, AcquisitionPlanner, sequence_lengths, [1, 2, -1, 3, 1])
+        self.assertEqual(AcquisitionPlanner([]).plan(3), [])
+        sm = self.setup_supermatrix()
+        sm.make_acquisition_csv(3)
+        with open("sequence_acquisition_plan.csv") as f:
+            rows = list(csv.reader(f))
+        os.remove("sequence_acquisition_plan.csv")
+        self.assertEqual(rows[0], ["Rank", "OTU", "Gene Region", "Cost", "PD Increase", "PD"])
+        # the second sequence already makes every triple decisive
+        self.assertEqual(rows[1:], [["1", "omega", "1", "1", "0.3", "0.5"], ["2", "gamma", "1", "1", "0.5", "1.0"]])
+
+
+
+    def test_sampled_decisiveness(self):
+        import random
+        from supermatrix import Supermatrix, Otu
+        from decisiveness import PatternDecisiveness
+        random.seed(13)
+        other = Supermatrix()
+        other.otus = {}
+        for i in range(60):
+            otu = Otu("otu" + str(i))
+            for locus in range(6):
+                otu.update("-", "x", random.choice([0, 0, 5]))
+            other.otus[otu.name] = otu
+        for name, matrix in [("fixture", self.setup_supermatrix()), ("random", other)]:
+            matrix.calculate_PD()
+            exact = PatternDecisiveness([matrix.otus[otu].sequence_lengths for otu in matrix.otus]).calculate().get_PD()
+            exact_loci = dict((locus, matrix.loci[locus][0]/float(matrix.loci[locus][1])) for locus in matrix.loci)
+            estimate = matrix.estimate_PD(num_samples=20000, seed=5)
+            counts = matrix.pd_estimate
+            lower, upper = counts.get_PD_interval()
+            print("%s matrix: exact PD %.4f, estimated PD %.4f, error %.4f, 95%% CI %.4f-%.4f" % \
+                (name, exact, counts.get_PD(), abs(exact - counts.get_PD()), lower, upper))
+            self.assertEqual(counts.num_samples, 20000)
+            self.assertTrue(lower <= exact <= upper)
+            self.assertAlmostEqual(estimate, exact, delta=0.02)
+            for locus in exact_loci:
+                lower, upper = counts.get_locus_interval(locus)
+                self.assertTrue(lower <= exact_loci[locus] <= upper)
+        # stops early once the standard error is small enough
+        other.estimate_PD(num_samples=20000, target_se=0.01, seed=5)
+        self.assertTrue(other.pd_estimate.num_samples < 20000)
+        self.assertTrue(other.pd_estimate.get_standard_error() <= 0.01)
+        # a fully decisive matrix does not stop after the first batch
+        from decisiveness import SampledDecisiveness
+        sampler = SampledDecisiveness([[1, 1] for otu in range(10)], 5)
+        counts = list(sampler.iter_estimates(20000, 0.0002))[-1]
+        self.assertEqual(counts.get_PD(), 1.0)
+        self.assertTrue(counts.num_samples > 1000)
+
+
+
     def test_supermatrix_data_figure(self):
         import os
         sm = self.setup_supermatrix()